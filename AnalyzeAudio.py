@@ -1,21 +1,38 @@
-
-import av
+from __future__ import annotations
+import math
 import time
 import queue
-import webrtcvad
 import threading
-import numpy as np
 import multiprocessing
 from Srt import Srt 
+from Stats import StatsBlock
+from Trace import Tracer
+from Profiler import install_profiler
+from StreamInfo import StreamGap, wait_for_stream
+from LazyImport import lazy_import
+
+av = lazy_import("av")
+webrtcvad = lazy_import("webrtcvad")
+np = lazy_import("numpy")
+
+SILENCE_FLOOR_DBFS = -96.0  # 全零采样的电平, 低于16位采样最小的非零电平(约-90.3 dBFS)
+
+
+def peak_dbfs(peak):
+    """16位采样的峰值幅度换算为dBFS(满幅为0 dBFS), 全零时为SILENCE_FLOOR_DBFS"""
+    if peak <= 0:
+        return SILENCE_FLOOR_DBFS
+    return 20 * math.log10(peak / 32768)
 
 
 class DataHandler(threading.Thread):
     """负责从队列中接收音频数据，进行反序列化，并传递给分析线程"""
-    def __init__(self, input_que:multiprocessing.Queue, frame_que:queue.Queue, stop_event:threading.Event):
+    def __init__(self, input_que:multiprocessing.Queue, frame_que:queue.Queue, stop_event:threading.Event, tracer:Tracer = None):
         super().__init__()
         self.input_que = input_que  # 输入队列
         self.frame_que = frame_que  # 帧队列
         self.stop_event = stop_event  # 停止事件
+        self.tracer = tracer or Tracer(StatsBlock(), "AudioDataHandler")  # 阶段计时
 
     def deserialize_audio_frame(self, data):
         """从二进制数据反序列化为音频帧"""
@@ -32,8 +49,14 @@ class DataHandler(threading.Thread):
         while not self.stop_event.is_set() or not self.input_que.empty():
             try:
                 data = self.input_que.get_nowait()
+                if "enqueue_time" in data:
+                    self.tracer.record_duration("audio_queue_transit", time.time() - data["enqueue_time"], data["pts"])
+                deserialize_start = time.perf_counter()
                 frame = self.deserialize_audio_frame(data)
-                self.frame_que.put(frame)
+                self.tracer.record("audio_deserialize", deserialize_start, frame.pts)
+                if data.get("gap"):
+                    self.frame_que.put((StreamGap(*data["gap"]), None))
+                self.frame_que.put((frame, data.get("arrival_time")))
 
             except queue.Empty:
                 time.sleep(0.1)
@@ -43,29 +66,46 @@ class DataHandler(threading.Thread):
 
 class AudioAnalyzer(threading.Thread):
     """负责从帧队列中取出音频帧并进行声音活动分析"""
-    def __init__(self, sample_rate:int, frame_que: queue.Queue,  stop_event):
+    def __init__(self, sample_rate:int, frame_que: queue.Queue,  stop_event, sample_que = None, stats:StatsBlock = None, tracer:Tracer = None, srt:Srt = None, resume = False, event_bus = None):
         super().__init__()
         self.frame_que = frame_que
         self.stop_event = stop_event
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.tracer = tracer or Tracer(self.stats, "AudioAnalyzer")  # 阶段计时
 
         self.avg_noise = None
         self.max_noise = -float('inf')
         self.avg_voice = None
         self.max_voice = -float('inf')
+        self.peak = 0  # 当前区间内所有帧(不论是否为语音)的峰值幅度
         self.last_pts = 0
 
-        self.srt = Srt(f"Audio-Status", sample_rate)
+        self.srt = srt or Srt(f"Audio-Status", sample_rate, sample_que=sample_que, append=resume, event_bus=event_bus)
         self.vad = webrtcvad.Vad(1)  # 语音活动检测器
     
     def run(self):
         """不断处理帧队列中的音频帧，执行声音活动分析"""
         while not self.stop_event.is_set() or not self.frame_que.empty():
             try:
-                frame = self.frame_que.get_nowait()
-                self.process_frame(frame)
+                frame, arrival_time = self.frame_que.get_nowait()
+                if isinstance(frame, StreamGap):
+                    self.mark_gap(frame)
+                    continue
+                analyze_start = time.perf_counter()
+                self.process_frame(frame, arrival_time)
+                self.tracer.record("audio_analyze", analyze_start, frame.pts)
 
             except queue.Empty:
                 time.sleep(0.1)
+        self.srt.close()
+
+    def mark_gap(self, gap:StreamGap):
+        """标记断流缺口, 统计区间从重连后的第一帧重新开始"""
+        self.srt.write_gap(gap.start_pts, gap.end_pts)
+        self.max_noise = 0
+        self.max_voice = 0
+        self.peak = 0
+        self.last_pts = gap.end_pts
 
     def padding_length(self, frame_bytes, target_length):
         """调整帧字节长度至目标长度"""
@@ -94,11 +134,14 @@ class AudioAnalyzer(threading.Thread):
 
     
 
-    def process_frame(self, frame:av.AudioFrame):
-        """处理单个音频帧，评估声音活动并记录相关数据"""
+    def process_frame(self, frame:av.AudioFrame, arrival_time = None):
+        """处理单个音频帧，评估声音活动并记录相关数据, arrival_time为该帧的线上到达时间"""
         sample_rate = frame.sample_rate
+        self.stats.inc("audio_frames_analyzed_total")
+        self.stats.set("audio_analyzed_pts_seconds", frame.time or 0)
         frame_int16 = frame.to_ndarray().astype('int16')
         max_db = self.calculate_max_db(frame_int16)
+        self.peak = max(self.peak, int(np.max(np.abs(frame_int16.astype('int32')))))
         frame_bytes = frame_int16.tobytes()
         frame_bytes = self.padding_length(frame_bytes, 320)
         is_speech = self.vad.is_speech(frame_bytes, sample_rate)
@@ -120,40 +163,57 @@ class AudioAnalyzer(threading.Thread):
 
         if frame.pts - self.last_pts > 0.45 * frame.sample_rate:
             ratio = self.calculate_voice_to_noise_ratio()
+            # max_voice_db和max_noise_db是相对1个采样单位的分贝(不小于0), 静音判断使用peak_dbfs
+            dbfs = peak_dbfs(self.peak)
+            metrics = {"max_voice_db": self.max_voice, "max_noise_db": self.max_noise, "voice_noise_ratio": ratio, "peak_dbfs": dbfs}
             if ratio:
-                self.srt.write_srt(f"Max Voice:{self.max_voice:.2f} db, Max Noise:{self.max_noise:.2f} db, Voice(mean) to Noise(mean) Ratio: {ratio:.2f}", self.last_pts, frame.pts)
+                self.srt.write_srt(f"Max Voice:{self.max_voice:.2f} db, Max Noise:{self.max_noise:.2f} db, Voice(mean) to Noise(mean) Ratio: {ratio:.2f}, Peak: {dbfs:.1f} dBFS", self.last_pts, frame.pts, metrics, arrival_time)
             else:
-                self.srt.write_srt(f"Max Voice:{self.max_voice:.2f} db, Max Noise:{self.max_noise:.2f} db, Voice(mean) to Noise(mean) Ratio: None", self.last_pts, frame.pts)
+                self.srt.write_srt(f"Max Voice:{self.max_voice:.2f} db, Max Noise:{self.max_noise:.2f} db, Voice(mean) to Noise(mean) Ratio: None, Peak: {dbfs:.1f} dBFS", self.last_pts, frame.pts, metrics, arrival_time)
             self.max_noise = 0
             self.max_voice = 0
+            self.peak = 0
             self.last_pts = frame.pts
 
 
 
 class AudioAnalyProcesser(multiprocessing.Process):
     """音频分析流程的多进程类，负责音频数据处理和分析线程的管理"""
-    def __init__(self, input_que, stream_info_dict, stop_event):
+    def __init__(self, input_que, stream_info, stop_event, sample_que = None, stats:StatsBlock = None, stream_ready = None, resume = False, event_bus = None):
         super().__init__()
         self.input_que = input_que
-        self.stream_info_dict = stream_info_dict
+        self.stream_info = stream_info  # 流信息(StreamChannel或Manager字典)
         self.stop_event = stop_event
+        self.sample_que = sample_que  # 时间序列样本队列
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.stream_ready = stream_ready  # 使用Manager字典时, 流信息写入后设置的事件
+        self.resume = resume  # 被Supervisor重启时为True, 接续已有的结果文件
+        self.event_bus = event_bus  # 事件总线, 指标超过触发阈值时发布事件
        
 
     def run(self):
         """进程运行函数，监控音频流状态并启动音频处理和分析线程"""
-        while self.stream_info_dict['status'] == None:
-            time.sleep(0.01)
+        install_profiler("AudioAnalyProcesser")
+        stream_info = wait_for_stream(self.stream_info, self.stream_ready, self.stop_event,
+                                      beat=lambda: self.stats.beat("AudioAnalyProcesser"))
+        if stream_info is None:
+            return
 
-        if self.stream_info_dict['audio']:
+        if stream_info['audio']:
                 
             frame_que = queue.Queue()
-            data_handler = DataHandler(self.input_que, frame_que, self.stop_event)
-            analyzer = AudioAnalyzer(self.stream_info_dict['audio_sample_rate'], frame_que, self.stop_event)
+            tracer = Tracer(self.stats, "AudioAnalyProcesser")
+            data_handler = DataHandler(self.input_que, frame_que, self.stop_event, tracer)
+            analyzer = AudioAnalyzer(stream_info['audio_sample_rate'], frame_que, self.stop_event, self.sample_que, self.stats, tracer, resume=self.resume, event_bus=self.event_bus)
 
             analyzer.start()
             data_handler.start()
             while not self.stop_event.is_set():
+                # 工作线程都在运行时才发送心跳, 线程异常退出后由Supervisor重启本进程
+                if data_handler.is_alive() and analyzer.is_alive():
+                    self.stats.beat("AudioAnalyProcesser")
                 time.sleep(0.5)
             data_handler.join()
             analyzer.join()
+            tracer.dump()
 
@@ -0,0 +1,244 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+from fractions import Fraction
+import av
+from LoadConfig import CONFIG
+from Srt import Srt, SrtCollector
+from AnalyzeVideo import VideoAnalyzer
+from AnalyzeAudio import AudioAnalyzer
+
+
+AUDIO_RATE = 8000  # 分析使用的音频采样率, 与设备的G.711音频相同
+AUDIO_SAMPLES = 160  # 每个音频帧的样本数(20ms), 满足webrtcvad的帧长要求
+VIDEO_GROUP_SECONDS = 0.45  # 视频按该时长分组分析, 与实时分析的DataHandler一致
+
+_model = None  # 工作进程中共享的Vosk模型
+
+
+def init_worker(speech_mode):
+    """工作进程初始化: 需要语音识别时每个进程只加载一次模型"""
+    global _model
+    if speech_mode:
+        from SpeechRecognize import load_model
+        _model = load_model()
+
+
+def find_chunks(path, min_chunk_seconds = 10.0, max_chunks = None):
+    """只解复用不解码, 找出参考流(有视频时为视频, 否则为音频)的关键帧, 在关键帧处将文件分段
+    Returns:
+        list: [(开始时间戳, 结束时间戳或None)], 时间戳单位为参考流的time_base
+    """
+    container = av.open(path)
+    stream = container.streams.video[0] if container.streams.video else container.streams.audio[0]
+    keyframes = []
+    last_pts = None
+    for packet in container.demux(stream):
+        if packet.pts is None:
+            continue
+        if packet.is_keyframe:
+            keyframes.append(packet.pts)
+        last_pts = packet.pts if last_pts is None else max(last_pts, packet.pts)
+    container.close()
+    if not keyframes:
+        return [(None, None)]
+
+    # 每段不短于min_chunk_seconds, 段数不超过max_chunks
+    min_length = int(min_chunk_seconds / stream.time_base)
+    if max_chunks:
+        min_length = max(min_length, (last_pts - keyframes[0]) // max_chunks)
+    starts = [keyframes[0]]
+    for pts in keyframes[1:]:
+        if pts - starts[-1] >= min_length:
+            starts.append(pts)
+    return [(start, end) for start, end in zip(starts, starts[1:] + [None])]
+
+
+def analyze_chunk(args):
+    """在工作进程中分析一段: 从关键帧处开始解码, 将帧交给各分析器, 结果收集在内存中
+    Returns:
+        (段序号, {结果名: [(开始时间戳, 结束时间戳, 文本, 指标)]}, {结果名: 采样率}, 段内媒体时长)
+    """
+    index, path, start, end, options = args
+    stop_event = threading.Event()
+    container = av.open(path)
+    video_stream = container.streams.video[0] if container.streams.video else None
+    audio_stream = container.streams.audio[0] if container.streams.audio else None
+    reference = video_stream or audio_stream
+    origin = container.start_time / av.time_base if container.start_time is not None else 0.0  # 文件起始时间(秒)
+    start_time = float(start * reference.time_base) if start is not None else origin
+    end_time = float(end * reference.time_base) if end is not None else float('inf')
+    if start is not None:
+        container.seek(start, stream=reference, backward=True, any_frame=False)
+
+    collectors = {}
+    rates = {}
+    video_analyzer = None
+    if video_stream is not None and options["video"]:
+        video_rate = int(1 / video_stream.time_base)
+        collectors["Video-Status"] = SrtCollector(video_rate)
+        rates["Video-Status"] = video_rate
+        video_analyzer = VideoAnalyzer(video_rate, queue.Queue(), stop_event, srt=collectors["Video-Status"])
+        video_origin = int(origin / video_stream.time_base)
+    audio_analyzer = None
+    recognizers = []
+    resampler = None
+    if audio_stream is not None:
+        if options["audio"]:
+            collectors["Audio-Status"] = SrtCollector(AUDIO_RATE)
+            rates["Audio-Status"] = AUDIO_RATE
+            audio_analyzer = AudioAnalyzer(AUDIO_RATE, queue.Queue(), stop_event, srt=collectors["Audio-Status"])
+            audio_analyzer.last_pts = int((start_time - origin) * AUDIO_RATE)
+        if options["speech_mode"] in ('keyword', 'both') and options["keywords"]:
+            from SpeechRecognize import KeywordSpotter
+            collectors["Speech-Keyword"] = SrtCollector(AUDIO_RATE)
+            rates["Speech-Keyword"] = AUDIO_RATE
+            recognizers.append(KeywordSpotter(AUDIO_RATE, options["keywords"], queue.Queue(), stop_event, _model, srt=collectors["Speech-Keyword"]))
+            for recognizer in recognizers:
+                recognizer.recognizer = recognizer.init_recognizer(AUDIO_RATE)
+        if audio_analyzer or recognizers:
+            # 统一重采样为8kHz单声道s16, 按160个样本切帧, 与实时流的G.711音频帧一致
+            resampler = av.AudioResampler(format='s16', layout='mono', rate=AUDIO_RATE)
+            fifo = av.AudioFifo()
+    audio_pts = None  # 下一个音频帧的时间戳(8kHz样本数, 相对文件起始)
+
+    def process_audio(frame):
+        nonlocal audio_pts
+        if frame is not None and audio_pts is None:
+            audio_pts = int((max(frame.time or 0, start_time) - origin) * AUDIO_RATE)
+        for resampled in resampler.resample(frame):
+            resampled.pts = None
+            fifo.write(resampled)
+        while fifo.samples >= AUDIO_SAMPLES or (frame is None and fifo.samples > 0):
+            audio_frame = fifo.read(min(AUDIO_SAMPLES, fifo.samples))
+            audio_frame.pts = audio_pts
+            audio_frame.time_base = Fraction(1, AUDIO_RATE)
+            audio_frame.sample_rate = AUDIO_RATE
+            audio_pts += audio_frame.samples
+            if audio_analyzer:
+                audio_analyzer.process_frame(audio_frame)
+            for recognizer in recognizers:
+                recognizer.process_frame(audio_frame)
+
+    group = []
+    group_start = start_time - origin
+    last_time = start_time  # 本段已分析的最后一帧的时间(秒)
+    video_done = video_analyzer is None
+    audio_done = resampler is None
+    streams = [stream for stream, used in ((video_stream, not video_done), (audio_stream, not audio_done)) if used]
+    for packet in container.demux(*streams):
+        if video_done and audio_done:
+            break
+        for frame in packet.decode():
+            if frame.time is None or frame.time < start_time:
+                continue
+            if frame.time >= end_time:
+                if packet.stream is video_stream:
+                    video_done = True
+                else:
+                    audio_done = True
+                continue
+            last_time = max(last_time, frame.time)
+            if packet.stream is video_stream and not video_done:
+                # 时间戳改为相对文件起始, 与实时分析的结果时间轴一致
+                frame.pts -= video_origin
+                group.append(frame)
+                if frame.time - group_start > VIDEO_GROUP_SECONDS:
+                    if len(group) > 1:
+                        video_analyzer.analyze_frames(group)
+                        group = []
+                    group_start = frame.time
+            elif packet.stream is audio_stream and not audio_done:
+                process_audio(frame)
+    container.close()
+
+    if video_analyzer and len(group) > 1:
+        video_analyzer.analyze_frames(group)
+    if resampler:
+        process_audio(None)
+        for recognizer in recognizers:
+            recognizer.finish(audio_pts)
+    duration = (end_time if end is not None else last_time) - start_time
+    return index, {name: collector.entries for name, collector in collectors.items()}, rates, duration
+
+
+def analyze_file(path, workers = None, min_chunk_seconds = 10.0, video = True, audio = True, speech_mode = None, keywords = None, prefix = None):
+    """离线分析录制的文件, 在关键帧处分段并行分析, 按时间戳合并各段结果并写入results目录
+    Args:
+        path (str): TS/MP4等录制文件路径
+        workers (int): 工作进程数, 默认为CPU核数
+        min_chunk_seconds (float): 每段的最短时长(秒)
+        video, audio (bool): 是否运行视频/音频分析
+        speech_mode (str): 'full', 'keyword', 'both' 或 None(不做语音识别)
+        keywords (list): 关键词列表
+        prefix (str): 结果文件名前缀, 默认为文件名, 避免覆盖实时分析的结果
+    Returns:
+        dict: 分析统计
+    """
+    workers = workers or os.cpu_count() or 1
+    prefix = prefix or os.path.splitext(os.path.basename(path))[0]
+    start = time.perf_counter()
+    chunks = find_chunks(path, min_chunk_seconds, max_chunks=workers * 4)
+    # 完整转写不按关键帧分段, 而是由TranscribeFile在静音处切分, 避免把语句切断; 关键词识别仍随各段进行
+    chunk_speech_mode = 'keyword' if speech_mode in ('keyword', 'both') else None
+    options = {"video": video, "audio": audio, "speech_mode": chunk_speech_mode, "keywords": keywords or []}
+    tasks = [(index, path, chunk_start, chunk_end, options) for index, (chunk_start, chunk_end) in enumerate(chunks)]
+
+    results = {}
+    rates = {}
+    media_seconds = 0.0
+    with multiprocessing.Pool(min(workers, len(tasks)), initializer=init_worker, initargs=(chunk_speech_mode,)) as pool:
+        for index, chunk_entries, chunk_rates, duration in pool.imap_unordered(analyze_chunk, tasks):
+            for name, items in chunk_entries.items():
+                results.setdefault(name, []).extend(items)
+            rates.update(chunk_rates)
+            media_seconds += duration
+
+    # 各段结果按时间戳排序后写入, 与实时分析的输出格式相同; 不写入指标存储, 其中只记录实时流的指标
+    for name, items in results.items():
+        srt = Srt(f"{prefix}-{name}", rates[name], store=False)
+        for entry_start, entry_end, text, metrics in sorted(items, key=lambda item: (item[0], item[1])):
+            srt.write_srt(text, entry_start, entry_end, metrics)
+        srt.close()
+
+    entries = {name: len(items) for name, items in results.items()}
+    if speech_mode in ('full', 'both'):
+        from TranscribeFile import transcribe_file
+        try:
+            entries["Speech-Text"] = transcribe_file(path, workers, f"{prefix}-Speech-Text")["entries"]
+        except ValueError:
+            pass  # 文件没有音频流
+    elapsed = time.perf_counter() - start
+    return {
+        "chunks": len(chunks),
+        "workers": min(workers, len(tasks)),
+        "media_seconds": media_seconds,
+        "elapsed_seconds": elapsed,
+        "speedup": media_seconds / elapsed if elapsed else 0,
+        "entries": entries,
+    }
+
+
+# 用法: python AnalyzeFile.py results/output_stream.ts
+#       python AnalyzeFile.py incident.mp4 --workers 8 --speech both
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze a recorded TS/MP4 file offline, in parallel chunks split at keyframes.")
+    parser.add_argument("file", help="recorded file, e.g. results/output_stream.ts")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--min-chunk", type=float, default=10.0, help="minimum chunk length in seconds")
+    parser.add_argument("--no-video", action="store_true", help="skip video analysis")
+    parser.add_argument("--no-audio", action="store_true", help="skip audio analysis")
+    parser.add_argument("--speech", choices=['none', 'full', 'keyword', 'both'], default=CONFIG.get('speech_mode', 'full'),
+                        help="speech recognition mode (default: speech_mode in config.json)")
+    parser.add_argument("--prefix", default=None, help="result file name prefix (default: input file name)")
+    args = parser.parse_args()
+
+    result = analyze_file(args.file, args.workers, args.min_chunk, not args.no_video, not args.no_audio,
+                          None if args.speech == 'none' else args.speech, CONFIG.get('keywords'), args.prefix)
+    print(f"Analyzed {result['media_seconds']:.1f} s of media in {result['elapsed_seconds']:.1f} s "
+          f"({result['speedup']:.1f}x real time, {result['chunks']} chunks on {result['workers']} workers)")
+    for name, count in result["entries"].items():
+        print(f"  {name}: {count} entries")
@@ -2,11 +2,16 @@ import time
 import queue
 import threading
 import multiprocessing
-import numpy as np
-from Srt import Srt
-from ping3 import ping
-from RTP import RTP
 from Srt import Srt
+from RTP import RTP, parse_sender_report
+from AnalyzeSync import AVSyncAnalyzer
+from Stats import StatsBlock
+from StreamInfo import StreamChannel
+from Profiler import install_profiler
+from LazyImport import lazy_import
+
+np = lazy_import("numpy")
+ping3 = lazy_import("ping3")
 
 
 class SharedValue:
@@ -28,7 +33,7 @@ class Ping(threading.Thread):
     def run(self):
         while not self.stop_event.is_set():
             try:
-               delay = ping(self.server_host, self.timeout)
+               delay = ping3.ping(self.server_host, self.timeout)
                with self.delay.lock:
                   self.delay.value = delay if delay is not None else 0  # 如果ping返回None, 则视为0延迟
             except Exception as e:
@@ -39,9 +44,11 @@ class Ping(threading.Thread):
 
 class NetAnalyzerForEachTrack(threading.Thread):
     """为每个视频/音频轨道处理接收的RTP包, 计算丢包、抖动等网络指标"""
-    def __init__(self, init_data, input_que:queue.Queue, delay:SharedValue, stop_event):
+    def __init__(self, init_data, input_que:queue.Queue, delay:SharedValue, stop_event, sample_que = None, stats:StatsBlock = None, srt:Srt = None, resume = False, event_bus = None, prefix = None):
         super().__init__()
-        self.srt = Srt(f'{init_data['type']}-Net-Status', init_data['sample_rate'])
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        name = f"{init_data['type']}-Net-Status"
+        self.srt = srt or Srt(f"{prefix}-{name}" if prefix else name, init_data['sample_rate'], sample_que=sample_que, append=resume, event_bus=event_bus)
         self.input_que = input_que
         self.delay = delay
         self.stop_event = stop_event
@@ -51,6 +58,7 @@ class NetAnalyzerForEachTrack(threading.Thread):
     
         self.track_id = init_data['track_id']
         self.type = init_data['type']
+        self.stats_writer = 1 if self.type == 'audio' else 0  # 本线程在net_rtp_packets_lost_total中的写入者序号
         self.ssrc = init_data['ssrc']
         self.sample_rate = init_data['sample_rate']
         self.init_seq = init_data['init_seq']
@@ -59,7 +67,7 @@ class NetAnalyzerForEachTrack(threading.Thread):
         
         self.prev_seq = self.init_seq - 1
         self.prev_timestamp = self.init_timestamp
-        self.prev_arrival_time = time.perf_counter()
+        self.prev_arrival_time = time.time()
 
         self.jitter = []
         self.pts_carry = 0
@@ -73,6 +81,22 @@ class NetAnalyzerForEachTrack(threading.Thread):
 
         
 
+    def reconnect(self, init_data):
+        """重连后的新RTP会话: 序列号和时间戳重新开始, 时间轴按断流的实际时长接续并标记缺口"""
+        gap_end = self.prev_pts + max(int((time.time() - self.prev_arrival_time) * self.sample_rate), 1)
+        self.srt.write_gap(self.prev_pts, gap_end)
+        self.ssrc = init_data['ssrc']
+        self.init_seq = init_data['init_seq']
+        self.init_timestamp = init_data['init_timestamp'] - gap_end  # calculate_pts从gap_end开始计算
+        self.prev_seq = self.init_seq - 1
+        self.prev_timestamp = init_data['init_timestamp']
+        self.prev_arrival_time = time.time()
+        self.pts_carry = 0
+        self.prev_pts = gap_end
+        self.jitter.clear()
+        self.loss_num = 0
+        self.recv_num = 1
+
     def get_delay(self):
         """安全获取当前延迟值"""
         with self.delay.lock:
@@ -107,6 +131,8 @@ class NetAnalyzerForEachTrack(threading.Thread):
             return
         
         self.loss_num += loss_num
+        if loss_num:
+            self.stats.inc("net_rtp_packets_lost_total", loss_num, self.stats_writer)
         self.recv_num += 1 + loss_num
         self.total_loss_num += loss_num
         self.total_recv_num += 1 + loss_num
@@ -130,7 +156,13 @@ class NetAnalyzerForEachTrack(threading.Thread):
             total_loss_rate = self.total_loss_num / self.total_recv_num * 100
             
             report_text = f"Track:{self.type}, Delay: {curr_delay:.2f} ms, Jitter: {jitter:.2f} ms, Loss_rate: {loss_rate:.2f} %, Total_loss_rate: {total_loss_rate:.2f} %"
-            self.srt.write_srt(report_text, curr_pts , curr_pts + self.sample_rate // 2)
+            metrics = {
+                "delay_ms": curr_delay,
+                "jitter_ms": jitter,
+                "loss_rate_pct": loss_rate,
+                "total_loss_rate_pct": total_loss_rate,
+            }
+            self.srt.write_srt(report_text, curr_pts , curr_pts + self.sample_rate // 2, metrics, rtp.arrival_time)
             
             
             self.loss_num = 0
@@ -148,58 +180,137 @@ class NetAnalyzerForEachTrack(threading.Thread):
         while not self.stop_event.is_set() or not self.input_que.empty():
             try:
                 rtp_packet = self.input_que.get_nowait()
+                if isinstance(rtp_packet, dict):
+                    self.reconnect(rtp_packet)  # 与RTP包经同一队列传入, 保证在新会话的第一个包之前处理
+                    continue
                 self.rtp_packet_handler(rtp_packet)
                         
             except queue.Empty:
                 time.sleep(0.01)
+        self.srt.close()
         
 
 class NetAnalyProcesser(multiprocessing.Process):
     """网络分析处理器，负责管理网络分析任务"""
-    def __init__(self, input_que:queue.Queue, server_host, pipeline, stop_event):
+    def __init__(self, input_que:queue.Queue, server_host, pipeline, stop_event, sample_que = None, stats:StatsBlock = None, resume = False, event_bus = None, sync_interval = 1.0, prefix = None):
         super().__init__()
         
         self.server_host = server_host
         self.input_que = input_que
         
-        self.pipeline = pipeline
+        self.pipeline = pipeline  # 中继发布各轨道初始化信息的StreamChannel(旧的入口脚本为管道)
         self.stop_event = stop_event
+        self.sample_que = sample_que  # 时间序列样本队列
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.resume = resume  # 被Supervisor重启时为True, 接续已有的结果文件
+        self.event_bus = event_bus  # 事件总线, 丢包率超过触发阈值时发布事件
         self.tasks = []
-        self.queues = {}
+        self.queues = {}  # SSRC -> 轨道分析线程的队列
+        self.tracks = {}  # 轨道类型 -> 轨道分析线程, 重连后沿用同一个线程和结果文件
+        self.track_info = {}  # 轨道类型 -> 已经交给分析线程的初始化信息
+        self.init_version = 0  # 已读取的初始化信息版本
+        self.sync_interval = sync_interval  # 音画同步报告的间隔(秒), 为None时不分析
+        self.sync = None  # 音画同步分析, 在子进程中创建
+        self.prefix = prefix  # 结果文件名前缀, 回放抓包时使用, 避免覆盖实时分析的结果
         
         
 
 
-    def run(self):
-        
-        delay = SharedValue()
-        self.tasks.append(Ping(self.server_host, delay, self.stop_event))
-
+    def init_info_changed(self):
+        """中继是否发布了新的初始化信息(重连后的新会话)"""
+        if isinstance(self.pipeline, StreamChannel):
+            return self.pipeline.version != self.init_version
+        return self.pipeline.poll()
+
+    def wait_init_info(self):
+        """等待中继发布的各轨道初始化信息, 等待期间保持心跳; 收到停止事件时返回None
+        StreamChannel保留最新版本, 被Supervisor重启后立即取得当前会话的信息; 管道(旧的入口脚本)接收到'start'为止"""
+        if isinstance(self.pipeline, StreamChannel):
+            while not self.stop_event.is_set():
+                descriptor = self.pipeline.wait(self.init_version, self.stop_event, timeout=1.0)
+                if descriptor is not None:
+                    self.init_version = descriptor.version
+                    return descriptor["tracks"]
+                self.stats.beat("NetAnalyProcesser")
+            return None
+        tracks = []
         while not self.stop_event.is_set():
+            if not self.pipeline.poll(1.0):
+                self.stats.beat("NetAnalyProcesser")
+                continue
             recv = self.pipeline.recv()
             if recv == 'start':
-                break
+                return tracks
+            tracks.append(recv)
+        return None
+
+    def receive_init_info(self, delay:SharedValue):
+        """读取各轨道初始化信息
+        第一次会话为每个轨道创建分析线程; 重连后的会话把新的初始化信息交给已有的线程, 沿用原来的时间轴"""
+        tracks = self.wait_init_info()
+        if tracks is None:
+            return
+        for recv in tracks:
+            if self.track_info.get(recv["type"]) == recv:
+                continue  # 进程内接入每个轨道到达时都重新发布全部轨道, 已处理的不再重复
+            self.track_info[recv["type"]] = recv
+            track = self.tracks.get(recv["type"])
+            if track is None:
+                track = NetAnalyzerForEachTrack(recv, queue.Queue(), delay, self.stop_event, self.sample_que, self.stats, resume=self.resume, event_bus=self.event_bus, prefix=self.prefix)
+                self.tracks[recv["type"]] = track
+                self.tasks.append(track)
             else:
-                ssrc = recv["ssrc"]
-                new_queue = queue.Queue()
-                self.queues[ssrc] = new_queue
-                self.tasks.append(NetAnalyzerForEachTrack(recv, new_queue, delay, self.stop_event))
-
+                track.input_que.put(recv)
+            self.queues[recv["ssrc"]] = track.input_que
+            if self.sync:
+                self.sync.add_track(recv)
         for task in self.tasks:
-            task.start()
+            if task.ident is None:  # 尚未启动(包括重连后才出现的轨道)
+                task.start()
+
+    def run(self):
+        install_profiler("NetAnalyProcesser")
+        delay = SharedValue()
+        if self.sync_interval:
+            self.sync = AVSyncAnalyzer(self.sample_que, self.stats, resume=self.resume, event_bus=self.event_bus, interval=self.sync_interval, prefix=self.prefix)
+        if self.server_host:
+            self.tasks.append(Ping(self.server_host, delay, self.stop_event))  # 回放抓包时可不ping, 延迟固定为0
+
+        self.receive_init_info(delay)
         
 
+        last_beat = 0
         while not self.stop_event.is_set() or not self.input_que.empty():
             try:
                 data = self.input_que.get_nowait()
-                rtp_packet = RTP(data)
-                if rtp_packet.is_rtp_packet:
-                    self.queues[rtp_packet.ssrc].put(rtp_packet)
+                # UDP中继每轮批量放入一个列表, TCP交织传输时逐包放入
+                for item in (data if isinstance(data, list) else (data,)):
+                    rtp_packet = RTP(item)
+                    self.stats.inc("net_rtp_packets_processed_total")
+                    if rtp_packet.is_rtp_packet:
+                        if rtp_packet.ssrc not in self.queues and self.init_info_changed():
+                            self.receive_init_info(delay)  # 重连后的新会话, 中继已发布新的初始化信息
+                        if rtp_packet.ssrc in self.queues:
+                            self.queues[rtp_packet.ssrc].put(rtp_packet)
+                            if self.sync:
+                                self.sync.packet(rtp_packet)
+                    elif self.sync:
+                        # 中继同时截取RTCP发送者报告, 用于音画同步分析
+                        report = parse_sender_report(item[0] if isinstance(item, tuple) else item)
+                        if report:
+                            self.sync.sender_report(*report)
             except queue.Empty:
                 time.sleep(0.01)
+            # 分析线程都在运行时才发送心跳, 线程异常退出后由Supervisor重启本进程
+            if time.time() - last_beat >= 1 and all(task.is_alive() for task in self.tasks):
+                self.stats.beat("NetAnalyProcesser")
+                last_beat = time.time()
         
         for task in self.tasks:
-            task.join()
+            if task.ident is not None:
+                task.join()
+        if self.sync:
+            self.sync.close()
     
 
 
@@ -0,0 +1,103 @@
+from Srt import Srt
+from RTP import RTP
+from Stats import StatsBlock
+from Latency import timestamp_delta
+
+
+class SyncTrack:
+    """一个轨道的时钟映射和当前窗口内的最小传输延迟"""
+    def __init__(self, init_data):
+        self.type = init_data['type']
+        self.sample_rate = init_data['sample_rate']
+        self.init_timestamp = init_data.get('init_timestamp')  # RTP-Info中的rtptime, 对应PLAY的起点
+        self.report = None  # 最近的RTCP SR: (NTP时间, RTP时间戳)
+        self.min_delay = None  # 窗口内 到达时间 - 采集时间 的最小值(秒), 取最小值滤除排队抖动
+
+    def capture_time(self, timestamp, reference):
+        """RTP时间戳在公共时钟上的采集时间(秒)
+        reference为'rtcp'时为发送端的NTP时间, 为'rtp-info'时为相对PLAY起点的时间"""
+        if reference == 'rtcp':
+            ntp, rtp_timestamp = self.report
+            return ntp + timestamp_delta(timestamp, rtp_timestamp) / self.sample_rate
+        return timestamp_delta(timestamp, self.init_timestamp) / self.sample_rate
+
+
+class AVSyncAnalyzer:
+    """音画同步分析, 在NetAnalyProcesser中逐个处理RTP头部, 不解码任何数据
+    两个轨道的RTP时间戳先映射到公共时钟: 两个轨道都收到RTCP SR时用发送端的NTP时间, 否则用RTP-Info中同一PLAY起点的rtptime.
+    每个轨道取窗口内 到达时间 - 采集时间 的最小值, 两者之差即接收端的音画偏移: 为正时视频晚于音频.
+    每interval秒写入一条AV-Sync报告, 漂移为相对本会话第一个窗口(或参考时钟切换后)的偏移变化"""
+    def __init__(self, sample_que = None, stats:StatsBlock = None, srt:Srt = None, resume = False, event_bus = None, interval = 1.0, prefix = None):
+        self.stats = stats or StatsBlock()
+        self.srt = srt or Srt(f"{prefix}-AV-Sync" if prefix else "AV-Sync", 1000, sample_que=sample_que, append=resume, event_bus=event_bus)
+        self.interval = interval  # 报告间隔(秒)
+        self.tracks = {}  # SSRC -> SyncTrack
+        self.reference = None  # 当前使用的公共时钟: 'rtcp' 或 'rtp-info'
+        self.baseline = None  # 计算漂移的基准偏移(秒)
+        self.window_start = None  # 当前窗口开始的到达时间
+        self.origin = None  # 报告时间轴的起点(time.time()), 取流水线启动时间, 重启后的进程接续同一时间轴
+
+    def add_track(self, init_data):
+        """中继发来的轨道初始化信息, 重连后的新会话同样经过这里"""
+        self.tracks = {ssrc: track for ssrc, track in self.tracks.items() if track.type != init_data['type']}
+        self.tracks[init_data['ssrc']] = SyncTrack(init_data)
+        self.reference = None
+        self.window_start = None
+
+    def sender_report(self, ssrc, ntp, rtp_timestamp):
+        track = self.tracks.get(ssrc)
+        if track is not None:
+            track.report = (ntp, rtp_timestamp)
+
+    def select_reference(self):
+        """两个轨道都有SR时用RTCP, 否则用RTP-Info, 都没有时无法比较"""
+        tracks = list(self.tracks.values())
+        if len(tracks) < 2:
+            return None
+        if all(track.report for track in tracks):
+            return 'rtcp'
+        if all(track.init_timestamp is not None for track in tracks):
+            return 'rtp-info'
+        return None
+
+    def packet(self, rtp:RTP):
+        """处理一个RTP头部"""
+        track = self.tracks.get(rtp.ssrc)
+        if track is None:
+            return
+        reference = self.select_reference()
+        if reference is None:
+            return
+        if reference != self.reference:
+            # 参考时钟变化(如收到第一批SR)后两种时钟不可比, 重新开始窗口和漂移基准
+            for other in self.tracks.values():
+                other.min_delay = None
+            self.reference = reference
+            self.baseline = None
+            self.window_start = rtp.arrival_time
+        delay = rtp.arrival_time - track.capture_time(rtp.timestamp, reference)
+        if track.min_delay is None or delay < track.min_delay:
+            track.min_delay = delay
+        if rtp.arrival_time - self.window_start >= self.interval:
+            self.report(rtp.arrival_time)
+
+    def report(self, arrival_time):
+        tracks = {track.type: track for track in self.tracks.values()}
+        video, audio = tracks.get('video'), tracks.get('audio')
+        if video and audio and video.min_delay is not None and audio.min_delay is not None:
+            offset = video.min_delay - audio.min_delay
+            if self.baseline is None:
+                self.baseline = offset
+            drift = offset - self.baseline
+            if self.origin is None:
+                self.origin = self.stats.get("pipeline_start_time_seconds") or self.window_start
+            start = int((self.window_start - self.origin) * 1000)
+            end = int((arrival_time - self.origin) * 1000)
+            self.srt.write_srt(f"A/V Offset: {offset * 1000:.1f} ms, Drift: {drift * 1000:.1f} ms, Reference: {self.reference}",
+                               start, end, {"av_offset_ms": offset * 1000, "av_drift_ms": drift * 1000}, arrival_time)
+        for track in self.tracks.values():
+            track.min_delay = None
+        self.window_start = arrival_time
+
+    def close(self):
+        self.srt.close()
@@ -1,22 +1,31 @@
-
-import av
-import cv2
+from __future__ import annotations
 import time
 import queue
 import threading
-import numpy as np
 import multiprocessing
 from Srt import Srt
+from LoadConfig import CONFIG
+from Stats import StatsBlock
+from Trace import Tracer
+from Profiler import install_profiler
+from StreamInfo import StreamGap, wait_for_stream
+from LazyImport import lazy_import
+
+av = lazy_import("av")
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
 
 class DataHandler(threading.Thread):
     """负责从队列中接收视频数据, 进行反序列化, 并缓存处理"""
-    def __init__(self, input_que:multiprocessing.Queue, buffer_que:queue.Queue, stop_event):
+    def __init__(self, input_que:multiprocessing.Queue, buffer_que:queue.Queue, stop_event, tracer:Tracer = None):
         super().__init__()
         self.input_que = input_que  # 输入队列
         self.buffer_que = buffer_que  # 缓冲队列
         self.buffer = []  # 用于存储反序列化后的帧
+        self.arrival_time = None  # 缓冲区中最新一帧的线上到达时间
         self.last_time = 0.0  # 上一帧的时间戳
         self.stop_event = stop_event  # 停止事件
+        self.tracer = tracer or Tracer(StatsBlock(), "VideoDataHandler")  # 阶段计时
 
     def deserialize_video_frame(self, data):
         """从二进制数据反序列化为视频帧"""
@@ -33,27 +42,98 @@ class DataHandler(threading.Thread):
         while not self.stop_event.is_set() or not self.input_que.empty():
             try:
                 data = self.input_que.get_nowait()
+                if "enqueue_time" in data:
+                    self.tracer.record_duration("video_queue_transit", time.time() - data["enqueue_time"], data["pts"])
+                deserialize_start = time.perf_counter()
                 frame = self.deserialize_video_frame(data)
+                self.tracer.record("video_deserialize", deserialize_start, frame.pts)
+                if data.get("gap"):
+                    # 断流前的帧单独分析, 不与重连后的帧合并, 随后标记缺口
+                    if len(self.buffer) > 1:
+                        self.buffer_que.put((self.buffer.copy(), self.arrival_time))
+                    self.buffer.clear()
+                    self.buffer_que.put((StreamGap(*data["gap"]), None))
+                    self.last_time = frame.time
                 self.buffer.append(frame)
+                self.arrival_time = data.get("arrival_time")
                 if frame.time - self.last_time > 0.45:
                     if len(self.buffer) > 1:
                         if self.buffer_que:
-                            self.buffer_que.put(self.buffer.copy())    
+                            self.buffer_que.put((self.buffer.copy(), self.arrival_time))
                         self.buffer.clear()
                     self.last_time = frame.time
 
             except queue.Empty:
                 time.sleep(0.01)
-        self.buffer_que.put(self.buffer.copy())
+        self.buffer_que.put((self.buffer.copy(), self.arrival_time))
         
 
+class FrameFaultDetector:
+    """在缩小的亮度平面上检测常见的摄像头故障: 画面冻结、黑屏和镜头遮挡
+    每帧直接从Y平面按步长取约width像素宽的缩略图(不转换颜色、不拷贝整帧), 状态只有上一帧的缩略图, 每帧耗时为微秒级
+    冻结: 与上一帧的平均绝对差低于frozen_mad; 黑屏: 亮度均值和标准差都很低; 遮挡: 不是黑屏但几乎没有边缘和亮度变化"""
+    def __init__(self, width = 64, frozen_mad = 0.5, black_luma = 24.0, black_std = 6.0, obstructed_edge = 2.0, obstructed_std = 12.0):
+        self.width = width  # 缩略图的目标宽度
+        self.frozen_mad = frozen_mad  # 冻结阈值: 相邻帧缩略图的平均绝对差
+        self.black_luma = black_luma  # 黑屏阈值: 亮度均值(Y, 0-255)
+        self.black_std = black_std  # 黑屏阈值: 亮度标准差
+        self.obstructed_edge = obstructed_edge  # 遮挡阈值: 边缘能量(相邻像素的平均绝对差)
+        self.obstructed_std = obstructed_std  # 遮挡阈值: 亮度标准差
+        self.previous = None  # 上一帧的缩略图
+        self.previous_time = None  # 上一帧的时间(秒)
+        self.frozen_since = None  # 连续冻结开始的时间(秒), 未冻结时为None
+
+    def thumbnail(self, frame:av.VideoFrame):
+        """按步长从Y平面取缩略图"""
+        plane = frame.planes[0]
+        luma = np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)[:frame.height, :frame.width]
+        step = max(frame.width // self.width, 1)
+        return luma[::step, ::step].astype(np.int16)
+
+    def update(self, frame:av.VideoFrame):
+        """检测一帧
+        Returns:
+            tuple: (是否冻结, 是否黑屏, 是否遮挡, 亮度均值, 边缘能量)
+        """
+        thumb = self.thumbnail(frame)
+        mean = float(thumb.mean())
+        std = float(thumb.std())
+        edge = float(np.abs(np.diff(thumb, axis=1)).mean() + np.abs(np.diff(thumb, axis=0)).mean())
+        black = mean < self.black_luma and std < self.black_std
+        obstructed = not black and edge < self.obstructed_edge and std < self.obstructed_std
+        frozen = (not black and self.previous is not None and self.previous.shape == thumb.shape
+                  and float(np.abs(thumb - self.previous).mean()) < self.frozen_mad)
+        if not frozen:
+            self.frozen_since = None
+        elif self.frozen_since is None:
+            self.frozen_since = self.previous_time
+        self.previous = thumb
+        self.previous_time = frame.time
+        return frozen, black, obstructed, mean, edge
+
+    def frozen_seconds(self):
+        """当前连续冻结的时长(秒), 可以跨越多个报告窗口"""
+        if self.frozen_since is None or self.previous_time is None:
+            return 0.0
+        return self.previous_time - self.frozen_since
+
+    def reset(self):
+        """断流后重新开始, 缺口前后的帧不做比较"""
+        self.previous = None
+        self.previous_time = None
+        self.frozen_since = None
+
+
 class VideoAnalyzer(threading.Thread):
     """视频数据的分析, 包括绿色比例、马赛克比例和比特率的计算"""
-    def __init__(self, sample_rate:int, buffer_que:queue.Queue, stop_event):
+    def __init__(self, sample_rate:int, buffer_que:queue.Queue, stop_event, sample_que = None, stats:StatsBlock = None, tracer:Tracer = None, srt:Srt = None, resume = False, event_bus = None):
         super().__init__()
         self.buffer_que = buffer_que
-        self.srt = Srt(f"Video-Status", sample_rate)
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.tracer = tracer or Tracer(self.stats, "VideoAnalyzer")  # 阶段计时
+        self.srt = srt or Srt(f"Video-Status", sample_rate, sample_que=sample_que, append=resume, event_bus=event_bus)
         self.stop_event = stop_event
+        self.faults = FrameFaultDetector(**CONFIG.get("video_faults", {}))  # 冻结、黑屏、遮挡检测, 每帧都运行
     
     def estimate_mosaic_ratio(self, frame:av.VideoFrame):
         """计算马赛克比例"""
@@ -103,18 +183,20 @@ class VideoAnalyzer(threading.Thread):
         frame_rate = 1 / curr_frame.time_base / pts_interval
         return frame_rate
         
-    def analyze_frames(self, buffer):
-        """分析缓存的帧序列, 计算各项指标并写入SRT文件"""
+    def analyze_frames(self, buffer, arrival_time = None):
+        """分析缓存的帧序列, 计算各项指标并写入SRT文件, arrival_time为最新一帧的线上到达时间"""
         if len(buffer) < 2: return
         duration = buffer[-1].time  -  buffer[0].time
         
         frame_rates = []
         green_ratios = []
         mosaic_ratios = []
+        faults = []
         total_bits = 0
         prev_frame = None
         
         for frame in buffer:
+            faults.append(self.faults.update(frame))
             mosaic_ratios.append(self.estimate_mosaic_ratio(frame))
             green_ratios.append(self.estimate_green_ratio(frame))
             total_bits += self.estimate_bit(frame)
@@ -127,45 +209,85 @@ class VideoAnalyzer(threading.Thread):
         green_ratio = np.mean(green_ratios)
         mosaic_ratio = np.mean(mosaic_ratios)
         frame_rate = np.mean(frame_rates)
+        frozen_ratio, black_ratio, obstructed_ratio, luma_mean, edge_energy = (float(value) for value in np.mean(faults, axis=0))
+        frozen_seconds = self.faults.frozen_seconds()
 
-        report_text = f"Resolution:({frame.width}, {frame.height}), Bitrate: {bitrate_mbps:.2f} mbps, Frame Rate: {frame_rate:.2f} fps, Mosaic Ratio: {mosaic_ratio * 100:.2f} %, Green Ratio: {green_ratio * 100:.2f} %"
-        self.srt.write_srt(report_text, buffer[0].pts, buffer[-1].pts)
+        self.stats.inc("video_frames_analyzed_total", len(buffer))
+        self.stats.set("video_analyzed_pts_seconds", buffer[-1].time)
+        report_text = (f"Resolution:({frame.width}, {frame.height}), Bitrate: {bitrate_mbps:.2f} mbps, Frame Rate: {frame_rate:.2f} fps, Mosaic Ratio: {mosaic_ratio * 100:.2f} %, Green Ratio: {green_ratio * 100:.2f} %, "
+                       f"Frozen: {frozen_ratio * 100:.0f} % ({frozen_seconds:.1f} s), Black: {black_ratio * 100:.0f} %, Obstructed: {obstructed_ratio * 100:.0f} %")
+        metrics = {
+            "bitrate_mbps": bitrate_mbps,
+            "frame_rate_fps": frame_rate,
+            "mosaic_ratio_pct": mosaic_ratio * 100,
+            "green_ratio_pct": green_ratio * 100,
+            "frozen_ratio_pct": frozen_ratio * 100,
+            "frozen_seconds": frozen_seconds,
+            "black_ratio_pct": black_ratio * 100,
+            "obstructed_ratio_pct": obstructed_ratio * 100,
+            "luma_mean": luma_mean,
+            "edge_energy": edge_energy,
+        }
+        write_start = time.perf_counter()
+        self.srt.write_srt(report_text, buffer[0].pts, buffer[-1].pts, metrics, arrival_time)
+        self.tracer.record("video_srt_write", write_start, buffer[0].pts)
         
         
     def run(self):
         while not self.stop_event.is_set() or not self.buffer_que.empty():
             try:
-                buffer = self.buffer_que.get_nowait()
-                self.analyze_frames(buffer)
+                buffer, arrival_time = self.buffer_que.get_nowait()
+                if isinstance(buffer, StreamGap):
+                    self.faults.reset()
+                    self.srt.write_gap(buffer.start_pts, buffer.end_pts)
+                    continue
+                analyze_start = time.perf_counter()
+                self.analyze_frames(buffer, arrival_time)
+                if buffer:
+                    self.tracer.record("analyze_frames", analyze_start, buffer[0].pts)
             except queue.Empty:
                 time.sleep(0.01)
+        self.srt.close()
 
 
 class VideoAnalyProcesser(multiprocessing.Process):
     """处理视频分析流程的多进程类"""
-    def __init__(self, input_que, stream_info_dict, stop_event):
+    def __init__(self, input_que, stream_info, stop_event, sample_que = None, stats:StatsBlock = None, stream_ready = None, resume = False, event_bus = None):
         super().__init__()
         self.input_que = input_que
-        self.stream_info_dict = stream_info_dict
+        self.stream_info = stream_info  # 流信息(StreamChannel或Manager字典)
         self.stop_event = stop_event
+        self.sample_que = sample_que  # 时间序列样本队列
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.stream_ready = stream_ready  # 使用Manager字典时, 流信息写入后设置的事件
+        self.resume = resume  # 被Supervisor重启时为True, 接续已有的结果文件
+        self.event_bus = event_bus  # 事件总线, 指标超过触发阈值时发布事件
        
 
     def run(self):
         """进程运行函数, 监控视频流状态并启动分析线程"""
-        while self.stream_info_dict['status'] == None:
-            time.sleep(0.01)
+        install_profiler("VideoAnalyProcesser")
+        stream_info = wait_for_stream(self.stream_info, self.stream_ready, self.stop_event,
+                                      beat=lambda: self.stats.beat("VideoAnalyProcesser"))
+        if stream_info is None:
+            return
 
-        if self.stream_info_dict['video']:
+        if stream_info['video']:
             buffer_que = queue.Queue()
-            data_handler = DataHandler(self.input_que, buffer_que, self.stop_event)
-            analyzer = VideoAnalyzer(self.stream_info_dict['video_sample_rate'], buffer_que, self.stop_event)
+            tracer = Tracer(self.stats, "VideoAnalyProcesser")
+            data_handler = DataHandler(self.input_que, buffer_que, self.stop_event, tracer)
+            analyzer = VideoAnalyzer(stream_info['video_sample_rate'], buffer_que, self.stop_event, self.sample_que, self.stats, tracer, resume=self.resume, event_bus=self.event_bus)
 
             analyzer.start()
             data_handler.start()
             while not self.stop_event.is_set():
+                # 工作线程都在运行时才发送心跳, 线程异常退出后由Supervisor重启本进程
+                if data_handler.is_alive() and analyzer.is_alive():
+                    self.stats.beat("VideoAnalyProcesser")
                 time.sleep(0.5)
             data_handler.join()
             analyzer.join()
+            tracer.dump()
 
 
 
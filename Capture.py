@@ -0,0 +1,89 @@
+import os
+import json
+import mmap
+import time
+import struct
+from LoadConfig import results_dir
+
+
+MAGIC = b'RCAP'
+VERSION = 1
+HEADER = struct.Struct('<4sBI')  # 魔数, 版本, 元数据(JSON)长度
+RECORD = struct.Struct('<dI')  # 接收时间(秒), 数据长度
+
+
+def capture_dir():
+    """返回抓包文件的默认目录 results/captures, 不存在时创建"""
+    return results_dir('captures')
+
+
+class CaptureWriter:
+    """将中继从服务器收到的原始字节流连同接收时间写入抓包文件
+    文件格式: 头部(魔数, 版本, 元数据长度) + JSON元数据, 之后每次读取一条记录(接收时间, 长度) + 数据
+    记录先缓存在内存中, 超过flush_bytes后一次写入, 不在转发路径上做小块写"""
+    def __init__(self, path, metadata:dict = None, flush_bytes:int = 1 << 20):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path  # 抓包文件路径
+        self.flush_bytes = flush_bytes  # 缓冲区达到该大小时写入文件
+        self.buffer = bytearray()  # 待写入的记录
+        self.records = 0  # 已写入的记录数
+        self.file = open(path, 'wb')
+        meta = json.dumps(dict(metadata or {}, created=time.time())).encode('utf-8')
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(meta)) + meta)
+
+    def write(self, recv_time:float, data:bytes):
+        """追加一次读取的数据"""
+        self.buffer += RECORD.pack(recv_time, len(data))
+        self.buffer += data
+        self.records += 1
+        if len(self.buffer) >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer.clear()
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class CaptureReader:
+    """以内存映射方式读取抓包文件, 按记录顺序返回 (接收时间, 数据)"""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_len = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a capture file (version {VERSION}).")
+        self.metadata = json.loads(self.map[HEADER.size:HEADER.size + meta_len].decode('utf-8'))
+        self.data_offset = HEADER.size + meta_len  # 第一条记录的偏移
+
+    def __iter__(self):
+        offset = self.data_offset
+        size = len(self.map)
+        while offset + RECORD.size <= size:
+            recv_time, length = RECORD.unpack_from(self.map, offset)
+            offset += RECORD.size
+            if offset + length > size:
+                break  # 最后一条记录不完整(如进程被强制结束)
+            yield recv_time, self.map[offset:offset + length]
+            offset += length
+
+    def summary(self):
+        """返回 (记录数, 字节数, 首条接收时间, 末条接收时间)"""
+        count, total, first, last = 0, 0, None, None
+        for recv_time, data in self:
+            count += 1
+            total += len(data)
+            first = recv_time if first is None else first
+            last = recv_time
+        return count, total, first, last
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,160 @@
+import os
+import json
+import math
+import time
+import fnmatch
+from collections import deque
+from typing import NamedTuple
+from Stats import StatsBlock
+from LoadConfig import results_dir
+
+
+class Match(NamedTuple):
+    """满足某个条件的一条报告, 时间为墙上时间轴上的区间"""
+    source: str  # 结果名, 如 'Video-Status'
+    metric: str
+    value: float
+    start: float
+    end: float
+
+
+class Condition:
+    """规则中的一个条件: 结果名匹配source(可用通配符)且指标metric高于above/低于below"""
+    def __init__(self, source, metric, above = None, below = None):
+        self.source = source
+        self.metric = metric
+        self.above = above
+        self.below = below
+
+    def matches(self, metrics:dict):
+        value = metrics.get(self.metric)
+        if value is None or not math.isfinite(value):
+            return False
+        return (self.above is None or value > self.above) and (self.below is None or value < self.below)
+
+
+def nearest(matches, start, end, window):
+    """与 [start, end] 相距不超过window秒的匹配中最近的一个, 没有时返回None"""
+    best, best_distance = None, window
+    for match in matches:
+        distance = max(match.start - end, start - match.end, 0.0)
+        if distance <= best_distance:
+            best, best_distance = match, distance
+    return best
+
+
+class CorrelationRule:
+    """声明式的关联规则, 例如 "马赛克与丢包在3秒内同时出现 -> 网络原因"
+    all中的条件都在window秒内出现时产生事故; none中的条件在事故前后window秒内出现过时不产生(用于区分原因),
+    有none条件时要等时间轴越过事故结束 + window + 允许的迟到时间后才能判定. 同一规则每cooldown秒最多一次"""
+    def __init__(self, name, cause, all, none = (), window = 3.0, cooldown = 10.0, lateness = 5.0, max_matches = 256):
+        self.name = name
+        self.cause = cause  # 原因标签, 如 'network'
+        self.conditions = [Condition(**condition) for condition in all]
+        self.exclusions = [Condition(**condition) for condition in none]
+        self.window = window
+        self.cooldown = cooldown
+        self.lateness = lateness  # 各来源报告的最大迟到时间(秒), 如语音识别比网络分析晚数秒
+        self.horizon = 2 * (window + lateness)  # 匹配保留的时长, 超过后不可能再参与关联
+        # 每个条件最近的匹配, 按时长和个数双重限制, 内存不随运行时间增长
+        self.matches = [deque(maxlen=max_matches) for _ in self.conditions]
+        self.excluded = [deque(maxlen=max_matches) for _ in self.exclusions]
+        self.pending = deque(maxlen=max_matches)  # 等待none条件判定的事故
+        self.last_end = -math.inf  # 上一次事故的结束时间
+
+    def add(self, index, match:Match, excluded = False):
+        """记录一个匹配, 返回因此成立的事故(没有none条件时)"""
+        matches = (self.excluded if excluded else self.matches)[index]
+        matches.append(match)
+        if excluded:
+            return None
+        evidence = [match]
+        for other, others in enumerate(self.matches):
+            if other != index:
+                found = nearest(others, match.start, match.end, self.window)
+                if found is None:
+                    return None
+                evidence.append(found)
+        start = min(item.start for item in evidence)
+        end = max(item.end for item in evidence)
+        if start < self.last_end + self.cooldown:
+            return None
+        self.last_end = end
+        incident = {"rule": self.name, "cause": self.cause, "start": start, "end": end,
+                    "evidence": [item._asdict() for item in evidence]}
+        if self.exclusions:
+            self.pending.append(incident)
+            return None
+        return incident
+
+    def ready(self, watermark):
+        """判定等待中的事故: 时间轴越过判定时间后, none条件都没有出现的事故成立"""
+        incidents = []
+        while self.pending and self.pending[0]["end"] + self.window + self.lateness <= watermark:
+            incident = self.pending.popleft()
+            if all(nearest(matches, incident["start"], incident["end"], self.window) is None for matches in self.excluded):
+                incidents.append(incident)
+        return incidents
+
+    def prune(self, watermark):
+        """丢弃不可能再参与关联的匹配"""
+        for matches in self.matches + self.excluded:
+            while matches and matches[0].end < watermark - self.horizon:
+                matches.popleft()
+
+
+class Correlator:
+    """跨模态关联引擎, 运行在主进程的样本采集线程中
+    各分析器的报告(视频、音频、网络、关键词)按线上到达时间映射到同一条墙上时间轴, 与各自的时间基无关;
+    逐条报告增量地评估config.json中correlation.rules的规则, 把带原因标签的事故写入results/Incidents.jsonl.
+    每条报告只检查结果名匹配的条件, 每个条件只保留有限时长内的匹配, 耗时和内存不随运行时间增长"""
+    def __init__(self, rules:list, lateness:float = 5.0, path:str = None, stats:StatsBlock = None, stream_name = None):
+        self.rules = [CorrelationRule(lateness=lateness, **rule) for rule in rules]
+        self.stats = stats or StatsBlock()
+        self.stream_name = stream_name
+        self.routes = {}  # 结果名 -> [(规则, 条件下标, 是否为none条件, 条件)], 第一次出现时按通配符解析
+        self.watermark = -math.inf  # 时间轴上已经看到的最晚时间
+        self.last_prune = 0.0
+        self.path = path or os.path.join(results_dir(), 'Incidents.jsonl')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 追加写入: 重启(包括崩溃后)不清除之前的事故记录, 与接续写入的结果文件相同
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def route(self, source):
+        routes = self.routes.get(source)
+        if routes is None:
+            routes = self.routes[source] = [
+                (rule, index, excluded, condition)
+                for rule in self.rules
+                for excluded, conditions in ((False, rule.conditions), (True, rule.exclusions))
+                for index, condition in enumerate(conditions)
+                if fnmatch.fnmatch(source, condition.source)]
+        return routes
+
+    def add(self, source, start, end, metrics:dict):
+        """输入一条报告: 结果名, 在墙上时间轴上的区间和数值指标"""
+        self.watermark = max(self.watermark, end)
+        for rule, index, excluded, condition in self.route(source):
+            if condition.matches(metrics):
+                incident = rule.add(index, Match(source, condition.metric, metrics[condition.metric], start, end), excluded)
+                if incident:
+                    self.emit(incident)
+        for rule in self.rules:
+            for incident in rule.ready(self.watermark):
+                self.emit(incident)
+        if self.watermark - self.last_prune > 1.0:
+            self.last_prune = self.watermark
+            for rule in self.rules:
+                rule.prune(self.watermark)
+
+    def emit(self, incident:dict):
+        self.stats.inc("correlation_incidents_total")
+        if self.stream_name:
+            incident = dict(incident, stream=self.stream_name)
+        self.file.write(json.dumps(incident, ensure_ascii=False) + "\n")
+        self.file.flush()
+        print(f"Incident: {incident['rule']} (cause: {incident['cause']}) at "
+              f"{time.strftime('%H:%M:%S', time.localtime(incident['start']))}, {incident['end'] - incident['start']:.1f} s\r\n")
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,81 @@
+import time
+import queue
+import fnmatch
+import multiprocessing
+from typing import NamedTuple
+from LoadConfig import CONFIG
+
+
+class Event(NamedTuple):
+    """分析器触发的事件"""
+    kind: str  # 触发规则名, 如 'mosaic', 'loss', 'keyword'
+    source: str  # 触发的结果名, 如 'Video-Status'
+    time: float  # 事件在墙上时间轴上的时间(time.time()): 有线上到达时间时取到达时间, 否则取报告时间
+    value: float  # 触发时的指标值
+    text: str  # 触发时的报告文本
+
+
+class EventBus:
+    """跨进程的轻量事件总线, 由主进程创建后传给各进程
+    每个订阅者一个multiprocessing.Queue, 发布时放入所有订阅者的队列(不经过manager服务进程);
+    订阅者非阻塞地取出积压的事件. 订阅者处理不过来时丢弃新事件, 不阻塞发布的分析器"""
+    def __init__(self, subscribers = (), maxsize:int = 1000):
+        self.queues = {name: multiprocessing.Queue(maxsize) for name in subscribers}
+
+    def publish(self, event:Event):
+        for que in self.queues.values():
+            try:
+                que.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def poll(self, subscriber):
+        """取出订阅者积压的所有事件, 没有该订阅者时返回空列表"""
+        que = self.queues.get(subscriber)
+        events = []
+        while que is not None:
+            try:
+                events.append(que.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+
+class TriggerRule:
+    """声明式的触发规则: 结果名匹配source(可用通配符)且指标metric超过above时发布事件, 同一规则每cooldown秒最多触发一次"""
+    def __init__(self, name, source, metric, above, cooldown = 5.0):
+        self.name = name
+        self.source = source
+        self.metric = metric
+        self.above = above
+        self.cooldown = cooldown
+        self.last_fired = 0.0
+
+    def check(self, metrics:dict, now:float):
+        """返回触发时的指标值, 未触发时返回None"""
+        value = metrics.get(self.metric)
+        if value is None or value <= self.above or now - self.last_fired < self.cooldown:
+            return None
+        self.last_fired = now
+        return value
+
+
+def load_triggers(source):
+    """读取config.json中适用于该结果名的触发规则"""
+    return [TriggerRule(rule["name"], rule["source"], rule["metric"], rule["above"], rule.get("cooldown", 5.0))
+            for rule in CONFIG.get("triggers", []) if fnmatch.fnmatch(source, rule["source"])]
+
+
+class TriggerPublisher:
+    """由Srt在写入每条报告时调用, 按规则检查报告的数值指标并向事件总线发布事件"""
+    def __init__(self, event_bus:EventBus, source:str):
+        self.event_bus = event_bus
+        self.source = source
+        self.rules = load_triggers(source)
+
+    def check(self, text, metrics:dict, arrival_time = None):
+        now = time.time()
+        for rule in self.rules:
+            value = rule.check(metrics, now)
+            if value is not None:
+                self.event_bus.publish(Event(rule.name, self.source, arrival_time or now, value, text))
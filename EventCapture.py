@@ -0,0 +1,214 @@
+from __future__ import annotations
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque
+from fractions import Fraction
+from typing import NamedTuple
+from Stats import StatsBlock
+from EventBus import EventBus, Event
+from LoadConfig import results_dir
+from LazyImport import lazy_import
+
+av = lazy_import("av")
+
+
+class CapturedPacket(NamedTuple):
+    """环形缓冲区中的一个压缩包"""
+    track: str  # 'video' 或 'audio'
+    data: bytes
+    pts: int
+    dts: int
+    keyframe: bool
+    time_base: Fraction
+    time: float  # 收到该包的墙上时间
+
+
+class PacketRing:
+    """最近若干秒的压缩包, 总字节数和时长都有上限, 超出时丢弃最旧的包"""
+    def __init__(self, max_bytes:int, max_seconds:float):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.packets = deque()
+        self.bytes = 0
+
+    def append(self, packet:CapturedPacket):
+        self.packets.append(packet)
+        self.bytes += len(packet.data)
+        while self.packets and (self.bytes > self.max_bytes or packet.time - self.packets[0].time > self.max_seconds):
+            self.bytes -= len(self.packets.popleft().data)
+
+    def snapshot(self):
+        """从最早的视频关键帧开始的所有包, 没有视频时为全部"""
+        packets = list(self.packets)
+        if any(packet.track == 'video' for packet in packets):
+            start = next((i for i, packet in enumerate(packets) if packet.track == 'video' and packet.keyframe), len(packets))
+            packets = packets[start:]
+        return packets
+
+    def clear(self):
+        self.packets.clear()
+        self.bytes = 0
+
+
+def adts_header(config:bytes, size:int):
+    """按AudioSpecificConfig生成AAC帧的ADTS头(7字节), MPEG-TS中的AAC需要ADTS封装"""
+    object_type = config[0] >> 3
+    frequency_index = ((config[0] & 0x07) << 1) | (config[1] >> 7)
+    channels = (config[1] >> 3) & 0x0F
+    length = size + 7
+    return bytes((0xFF, 0xF1,
+                  ((object_type - 1) << 6) | (frequency_index << 2) | (channels >> 2),
+                  ((channels & 0x03) << 6) | (length >> 11),
+                  (length >> 3) & 0xFF,
+                  ((length & 0x07) << 5) | 0x1F,
+                  0xFC))
+
+
+def add_clip_stream(output, source:dict):
+    """在片段文件中添加一个流: 有源流时以其为模板复制编码参数, 否则(进程内接入)按编码名和参数创建"""
+    if source.get("template") is not None:
+        return output.add_stream(template=source["template"])
+    stream = output.add_stream(source["codec"], rate=source["rate"])
+    if source["type"] == 'video':
+        stream.width = source["width"]
+        stream.height = source["height"]
+        stream.pix_fmt = 'yuv420p'
+    else:
+        stream.layout = source["layout"]
+    return stream
+
+
+class ClipWriter(threading.Thread):
+    """把预录的包和之后的包复制到一个事件片段文件(MPEG-TS, 不重新编码)
+    输出文件和流在构造时(接收线程中, 源流仍然有效)创建, 复用在本线程中进行, 不阻塞接收"""
+    def __init__(self, path, sources:dict, packets:list, log_path):
+        super().__init__()
+        self.path = path
+        self.log_path = log_path  # 事件日志, 每个片段一行
+        self.output = av.open(path, mode='w', format='mpegts')
+        self.streams = {track: add_clip_stream(self.output, source) for track, source in sources.items()}
+        self.headers = {track: source.get("header") for track, source in sources.items()}  # 加在第一个关键帧前的参数集
+        self.adts = {track: source.get("adts") for track, source in sources.items()}  # 需要ADTS封装的AAC流的AudioSpecificConfig
+        self.queue = queue.SimpleQueue()  # 待写入的包, None表示片段结束
+        for packet in packets:
+            self.queue.put(packet)
+        self.events = []  # 片段内的触发事件
+        self.origin = None  # 片段起点(秒), 第一个视频关键帧的时间
+        self.first_time = None  # 第一个包的墙上时间
+        self.last_time = None  # 最后一个包的墙上时间
+
+    def write(self, captured:CapturedPacket):
+        stream = self.streams.get(captured.track)
+        if stream is None:
+            return
+        if self.origin is None:
+            if 'video' in self.streams and (captured.track != 'video' or not captured.keyframe):
+                return  # 从视频关键帧开始
+            self.origin = float(captured.pts * captured.time_base)
+        offset = int(self.origin / captured.time_base)
+        if captured.pts < offset:
+            return
+        data = captured.data
+        if captured.keyframe and self.headers.get(captured.track):
+            data = self.headers.pop(captured.track) + data
+        if self.adts.get(captured.track):
+            data = adts_header(self.adts[captured.track], len(data)) + data
+        packet = av.Packet(data)
+        packet.pts = captured.pts - offset
+        packet.dts = (captured.dts if captured.dts is not None else captured.pts) - offset
+        packet.time_base = captured.time_base
+        packet.is_keyframe = captured.keyframe
+        packet.stream = stream
+        try:
+            self.output.mux(packet)
+        except av.AVError:
+            return  # 时间戳不单调等, 丢弃该包
+        self.first_time = self.first_time or captured.time
+        self.last_time = captured.time
+
+    def run(self):
+        while True:
+            packet = self.queue.get()
+            if packet is None:
+                break
+            self.write(packet)
+        self.output.close()
+        with open(self.log_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps({"clip": self.path, "start": self.first_time, "end": self.last_time, "events": self.events}, ensure_ascii=False) + "\n")
+
+
+class EventCapture:
+    """触发式事件录制, 运行在流处理器中(唯一能看到压缩包的进程)
+    内存中保留最近pre_seconds秒的压缩包(总字节数不超过max_bytes); 收到事件总线上的触发事件时,
+    把缓冲区中的包连同之后post_seconds秒的包写入results/events下的片段文件. 片段进行中再次触发时延长后录,
+    单个片段不超过max_clip_seconds秒. 连续录制可以关闭或降低质量, 事件前后仍保留完整的原始码流"""
+    def __init__(self,
+                 event_bus:EventBus,
+                 pre_seconds:float = 10.0,
+                 post_seconds:float = 10.0,
+                 max_bytes:int = 64 << 20,
+                 max_clip_seconds:float = 120.0,
+                 dir:str = None,
+                 stats:StatsBlock = None,
+                 poll_interval:float = 0.1):
+        self.event_bus = event_bus
+        self.ring = PacketRing(max_bytes, pre_seconds)
+        self.post_seconds = post_seconds
+        self.max_clip_seconds = max_clip_seconds
+        self.dir = dir or results_dir('events')
+        os.makedirs(self.dir, exist_ok=True)
+        self.stats = stats or StatsBlock()
+        self.poll_interval = poll_interval  # 检查事件总线的间隔(秒)
+        self.sources = {}  # 轨道 -> 片段中流的参数, 见add_clip_stream
+        self.writer = None  # 进行中的片段
+        self.clip_end = 0.0  # 进行中的片段的结束时间
+        self.clip_limit = 0.0  # 进行中的片段最晚的结束时间
+        self.last_poll = 0.0
+
+    def set_sources(self, sources:dict):
+        """(重新)连接后设置各轨道的参数, 之前的片段结束, 缓冲区清空"""
+        self.finish()
+        self.ring.clear()
+        self.sources = sources
+
+    def add(self, track, data:bytes, pts, dts, keyframe:bool, time_base):
+        """加入一个压缩包, 并按间隔检查事件总线"""
+        if pts is None or track not in self.sources:
+            return
+        now = time.time()
+        captured = CapturedPacket(track, data, pts, dts, keyframe, time_base, now)
+        self.ring.append(captured)
+        if self.writer:
+            self.writer.queue.put(captured)
+        if now - self.last_poll >= self.poll_interval:
+            self.last_poll = now
+            for event in self.event_bus.poll('capture'):
+                self.trigger(event, now)
+            if self.writer and now >= self.clip_end:
+                self.finish()
+            self.stats.set("capture_ring_bytes", self.ring.bytes)
+
+    def trigger(self, event:Event, now):
+        """开始新的片段, 或延长进行中的片段"""
+        self.stats.inc("capture_events_total")
+        if self.writer is None:
+            # 带毫秒, 同一秒内结束又触发的片段不会覆盖前一个
+            name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(event.time))}-{int(event.time * 1000) % 1000:03d}-{event.kind}.ts"
+            path = os.path.join(self.dir, name)
+            self.writer = ClipWriter(path, self.sources, self.ring.snapshot(), os.path.join(self.dir, 'events.jsonl'))
+            self.writer.start()
+            self.clip_limit = now + self.max_clip_seconds
+            print(f"Event '{event.kind}' from {event.source}, capturing {name}\r\n")
+        self.writer.events.append(event._asdict())
+        self.clip_end = min(max(self.clip_end, now + self.post_seconds), self.clip_limit)
+
+    def finish(self):
+        """结束进行中的片段, 由写入线程完成剩余的复用"""
+        if self.writer is None:
+            return
+        self.writer.queue.put(None)
+        self.writer = None
+        self.stats.inc("capture_clips_total")
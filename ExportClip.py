@@ -0,0 +1,267 @@
+import io
+import os
+import math
+import time
+import argparse
+import av
+from TSFileHandler import TS_PACKET_SIZE, KeyframeIndex
+
+
+PROBE_OPTIONS = {"probesize": "1000000", "analyzeduration": "1000000"}  # 片段从关键帧开始, 不需要长时间探测
+TABLE_SCAN_PACKETS = 32  # 在段首查找节目表的TS包数
+
+
+class SegmentReader(io.RawIOBase):
+    """把录制文件中的 [start, end) 作为独立的文件交给PyAV读取, 前面加上该段的节目表(PAT/PMT),
+    使解复用器从任意关键帧处开始即可识别各个流"""
+    def __init__(self, file, tables:bytes, start:int, end:int):
+        self.file = file
+        self.head = tables
+        self.start = start
+        self.end = end
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def size(self):
+        return len(self.head) + self.end - self.start
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size()}[whence]
+        self.position = max(0, min(base + offset, self.size()))
+        return self.position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        count = 0
+        if self.position < len(self.head):
+            chunk = self.head[self.position:self.position + len(view)]
+            view[:len(chunk)] = chunk
+            count = len(chunk)
+        file_position = self.start + self.position + count - len(self.head)
+        if count < len(view) and file_position < self.end:
+            self.file.seek(file_position)
+            count += self.file.readinto(view[count:count + min(len(view) - count, self.end - file_position)]) or 0
+        self.position += count
+        return count
+
+
+def index_path(path):
+    """录制文件的关键帧索引路径"""
+    return path + '.idx'
+
+
+class IndexReader:
+    """按需读取定长记录的关键帧索引(格式见TSFileHandler.KeyframeIndex), 只读取二分查找经过的记录
+    关键帧的秒数和墙上时间按写入顺序不减(重启后追加的段接续原来的时间轴), 段起始偏移也按顺序递增"""
+    def __init__(self, path, file_size):
+        self.file = open(index_path(path), 'rb')
+        header = self.file.read(KeyframeIndex.HEADER.size)
+        if header != KeyframeIndex.HEADER.pack(KeyframeIndex.MAGIC, KeyframeIndex.VERSION):
+            self.file.close()
+            raise ValueError(f"Unsupported keyframe index: {index_path(path)}")
+        # 录制中断时最后一条记录可能不完整, 不计入
+        self.count = (os.path.getsize(index_path(path)) - KeyframeIndex.HEADER.size) // KeyframeIndex.RECORD.size
+        self.file_size = file_size  # 录制文件的长度, 最后一段的结束偏移
+
+    def record(self, i):
+        """第i条记录: (段起始偏移, pts, 字节偏移, 秒数, 墙上时间)"""
+        self.file.seek(KeyframeIndex.HEADER.size + i * KeyframeIndex.RECORD.size)
+        return KeyframeIndex.RECORD.unpack(self.file.read(KeyframeIndex.RECORD.size))
+
+    def entry(self, i, key):
+        """第i条记录是关键帧且key("seconds"或"time")已知时返回关键帧, 否则(段记录或墙上时间未知)返回None"""
+        segment, pts, offset, seconds, wall_time = self.record(i)
+        entry = {"segment": segment, "pts": pts, "offset": offset, "seconds": seconds,
+                 "time": None if math.isnan(wall_time) else wall_time}
+        return entry if pts != KeyframeIndex.SEGMENT and entry[key] is not None else None
+
+    def next_entry(self, i, key, stop = None):
+        """从第i条开始第一个可用的关键帧, 返回 (下标, 关键帧), 到stop为止没有时返回 (stop, None)"""
+        stop = self.count if stop is None else stop
+        while i < stop:
+            entry = self.entry(i, key)
+            if entry is not None:
+                return i, entry
+            i += 1
+        return stop, None
+
+    def bisect(self, value, key):
+        """key不大于value的关键帧的个数对应的位置: 返回第一个key大于value的可用记录的下标(没有时为count)
+        段记录和墙上时间未知的记录会被跳过, 它们很少且不连成长串"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            i, entry = self.next_entry(middle, key, high)
+            if entry is None:
+                high = middle
+            elif entry[key] <= value:
+                low = i + 1
+            else:
+                high = middle
+        return low
+
+    def bisect_segment(self, segment):
+        """第一条段起始偏移大于segment的记录的下标"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] <= segment:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_keyframe(self, start, end, key):
+        """找到不晚于start的最后一个关键帧; start早于录制开始时取范围内的第一个关键帧
+        Returns:
+            tuple: (段 {"start", "end", "first_seconds"}, 关键帧 {pts, seconds, offset, time})
+        """
+        position = self.bisect(start, key)
+        entry = None
+        i = position - 1
+        while i >= 0 and entry is None:  # 退回到最后一个可用的关键帧
+            entry = self.entry(i, key)
+            i -= 1
+        if entry is None:
+            _, entry = self.next_entry(position, key)
+            if entry is None or entry[key] >= end:
+                raise ValueError("No recording in the requested range.")
+        return self.segment(entry["segment"]), entry
+
+    def segment(self, start):
+        """起始偏移为start的段: 结束偏移为下一段的起始偏移, first_seconds为段内第一个关键帧的秒数"""
+        following = self.bisect_segment(start)
+        end = self.record(following)[0] if following < self.count else self.file_size
+        first = self.bisect_segment(start - 1)  # 本段的第一条记录
+        _, entry = self.next_entry(first, "seconds", following)
+        return {"start": start, "end": end, "first_seconds": entry["seconds"]}
+
+    def close(self):
+        self.file.close()
+
+
+def ts_payload(packet:bytes):
+    """TS包负载的起始位置"""
+    if packet[3] & 0x20:  # 有适配域
+        return 5 + packet[4]
+    return 4
+
+
+def read_tables(file, segment_start):
+    """取出段首的节目表包: PAT(PID 0)、SDT(PID 0x11)和PAT中列出的PMT"""
+    file.seek(segment_start)
+    data = file.read(TS_PACKET_SIZE * TABLE_SCAN_PACKETS)
+    packets = [data[i:i + TS_PACKET_SIZE] for i in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE)]
+    table_pids = {0x0000, 0x0011}
+    for packet in packets:
+        if packet[0] == 0x47 and ((packet[1] & 0x1F) << 8 | packet[2]) == 0 and packet[1] & 0x40:
+            section = packet[ts_payload(packet) + 1 + packet[ts_payload(packet)]:]
+            length = ((section[1] & 0x0F) << 8) | section[2]
+            for i in range(8, 3 + length - 4, 4):
+                if (section[i] << 8 | section[i + 1]) != 0:  # 节目号0为网络信息表
+                    table_pids.add((section[i + 2] & 0x1F) << 8 | section[i + 3])
+            break
+    tables = {}  # 节目表会周期性重复, 每个PID只取第一个
+    for packet in packets:
+        pid = (packet[1] & 0x1F) << 8 | packet[2]
+        if packet[0] == 0x47 and pid in table_pids:
+            tables.setdefault(pid, packet)
+    return b''.join(tables.values())
+
+
+def first_video_seconds(file, segment):
+    """段内第一个视频包在文件中的时间(秒), 用于换算索引中的编码pts与文件中的时间戳(复用器会加上固定偏移)"""
+    with av.open(SegmentReader(file, b'', segment["start"], segment["end"]), format='mpegts', options=PROBE_OPTIONS) as source:
+        for packet in source.demux(video=0):
+            if packet.pts is not None:
+                return float(packet.pts * packet.time_base)
+    return segment["first_seconds"]
+
+
+def export_clip(path, start, end, output = None, wall = False):
+    """从录制文件中导出一段, 只复制包不重新编码
+    在关键帧索引中二分查找不晚于start的关键帧, 只读取片段所在的字节范围, 耗时与录制文件的长度无关
+    片段跨越重启(索引中的多个段)时截止到起点所在段的末尾
+    Args:
+        path (str): 录制文件, 如results/output_stream.ts
+        start, end (float): 片段的起止时间; 默认为流时间轴上的秒数(与结果文件的时间一致), wall为True时为Unix时间
+        output (str): 输出文件, 格式由扩展名决定, 默认为results/clips/<文件名>-<起点>-<终点>.ts
+    Returns:
+        dict: 导出统计
+    """
+    began = time.perf_counter()
+    key = "time" if wall else "seconds"
+    index = IndexReader(path, os.path.getsize(path))
+    try:
+        segment, entry = index.find_keyframe(start, end, key)
+    finally:
+        index.close()
+    # 换算到流时间轴上的秒数
+    end_seconds = entry["seconds"] + (end - entry["time"]) if wall else end
+    if output is None:
+        dir = os.path.join(os.path.dirname(os.path.abspath(path)), 'clips')
+        os.makedirs(dir, exist_ok=True)
+        output = os.path.join(dir, f"{os.path.splitext(os.path.basename(path))[0]}-{start:.0f}-{end:.0f}.ts")
+
+    packets = 0
+    with open(path, 'rb') as file:
+        tables = read_tables(file, segment["start"])
+        shift = first_video_seconds(file, segment) - segment["first_seconds"]
+        begin = entry["seconds"] + shift  # 起点关键帧在文件中的时间
+        stop = end_seconds + shift
+        reader = SegmentReader(file, tables, entry["offset"], segment["end"])
+        with av.open(reader, format='mpegts', options=PROBE_OPTIONS) as source, av.open(output, mode='w') as target:
+            streams = {stream: target.add_stream(template=stream) for stream in source.streams if stream.type in ('video', 'audio')}
+            started = not any(stream.type == 'video' for stream in streams)  # 从起点关键帧开始复制
+            for packet in source.demux(*streams):
+                if packet.pts is None or packet.dts is None:
+                    continue
+                seconds = float(packet.pts * packet.time_base)
+                if packet.stream.type == 'video':
+                    if not started:
+                        if not packet.is_keyframe or seconds < begin - 0.001:
+                            continue
+                        started = True
+                    if float(packet.dts * packet.time_base) > stop:
+                        break
+                elif not started or seconds < begin or seconds > stop:
+                    continue
+                # 片段的时间戳从0开始
+                offset = int(begin / packet.time_base)
+                packet.pts -= offset
+                packet.dts -= offset
+                packet.stream = streams[packet.stream]
+                target.mux(packet)
+                packets += 1
+    return {
+        "output": output,
+        "packets": packets,
+        "start_seconds": entry["seconds"],
+        "end_seconds": end_seconds,
+        "bytes_read": reader.position,
+        "elapsed_seconds": time.perf_counter() - began,
+    }
+
+
+# 用法: python ExportClip.py results/output_stream.ts 120 140
+#       python ExportClip.py results/output_stream.ts 1714550000 1714550020 --wall -o incident.mp4
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a time range of a recording without re-encoding, using its keyframe index.")
+    parser.add_argument("file", help="recorded file, e.g. results/output_stream.ts")
+    parser.add_argument("start", type=float, help="clip start, in stream seconds (or Unix time with --wall)")
+    parser.add_argument("end", type=float, help="clip end, in stream seconds (or Unix time with --wall)")
+    parser.add_argument("-o", "--output", default=None, help="output file (default: results/clips/<name>-<start>-<end>.ts)")
+    parser.add_argument("--wall", action="store_true", help="start and end are Unix times")
+    args = parser.parse_args()
+
+    result = export_clip(args.file, args.start, args.end, args.output, args.wall)
+    print(f"Exported {result['packets']} packets ({result['start_seconds']:.2f}-{result['end_seconds']:.2f} s) "
+          f"to {result['output']} in {result['elapsed_seconds'] * 1000:.1f} ms, read {result['bytes_read'] / 1048576:.1f} MiB")
@@ -1,8 +1,36 @@
+import os
 import re
+import sys
 import time
 import socket
+import struct
+import platform
+import selectors
 import threading
 import multiprocessing
+from Stats import StatsBlock
+from Latency import ArrivalClock
+from RTP import parse_sender_report
+from Capture import CaptureWriter
+from StreamInfo import publish_tracks
+from Profiler import install_profiler
+
+
+# Linux内核接收时间戳选项(旧版本的socket模块未导出, SO_和SCM_的取值相同)
+# 35只是x86上的取值(其他架构如mips、sparc、parisc不同), 其他平台没有导出时不使用内核时间戳
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35 if sys.platform.startswith('linux')
+                         and platform.machine() in ('x86_64', 'i386', 'i686', 'AMD64') else None)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct('@ll')  # struct timespec: 秒(time_t), 纳秒(long), 32位平台上均为4字节
+
+
+def kernel_receive_time(ancdata):
+    """从recvmsg的辅助数据中取出内核接收时间戳(秒), 没有时返回None"""
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS and len(cmsg_data) >= TIMESPEC.size:
+            seconds, nanoseconds = TIMESPEC.unpack_from(cmsg_data)
+            return seconds + nanoseconds / 1e9
+    return None
 
 
 class TCPPacketForwarder(threading.Thread):
@@ -13,17 +41,33 @@ class TCPPacketForwarder(threading.Thread):
         self.dst_sock = dst_sock  # 目标socket
         self.buffer = b''  # 数据缓冲
         self.stop_event = stop_event  # 停止事件
+        self.stats = None  # 共享内存统计块, 仅服务器端转发器统计
+        self.recv_time = None  # 最近一次接收数据的时间
+        self.prev_recv_time = None  # 上一次接收数据的时间
+        self.recv_len = 0  # 最近一次接收的数据长度
   
     def data_handler(self, data):
         """数据处理方法, 基础实现仅将接收的数据放入缓冲区"""
         self.buffer = data
     
+    def receive(self):
+        """从源socket接收数据, 并记录接收时间"""
+        data = self.src_sock.recv(4096)
+        self.prev_recv_time = self.recv_time
+        self.recv_time = time.time()
+        self.recv_len = len(data)
+        return data
+
     def run(self):
         """不断从源socket接收数据并转发到目标socket, 直至收到停止信号"""
         self.src_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         while not self.stop_event.is_set():
             try:
-                data = self.src_sock.recv(4096)
+                data = self.receive()
+                if not data:
+                    break  # 对端已关闭连接
+                if self.stats:
+                    self.stats.inc("relay_bytes_total", len(data))
                 self.data_handler(data)
                 self.dst_sock.sendall(self.buffer)
                 self.buffer = b''
@@ -36,6 +80,184 @@ class TCPPacketForwarder(threading.Thread):
         self.src_sock.close()
         self.dst_sock.close()
     
+class RelayPort:
+    """中继的一个UDP端口(RTP或RTCP), 服务器发来的数据报转发给客户端, 客户端发来的(RTCP接收报告、打洞包)转发给服务器"""
+    def __init__(self, sock:socket.socket, track_id:int, is_rtp:bool, client_addr):
+        self.sock = sock
+        self.track_id = track_id  # 轨道号
+        self.is_rtp = is_rtp  # RTP端口为True, RTCP端口为False
+        self.client_addr = client_addr  # 客户端的接收地址
+        self.server_addr = None  # 服务器的发送地址, SETUP响应后设置
+        self.track_type = None  # 'video' 或 'audio'
+
+
+class UDPRelay(threading.Thread):
+    """UDP传输的数据报中继线程, 一个RTSP连接一个
+    每个轨道绑定一对相邻的端口(RTP偶数, RTCP奇数), 所有端口注册到同一个selector
+    端口可读时批量读取(类似recvmmsg): 每次最多读batch_size个数据报到预分配的缓冲区后原样转发,
+    RTP头部连同内核接收时间戳汇总成一个列表, 每轮只向NetAnalyProcesser的队列放入一次"""
+    def __init__(self, stop_event, rtp_queue = None, stats:StatsBlock = None, arrival_clock:ArrivalClock = None, batch_size = 64):
+        super().__init__(daemon=True)
+        self.stop_event = stop_event
+        self.rtp_queue = rtp_queue  # RTP头部队列, 为None时不截取
+        self.stats = stats
+        self.arrival_clock = arrival_clock
+        self.batch_size = batch_size  # 每个端口每轮最多读取的数据报数
+        self.selector = selectors.DefaultSelector()
+        self.ports = {}  # 轨道号 -> (RTP端口, RTCP端口)
+        self.buffer = bytearray(65536)  # 接收缓冲区, 所有数据报复用
+        self.view = memoryview(self.buffer)
+        self.kernel_timestamps = SO_TIMESTAMPNS is not None and sys.platform.startswith('linux') and hasattr(socket.socket, 'recvmsg_into')
+        self.closed = threading.Event()
+
+    def bind_pair(self, max_tries = 20):
+        """绑定一对相邻端口, RTP端口为偶数"""
+        for _ in range(max_tries):
+            rtp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            rtp_sock.bind(('', 0))
+            port = rtp_sock.getsockname()[1]
+            if port % 2 == 0:
+                rtcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                try:
+                    rtcp_sock.bind(('', port + 1))
+                    return rtp_sock, rtcp_sock
+                except OSError:
+                    rtcp_sock.close()
+            rtp_sock.close()
+        raise OSError("Could not bind an RTP/RTCP port pair.")
+
+    def add_track(self, track_id, client_host, client_ports):
+        """为轨道绑定中继端口对并开始接收, 返回 (RTP端口, RTCP端口)"""
+        socks = self.bind_pair()
+        for sock, client_port, is_rtp in zip(socks, client_ports, (True, False)):
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 21)  # 突发到达时不在内核中丢包
+            if self.kernel_timestamps:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.selector.register(sock, selectors.EVENT_READ, RelayPort(sock, track_id, is_rtp, (client_host, client_port)))
+        self.ports[track_id] = tuple(sock.getsockname()[1] for sock in socks)
+        if self.ident is None:
+            self.start()
+        return self.ports[track_id]
+
+    def connect_track(self, track_id, server_host, server_ports, track_type):
+        """SETUP响应后记录服务器的端口, 之后来自客户端的数据报转发到这里"""
+        for key in list(self.selector.get_map().values()):
+            port:RelayPort = key.data
+            if port.track_id == track_id:
+                port.server_addr = (server_host, server_ports[0] if port.is_rtp else server_ports[1])
+                port.track_type = track_type
+
+    def drain(self, port:RelayPort, taps:list):
+        """读取并转发一个端口上已到达的数据报, 最多batch_size个"""
+        for _ in range(self.batch_size):
+            try:
+                if self.kernel_timestamps:
+                    length, ancdata, _, addr = port.sock.recvmsg_into([self.buffer], socket.CMSG_SPACE(TIMESPEC.size))
+                    arrival_time = kernel_receive_time(ancdata) or time.time()
+                else:
+                    length, addr = port.sock.recvfrom_into(self.buffer)
+                    arrival_time = time.time()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return  # ICMP端口不可达等错误, 丢弃
+            datagram = self.view[:length]
+            # 只转发客户端和服务器之间的数据报: 其他来源的数据报(伪造的RTP、扫描)既不转发也不计入分析
+            if addr == port.client_addr:
+                to_server, destination = True, port.server_addr
+            elif port.server_addr is not None and addr[0] == port.server_addr[0]:
+                to_server, destination = False, port.client_addr  # 服务器可能从与SETUP响应不同的端口发送
+            else:
+                continue
+            if destination is not None:
+                try:
+                    port.sock.sendto(datagram, destination)
+                except OSError:
+                    pass
+            if to_server or length < 12:
+                continue
+            if not port.is_rtp:
+                # RTCP: 截取发送者报告(SR)的前20字节, 用于音画同步分析和到达时间映射
+                if length >= 20 and datagram[1] == 200:
+                    if self.rtp_queue is not None:
+                        taps.append((bytes(datagram[:20]), arrival_time))
+                    report = parse_sender_report(datagram[:20])
+                    if self.arrival_clock and port.track_type and report:
+                        self.arrival_clock.sender_report(port.track_type, report[1], report[2])
+                continue
+            if self.stats:
+                # UDP中继线程是这两个计数器的第1个写入者(见Stats.WRITERS)
+                self.stats.inc("relay_rtp_packets_total", writer=1)
+                self.stats.inc("relay_bytes_total", length, writer=1)
+            if self.rtp_queue is not None:
+                taps.append((bytes(datagram[:12]), arrival_time))
+            if self.arrival_clock and port.track_type:
+                self.arrival_clock.stamp(port.track_type, int.from_bytes(datagram[4:8], 'big'), arrival_time)
+
+    def run(self):
+        while not self.stop_event.is_set() and not self.closed.is_set():
+            taps = []
+            for key, _ in self.selector.select(0.5):
+                self.drain(key.data, taps)
+            if taps:
+                self.rtp_queue.put(taps)
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def close(self):
+        self.closed.set()
+
+
+class UDPSession:
+    """一个RTSP连接的UDP传输状态, 由客户端和服务器端处理器共享
+    SETUP请求中client_port改写为中继的端口对; 响应中的client_port改回客户端的端口, server_port改为中继的端口对,
+    客户端和服务器都只与中继交换数据报. TCP交织传输的SETUP不含client_port, 不做改写"""
+    def __init__(self, server_host, client_host, relay:UDPRelay):
+        self.server_host = server_host
+        self.client_host = client_host
+        self.relay = relay
+        self.pending = {}  # CSeq -> (轨道号, 客户端端口对)
+
+    def rewrite_setup(self, data:bytes):
+        """改写客户端的SETUP请求"""
+        try:
+            request = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return data
+        ports = re.search(r"client_port=([0-9]+)-([0-9]+)", request)
+        if not ports:
+            return data
+        cseq = re.search(r"CSeq: *([0-9]+)", request)
+        if not cseq:
+            return data  # 没有CSeq时无法与响应对应, 原样转发, 由服务器回应错误
+        cseq = cseq.group(1)
+        track = re.search(r"trackID=([0-9]+)", request.split("\r\n", 1)[0])
+        track_id = int(track.group(1)) if track else len(self.relay.ports)
+        client_ports = (int(ports.group(1)), int(ports.group(2)))
+        relay_ports = self.relay.add_track(track_id, self.client_host, client_ports)
+        self.pending[cseq] = (track_id, client_ports)
+        return request.replace(ports.group(0), f"client_port={relay_ports[0]}-{relay_ports[1]}").encode('utf-8')
+
+    def rewrite_setup_response(self, response:str, track_types):
+        """改写服务器的SETUP响应, 返回 (轨道号, 改写后的响应); 不是本会话的UDP SETUP时返回 (None, response)"""
+        cseq = re.search(r"CSeq: *([0-9]+)", response)
+        server_ports = re.search(r"server_port=([0-9]+)-([0-9]+)", response)
+        if not cseq or not server_ports or cseq.group(1) not in self.pending:
+            return None, response
+        track_id, client_ports = self.pending.pop(cseq.group(1))
+        relay_ports = self.relay.ports[track_id]
+        self.relay.connect_track(track_id, self.server_host, (int(server_ports.group(1)), int(server_ports.group(2))),
+                                 track_types[track_id].get("type") if track_id < len(track_types) else None)
+        response = re.sub(r"client_port=[0-9]+-[0-9]+", f"client_port={client_ports[0]}-{client_ports[1]}", response)
+        response = response.replace(server_ports.group(0), f"server_port={relay_ports[0]}-{relay_ports[1]}")
+        return track_id, response
+
+    def close(self):
+        self.relay.close()
+
+
 class ServerPacketHandler(TCPPacketForwarder):
     """服务器端包处理器, 扩展自TCP包转发器, 用于解析RTSP协议信息"""
     def __init__(self, 
@@ -43,18 +265,76 @@ class ServerPacketHandler(TCPPacketForwarder):
                 dst_sock: socket.socket, 
                 stop_event, 
                 rtp_queue:multiprocessing.Queue, 
-                pipeline):
+                pipeline,
+                stats:StatsBlock = None,
+                arrival_clock:ArrivalClock = None,
+                capture:CaptureWriter = None,
+                session:UDPSession = None):
         super().__init__(src_sock, dst_sock, stop_event)
         self.init_info = [{}, {}]  # 初始化信息存储
         self.rtp_queue = rtp_queue  # RTP数据队列
-        self.pipeline = pipeline  # 管道用于发送初始化信息
+        self.pipeline = pipeline  # 各轨道初始化信息的广播通道(旧的入口脚本为管道)
+        self.stats = stats  # 共享内存统计块
+        self.arrival_clock = arrival_clock  # RTP时间戳 -> 到达时间映射
+        self.kernel_timestamps = False  # 是否使用内核接收时间戳
+        self.max_interpolation = 0.02  # 一次读取内的包到达时间插值的最大跨度(秒)
+        self.capture = capture  # 抓包文件写入器, 为None时不抓包
+        self.session = session  # UDP传输的中继会话, 为None时只支持TCP交织传输
+
+    def enable_kernel_timestamps(self):
+        """请求内核为接收的数据打上时间戳(仅Linux), 失败时退回用户态时间"""
+        if SO_TIMESTAMPNS is None or not sys.platform.startswith('linux'):
+            return False
+        try:
+            self.src_sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.kernel_timestamps = True
+        except OSError as e:
+            print(f"Kernel receive timestamps unavailable: {e}")
+        return self.kernel_timestamps
+
+    def receive(self):
+        """接收数据, 启用内核时间戳时通过recvmsg读取数据到达网卡协议栈的时间, 开启抓包时同时写入抓包文件"""
+        if not self.kernel_timestamps:
+            data = super().receive()
+        else:
+            data, ancdata, _, _ = self.src_sock.recvmsg(4096, socket.CMSG_SPACE(TIMESPEC.size))
+            recv_time = kernel_receive_time(ancdata)
+            self.prev_recv_time = self.recv_time
+            self.recv_time = recv_time if recv_time is not None else time.time()
+            self.recv_len = len(data)
+        if self.capture and data:
+            self.capture.write(self.recv_time, data)
+        return data
+
+    def cleanup(self):
+        """关闭socket连接和抓包文件"""
+        super().cleanup()
+        if self.capture:
+            self.capture.close()
+        if self.session:
+            self.session.close()
+
+    def packet_arrival_time(self, end_offset):
+        """估计一次读取中某个包的到达时间
+        TCP一次读取可能包含多个RTP包, 内核时间戳对应最后到达的数据段,
+        之前的包按其结束位置在上次与本次接收时间之间线性插值"""
+        if self.prev_recv_time is None or self.recv_len == 0:
+            return self.recv_time
+        span = min(self.recv_time - self.prev_recv_time, self.max_interpolation)
+        return self.recv_time - span * (1 - min(end_offset, self.recv_len) / self.recv_len)
+
+    def run(self):
+        """启用内核时间戳后开始转发"""
+        self.enable_kernel_timestamps()
+        super().run()
     
     def rtsp_packet_handler(self, packet:str):
-        """RTSP数据包处理方法, 解析RTSP响应及其内容"""
+        """RTSP数据包处理方法, 解析RTSP响应及其内容, 返回转发给客户端的响应(UDP传输的SETUP响应会被改写)"""
         if packet.startswith("RTSP/1.0"):
             status_code = re.search(r"RTSP/1.0 ([0-9]+) (.*)\r\n", packet).group(1)
             if status_code != '200':
-                self.stop_event.set()
+                # 不停止整个流水线: 错误响应照常转发给客户端, 打开失败后由RTSPStreamHandler退避重连
+                print(f"RTSP server responded {status_code}.\r\n")
                 
             elif "Content-Type: application/sdp" in packet:
                 sdp = packet.split("\r\n\r\n")[1]
@@ -62,20 +342,28 @@ class ServerPacketHandler(TCPPacketForwarder):
                 for track in tracks:
                     track_type = re.search(r"([a-zA-Z]+) (.*)",track).group(1)
                     track_id = int(re.search(r"trackID=([0-9])\r\n",track).group(1))
-                    sample_rate = int(re.search(r"a=rtpmap:([0-9]+) ([a-zA-Z0-9]+)/([0-9]+)\r\n", track).group(3))
+                    sample_rate = int(re.search(r"a=rtpmap:([0-9]+) ([a-zA-Z0-9\-]+)/([0-9]+)(/[0-9]+)?\r\n", track).group(3))
                     self.init_info[track_id]["type"] = track_type
                     self.init_info[track_id]["track_id"] = track_id
                     self.init_info[track_id]["sample_rate"] = sample_rate
             
             elif "Transport" in packet:
                 trans_info = re.search(r"Transport: (.*)\r\n", packet).group(1)
-                track_id = int(re.search(r"interleaved=([0-9])-([0-9])",trans_info).group(1))//2
+                if "interleaved=" in trans_info:
+                    track_id = int(re.search(r"interleaved=([0-9])-([0-9])",trans_info).group(1))//2
+                elif self.session is not None:
+                    track_id, packet = self.session.rewrite_setup_response(packet, self.init_info)
+                    if track_id is None:
+                        return packet
+                else:
+                    return packet
                 ssrc = int(re.search(r"ssrc=([0-9a-zA-Z]+)",trans_info).group(1), 16)
                 self.init_info[track_id]["ssrc"] = ssrc
                 
             elif "RTP-Info" in packet:
                 rtp_info = re.search(r"RTP-Info: (.*)\r\n", packet).group(1)
                 tracks = rtp_info.split('url=')[1:]
+                playing = []
                 for track in tracks:
                     items = track.split(";")
                     track_id = int(re.search(r"trackID=([0-9])",items[0]).group(1))
@@ -83,8 +371,18 @@ class ServerPacketHandler(TCPPacketForwarder):
                     rtptime = int(re.search(r"rtptime=([0-9]+)", items[2]).group(1))
                     self.init_info[track_id]["init_seq"] = seq
                     self.init_info[track_id]["init_timestamp"] = rtptime
-                    self.pipeline.send(self.init_info[track_id])
-                self.pipeline.send('start')          
+                    playing.append(dict(self.init_info[track_id]))
+                if self.pipeline is not None:  # 未启用网络分析时没有接收端
+                    publish_tracks(self.pipeline, playing)
+                if self.arrival_clock:
+                    # 与FFmpeg的rtpdec相同: pts以RTP-Info中的rtptime为起点, 加上Range的起点
+                    start = re.search(r"Range: npt=([0-9.]+)-", packet)
+                    self.arrival_clock.reset(sum(1 for info in self.init_info if info.get("type")))
+                    for info in playing:
+                        if info.get("type") in ('video', 'audio') and info.get("sample_rate"):
+                            self.arrival_clock.configure(info["type"], info["sample_rate"], info["init_timestamp"],
+                                                         float(start.group(1)) if start else 0.0)
+        return packet
 
     def data_handler(self, data:bytes):
         """数据处理方法, 根据数据类型进行不同的处理逻辑"""
@@ -96,21 +394,48 @@ class ServerPacketHandler(TCPPacketForwarder):
             channel = rtsp_interleaved_head[1]
             length = rtsp_interleaved_head[2] * 256 + rtsp_interleaved_head[3]
             if channel == 0x00 or channel == 0x02:
-                self.rtp_queue.put(data[4:16])
+                arrival_time = self.packet_arrival_time(self.recv_len - len(data) + 4 + length)
+                if self.rtp_queue is not None:  # 未启用网络分析时不传递RTP头部
+                    self.rtp_queue.put((data[4:16], arrival_time))
+                track_type = self.init_info[channel // 2].get("type")
+                if self.arrival_clock and track_type and len(data) >= 12:
+                    self.arrival_clock.stamp(track_type, int.from_bytes(data[8:12], 'big'), arrival_time)
+                if self.stats:
+                    self.stats.inc("relay_rtp_packets_total")
+                self.buffer += data[:(4+length)]
+                self.data_handler(data[(4+length):])
+                return
+            if channel == 0x01 or channel == 0x03:
+                # RTCP: 截取发送者报告(SR)的前20字节, 用于音画同步分析和到达时间映射
+                if len(data) >= 24 and data[5] == 200:
+                    if self.rtp_queue is not None:
+                        self.rtp_queue.put((data[4:24], self.packet_arrival_time(self.recv_len - len(data) + 4 + length)))
+                    track_type = self.init_info[channel // 2].get("type")
+                    report = parse_sender_report(data[4:24])
+                    if self.arrival_clock and track_type and report:
+                        self.arrival_clock.sender_report(track_type, report[1], report[2])
                 self.buffer += data[:(4+length)]
                 self.data_handler(data[(4+length):])
                 return
         try:
             decoded_data = data.decode('utf-8')
-            self.rtsp_packet_handler(decoded_data)
+            packet = self.rtsp_packet_handler(decoded_data)
+            if packet is not None and packet != decoded_data:
+                data = packet.encode('utf-8')
         except Exception:
             pass
         self.buffer = data
         
 class ClientPacketHandler(TCPPacketForwarder):
-    """客户端包处理器, 继承自TCP包转发器"""
-    def __init__(self, src_sock: socket.socket, dst_sock: socket.socket, stop_event: threading.Event):
+    """客户端包处理器, 继承自TCP包转发器, UDP传输时改写SETUP请求中的客户端端口"""
+    def __init__(self, src_sock: socket.socket, dst_sock: socket.socket, stop_event: threading.Event, session:UDPSession = None):
         super().__init__(src_sock, dst_sock, stop_event)
+        self.session = session  # UDP传输的中继会话
+
+    def data_handler(self, data):
+        if self.session is not None and data.startswith(b"SETUP "):
+            data = self.session.rewrite_setup(data)
+        self.buffer = data
 
 class RTSPForwarder(multiprocessing.Process):
     """RTSP转发器进程, 负责通过中继转发器建立RTSP客户端和服务器之间的通信"""
@@ -119,13 +444,19 @@ class RTSPForwarder(multiprocessing.Process):
                 server_host:str, 
                 server_port:int, 
                 pipeline,
-                stop_event):
+                stop_event,
+                stats:StatsBlock = None,
+                arrival_clock:ArrivalClock = None,
+                capture_dir:str = None):
         super().__init__()
         self.pipeline = pipeline
+        self.stats = stats
+        self.arrival_clock = arrival_clock
         self.server_addr = (server_host, server_port)
         self.rtp_queue = rtp_queue
         self.stop_event = stop_event
         self.serve_list = []
+        self.capture_dir = capture_dir  # 抓包文件目录, 为None时不抓包
         
     
         
@@ -136,6 +467,7 @@ class RTSPForwarder(multiprocessing.Process):
         while retries < max_retries:
             try:
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 被Supervisor重启后可立即重新监听
                 self.sock.bind(('127.0.0.1', 12024))
                 self.sock.listen(5)
                 self.sock.settimeout(1)
@@ -149,20 +481,43 @@ class RTSPForwarder(multiprocessing.Process):
             self.stop_event.set()
             return
              
+    def open_capture(self):
+        """为新的服务器连接创建抓包文件, 每个连接一个文件"""
+        if not self.capture_dir:
+            return None
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{len(self.serve_list) // 2}.rcap"
+        return CaptureWriter(os.path.join(self.capture_dir, name),
+                             {"server_host": self.server_addr[0], "server_port": self.server_addr[1]})
+
     def run(self):
         """进程主函数, 接受客户端连接并启动前后转发器线程"""
+        install_profiler("RTSPForwarder")
         self.create_socket()
         while not self.stop_event.is_set():
+            if self.stats:
+                self.stats.beat("RTSPForwarder")
             try:
                 client_sock, client_addr = self.sock.accept()
                 server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_sock.connect(self.server_addr)
-                forwarder_c2s = ClientPacketHandler(client_sock, server_sock, self.stop_event)
+                try:
+                    server_sock.settimeout(5)
+                    server_sock.connect(self.server_addr)
+                    server_sock.settimeout(None)
+                except socket.error as e:
+                    # 服务器暂时不可达(如设备重启): 关闭客户端连接, 由RTSPStreamHandler退避重连
+                    print(f"Could not connect to the RTSP server: {e}\r\n")
+                    server_sock.close()
+                    client_sock.close()
+                    continue
+                # UDP传输时数据报经本连接的中继端口转发, TCP交织传输时中继线程不启动
+                session = UDPSession(self.server_addr[0], client_addr[0],
+                                     UDPRelay(self.stop_event, self.rtp_queue, self.stats, self.arrival_clock))
+                forwarder_c2s = ClientPacketHandler(client_sock, server_sock, self.stop_event, session)
                 self.serve_list.append(forwarder_c2s)
                 forwarder_c2s.start()
                 
 
-                forwarder_s2c = ServerPacketHandler(server_sock, client_sock, self.stop_event, self.rtp_queue, self.pipeline)
+                forwarder_s2c = ServerPacketHandler(server_sock, client_sock, self.stop_event, self.rtp_queue, self.pipeline, self.stats, self.arrival_clock, self.open_capture(), session)
                 self.serve_list.append(forwarder_s2c)
                 forwarder_s2c.start()
                 
@@ -0,0 +1,132 @@
+import multiprocessing
+
+
+TRACK_TYPES = ('video', 'audio')  # 轨道类型 -> 在共享内存中的下标
+MAX_TIMESTAMP = 4294967296  # RTP时间戳的最大值
+
+
+def timestamp_delta(timestamp, reference):
+    """两个RTP时间戳的有符号差值 timestamp - reference, 处理回绕"""
+    return (timestamp - reference + MAX_TIMESTAMP // 2) % MAX_TIMESTAMP - MAX_TIMESTAMP // 2
+
+
+class ArrivalClock:
+    """共享内存中的 RTP时间戳 -> 线上到达时间 映射, 由中继写入, 由解码进程读取
+    每个轨道一段: [写入位置, 起始RTP时间戳, 是否已有起始时间戳, 时钟频率, Range起点(时钟单位),
+                 是否收到SR, 最近SR的NTP时间, 最近SR的RTP时间戳, 是否已有首个SR的NTP时间, 首个SR的NTP时间, SR时间戳偏移,
+                 收到第一个SR时的写入位置, 环形缓冲区(时间戳, 到达时间)...]
+    查找时按FFmpeg的rtpdec(finalize_packet)由帧pts反推RTP时间戳:
+    收到SR前 pts = RTP时间戳 - 起始RTP时间戳 + Range起点, 起始时间戳为RTP-Info中的rtptime, 没有时为第一个RTP包的时间戳;
+    多个流且本轨道收到SR后, pts改为按发送端的NTP时间对齐各轨道(rtpdec以此做音画同步), 见sender_report.
+    中继与FFmpeg按相同的顺序处理RTP包和SR, 在本轨道第一个SR之后写入的时间戳按SR对齐查找"""
+    HEADER = 12
+
+    def __init__(self, capacity:int = 1024):
+        self.capacity = capacity  # 每个轨道保留的最近RTP时间戳数量
+        self.track_size = self.HEADER + capacity * 2
+        self.array = multiprocessing.RawArray('d', len(TRACK_TYPES) * self.track_size)
+        self.streams = multiprocessing.RawValue('i', 0)  # 会话中的流数量, 只有一个流时rtpdec不按SR对齐
+
+    def reset(self, streams:int = 0):
+        """新的RTSP会话开始时清空映射, streams为SDP中的流数量(进程内接入自行生成pts, 为0)"""
+        for i in range(len(self.array)):
+            self.array[i] = 0
+        self.streams.value = streams
+
+    def configure(self, track_type, clock_rate, base_timestamp = None, range_start:float = 0.0):
+        """PLAY响应到达时设置轨道的时钟频率, RTP-Info中的rtptime和Range的起点(秒)"""
+        base = TRACK_TYPES.index(track_type) * self.track_size
+        self.array[base + 3] = clock_rate
+        self.array[base + 4] = round(range_start * clock_rate)
+        if base_timestamp:  # rtpdec忽略为0的rtptime
+            self.array[base + 1] = base_timestamp
+            self.array[base + 2] = 1
+
+    def sender_report(self, track_type, ntp, rtp_timestamp):
+        """记录RTCP发送者报告, 与rtpdec相同: 会话中第一个SR的NTP时间作为所有轨道的共同起点,
+        该SR的RTP时间戳相对起始时间戳的偏移换算到其他轨道的时钟, 之后各轨道的pts = 偏移 + 自共同起点的NTP时长 + 自最近SR的时间戳差"""
+        array = self.array
+        base = TRACK_TYPES.index(track_type) * self.track_size
+        if not array[base + 8]:
+            array[base + 8] = 1
+            array[base + 9] = ntp
+            if not array[base + 2]:
+                array[base + 1] = rtp_timestamp
+                array[base + 2] = 1
+            array[base + 10] = timestamp_delta(rtp_timestamp, int(array[base + 1]))
+            for other in range(len(TRACK_TYPES)):
+                start = other * self.track_size
+                if start != base and not array[start + 8] and array[start + 3] and array[base + 3]:
+                    array[start + 8] = 1
+                    array[start + 9] = ntp
+                    array[start + 10] = round(array[base + 10] * array[start + 3] / array[base + 3])
+        if not array[base + 5]:
+            array[base + 11] = array[base]
+        array[base + 6] = ntp
+        array[base + 7] = rtp_timestamp
+        array[base + 5] = 1
+
+    def targets(self, base, pts):
+        """帧pts对应的RTP时间戳: 按起始RTP时间戳, 以及(本轨道收到SR后)按SR对齐, 没有SR时后者为None"""
+        array = self.array
+        plain = (int(array[base + 1]) + pts - int(array[base + 4])) % MAX_TIMESTAMP
+        if self.streams.value < 2 or not array[base + 5] or not array[base + 3]:
+            return plain, None
+        addend = round((array[base + 6] - array[base + 9]) * array[base + 3])
+        delta = pts - int(array[base + 4]) - int(array[base + 10]) - addend
+        return plain, (int(array[base + 7]) + delta) % MAX_TIMESTAMP
+
+    def stamp(self, track_type, timestamp, arrival_time):
+        """记录一个RTP时间戳的到达时间, 同一时间戳(同一帧的多个包)只记录第一个包"""
+        base = TRACK_TYPES.index(track_type) * self.track_size
+        array = self.array
+        if not array[base + 2]:
+            array[base + 1] = timestamp
+            array[base + 2] = 1
+        position = int(array[base])
+        last = base + self.HEADER + ((position - 1) % self.capacity) * 2
+        if position and array[last] == timestamp:
+            return
+        slot = base + self.HEADER + (position % self.capacity) * 2
+        array[slot] = timestamp
+        array[slot + 1] = arrival_time
+        array[base] = position + 1
+
+    def lookup(self, track_type, pts, tolerance:int = 0):
+        """根据帧pts查找对应RTP包的到达时间
+        Args:
+            track_type (str): 'video'或'audio'
+            pts (int): 解码帧的pts(以RTP时钟为时间基)
+            tolerance (int): 没有完全相同的时间戳时, 允许的最大时间戳差值
+        Returns:
+            float: 到达时间(time.time()), 找不到时返回None
+        """
+        if pts is None:
+            return None
+        base = TRACK_TYPES.index(track_type) * self.track_size
+        array = self.array
+        if not array[base + 2]:
+            return None
+        plain, aligned = self.targets(base, pts)
+        switch = int(array[base + 11])
+        position = int(array[base])
+        best, best_distance = None, tolerance + 1
+        # UDP传输时FFmpeg分别接收RTP和RTCP, 切换附近的包可能按另一种映射, 只在按顺序找不到时采用
+        fallback, fallback_distance = None, tolerance + 1
+        # 从最新的记录向前查找, 解码帧通常对应最近到达的包;
+        # 时间戳随到达顺序递增, 遇到比两种映射都早了tolerance以上的记录后, 更早的记录不可能更近, 停止查找
+        # (如AAC一个RTP包中第一个之后的AU没有对应的记录, 只需检查最近的几条)
+        for i in range(1, min(position, self.capacity) + 1):
+            slot = base + self.HEADER + ((position - i) % self.capacity) * 2
+            target, other = (aligned, plain) if aligned is not None and position - i >= switch else (plain, aligned)
+            delta = timestamp_delta(int(array[slot]), target)
+            if delta == 0:
+                return array[slot + 1]
+            if abs(delta) < best_distance:
+                best, best_distance = array[slot + 1], abs(delta)
+            other_delta = timestamp_delta(int(array[slot]), other) if other is not None else None
+            if other_delta is not None and abs(other_delta) < fallback_distance:
+                fallback, fallback_distance = array[slot + 1], abs(other_delta)
+            if delta < -tolerance and (other_delta is None or other_delta < -tolerance):
+                break
+        return best if best is not None else fallback
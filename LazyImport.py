@@ -0,0 +1,31 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    """延迟导入的模块代理: 第一次访问属性时才真正导入模块
+    主进程导入各处理器模块时不会加载cv2/av/vosk等重量级依赖, 由真正用到它们的子进程各自加载
+    访问过的属性缓存在代理上, 之后的访问与普通属性查找相同"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()  # 同一进程中的多个线程可能同时触发导入
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        value = getattr(self._module or self._load(), attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}' ({'loaded' if self._module else 'not loaded'})>"
+
+
+def lazy_import(name):
+    """返回模块的延迟导入代理, 用法: np = lazy_import("numpy")"""
+    return LazyModule(name)
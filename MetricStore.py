@@ -0,0 +1,146 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from LoadConfig import results_dir
+
+
+class MetricStore:
+    """基于SQLite(WAL模式)的持久化指标存储, 跨会话保留, 按流、指标和时间建立索引
+    写入先缓存在内存中, 达到批量大小或时间间隔后在一个事务中批量插入; 时间间隔由后台定时线程保证.
+    连接工作在自动提交模式, 只有批量插入时显式开启事务, 写锁不会在两次插入之间一直被某个连接占用"""
+    def __init__(self, path = None, batch_size:int = 200, flush_interval:float = 2.0):
+        path = path or os.path.join(results_dir(), 'metrics.db')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path  # 数据库文件路径
+        self.batch_size = batch_size  # 批量插入的记录数
+        self.flush_interval = flush_interval  # 最长的批量插入间隔(秒)
+        self.pending = []  # 待插入的记录
+        self.series_ids = {}  # (流, 指标) -> series id 的缓存
+        self.last_flush = time.monotonic()  # 上次批量插入的时间
+
+        # 多个分析进程会同时写入同一个数据库, WAL模式下读写互不阻塞
+        # isolation_level=None: 不隐式开启事务, 否则新建series后的写事务要到下一次批量插入才提交, 期间其他进程无法写入
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS series (
+                id INTEGER PRIMARY KEY,
+                stream TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                UNIQUE (stream, metric)
+            );
+            CREATE TABLE IF NOT EXISTS samples (
+                series_id INTEGER NOT NULL REFERENCES series(id),
+                ts REAL NOT NULL,
+                value REAL NOT NULL,
+                start_pts INTEGER,
+                end_pts INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_samples_series_ts ON samples (series_id, ts);
+        """)
+        self.lock = threading.RLock()  # 写入线程与定时插入线程共用缓存和连接
+        self.closed = threading.Event()
+        self.timer = None  # 定时批量插入线程
+        if flush_interval > 0:
+            self.timer = threading.Thread(target=self.flush_periodically, name="MetricStoreFlush", daemon=True)
+            self.timer.start()
+
+    def series_id(self, stream, metric):
+        """获取(流, 指标)对应的series id, 不存在时创建"""
+        key = (stream, metric)
+        if key not in self.series_ids:
+            self.conn.execute("INSERT OR IGNORE INTO series (stream, metric) VALUES (?, ?)", key)
+            row = self.conn.execute("SELECT id FROM series WHERE stream = ? AND metric = ?", key).fetchone()
+            self.series_ids[key] = row[0]
+        return self.series_ids[key]
+
+    def add(self, stream, metric, value, ts = None, start_pts = None, end_pts = None):
+        """添加一条指标记录, 必要时触发批量插入"""
+        ts = ts if ts is not None else time.time()
+        with self.lock:
+            self.pending.append((self.series_id(stream, metric), ts, float(value), start_pts, end_pts))
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """将缓存的记录在一个事务中批量插入"""
+        with self.lock:
+            if self.pending:
+                self.conn.execute("BEGIN")
+                try:
+                    self.conn.executemany(
+                        "INSERT INTO samples (series_id, ts, value, start_pts, end_pts) VALUES (?, ?, ?, ?, ?)",
+                        self.pending)
+                except BaseException:
+                    self.conn.execute("ROLLBACK")
+                    raise
+                self.conn.execute("COMMIT")
+                self.pending.clear()
+            self.last_flush = time.monotonic()
+
+    def flush_periodically(self):
+        """定时批量插入线程: 距上次插入超过flush_interval且有缓存的记录时插入"""
+        while not self.closed.wait(self.flush_interval / 2):
+            with self.lock:
+                if self.closed.is_set():
+                    return
+                if self.pending and time.monotonic() - self.last_flush >= self.flush_interval:
+                    try:
+                        self.flush()
+                    except sqlite3.Error as e:
+                        print(f"Error writing metric store: {e}")
+
+    def query(self, stream, metric, since = None, until = None, min_value = None, max_value = None, limit = None):
+        """按流、指标、时间范围和取值范围查询, 返回 [(ts, value, start_pts, end_pts), ...]"""
+        sql = ("SELECT samples.ts, samples.value, samples.start_pts, samples.end_pts FROM samples "
+               "JOIN series ON series.id = samples.series_id "
+               "WHERE series.stream = ? AND series.metric = ?")
+        params = [stream, metric]
+        for condition, value in (("samples.ts >= ?", since), ("samples.ts < ?", until),
+                                 ("samples.value >= ?", min_value), ("samples.value <= ?", max_value)):
+            if value is not None:
+                sql += f" AND {condition}"
+                params.append(value)
+        sql += " ORDER BY samples.ts"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
+
+    def list_series(self):
+        """列出已存储的所有(流, 指标)"""
+        return self.conn.execute("SELECT stream, metric FROM series ORDER BY stream, metric").fetchall()
+
+    def close(self):
+        """写入剩余记录并关闭数据库连接"""
+        with self.lock:
+            self.flush()
+            self.closed.set()
+            self.conn.close()
+        if self.timer is not None and self.timer is not threading.current_thread():
+            self.timer.join()
+
+
+# 命令行查询入口, 例如: python MetricStore.py --stream rtsp://... --metric video-Net-Status/loss_rate_pct --min 5 --days 7
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the persistent metric store.")
+    parser.add_argument("--db", default=None, help="path of metrics.db")
+    parser.add_argument("--stream", help="stream name")
+    parser.add_argument("--metric", help="metric name, e.g. Video-Status/mosaic_ratio_pct")
+    parser.add_argument("--days", type=float, default=None, help="only return samples from the last N days")
+    parser.add_argument("--min", type=float, default=None, dest="min_value")
+    parser.add_argument("--max", type=float, default=None, dest="max_value")
+    args = parser.parse_args()
+
+    store = MetricStore(args.db)
+    if not args.stream or not args.metric:
+        for stream, metric in store.list_series():
+            print(f"{stream}\t{metric}")
+    else:
+        since = time.time() - args.days * 86400 if args.days else None
+        for ts, value, start_pts, end_pts in store.query(args.stream, args.metric, since, None, args.min_value, args.max_value):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))}\t{value:.3f}\t{start_pts}\t{end_pts}")
+    store.close()
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import signal
+import threading
+import tracemalloc
+from collections import Counter
+from LoadConfig import results_dir
+
+
+def profile_dir():
+    """返回性能分析结果目录 results/profiles, 不存在时创建"""
+    return results_dir('profiles')
+
+
+class StackSampler(threading.Thread):
+    """低开销的栈采样线程, 定时采集进程内所有线程的调用栈, 输出collapsed stacks(可直接生成火焰图)"""
+    def __init__(self, name, interval:float = 0.005, max_duration:float = 60):
+        super().__init__(daemon=True)
+        self.name_prefix = name  # 进程名称, 用于输出文件命名
+        self.interval = interval  # 采样间隔(秒)
+        self.max_duration = max_duration  # 最长采样时间(秒)
+        self.stop_flag = threading.Event()
+        self.stacks = Counter()  # 折叠后的调用栈 -> 采样次数
+
+    def sample(self):
+        """采集一次所有线程(除自身外)的调用栈"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def run(self):
+        deadline = time.monotonic() + self.max_duration
+        while not self.stop_flag.is_set() and time.monotonic() < deadline:
+            self.sample()
+            self.stop_flag.wait(self.interval)
+        self.dump()
+
+    def dump(self):
+        """将采样结果写入 results/profiles/<进程名>-<pid>-<时间>.folded"""
+        path = os.path.join(profile_dir(), f"{self.name_prefix}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        print(f"Stack profile written to {path}\r\n")
+
+    def stop(self):
+        self.stop_flag.set()
+
+
+class ProcessProfiler:
+    """进程内按需性能分析
+    SIGUSR1: 开始栈采样, 再次收到时停止并输出
+    SIGUSR2: 第一次开启tracemalloc, 之后每次输出内存占用前N项及与上一次快照的差异"""
+    def __init__(self, name, top_n:int = 25):
+        self.name = name  # 进程名称
+        self.top_n = top_n  # 内存快照输出的条目数
+        self.sampler = None  # 当前的栈采样线程
+        self.last_snapshot = None  # 上一次的内存快照
+
+    def toggle_sampler(self, *args):
+        if self.sampler is not None and self.sampler.is_alive():
+            self.sampler.stop()
+            self.sampler = None
+        else:
+            self.sampler = StackSampler(self.name)
+            self.sampler.start()
+
+    def memory_snapshot(self, *args):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.last_snapshot = tracemalloc.take_snapshot()
+            print(f"tracemalloc started in {self.name} ({os.getpid()})\r\n")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        path = os.path.join(profile_dir(), f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.tracemalloc.txt")
+        with open(path, 'w', encoding='utf-8') as file:
+            current, peak = tracemalloc.get_traced_memory()
+            file.write(f"traced: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB\n\n")
+            file.write(f"Top {self.top_n} allocations:\n")
+            for stat in snapshot.statistics('lineno')[:self.top_n]:
+                file.write(f"{stat}\n")
+            if self.last_snapshot is not None:
+                file.write(f"\nTop {self.top_n} differences since last snapshot:\n")
+                for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:self.top_n]:
+                    file.write(f"{stat}\n")
+        self.last_snapshot = snapshot
+        print(f"Memory snapshot written to {path}\r\n")
+
+
+def install_profiler(name):
+    """在进程的主线程中注册性能分析信号处理函数, 在每个进程的run()开头调用
+    不支持SIGUSR1/SIGUSR2的平台(如Windows)上不做任何事"""
+    if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+        return None
+    profiler = ProcessProfiler(name)
+    signal.signal(signal.SIGUSR1, profiler.toggle_sampler)
+    signal.signal(signal.SIGUSR2, profiler.memory_snapshot)
+    return profiler
@@ -1,8 +1,23 @@
 import time
 import struct
 
+NTP_EPOCH_OFFSET = 2208988800  # NTP纪元(1900年)与Unix纪元的秒数差
+
+
+def parse_sender_report(packet):
+    """解析RTCP发送者报告(SR)的前20字节, 中继和进程内接入只截取这一部分
+    Returns:
+        tuple: (SSRC, 发送端的NTP时间(换算为Unix秒), 对应的RTP时间戳), 不是SR时返回None
+    """
+    if len(packet) < 20 or (packet[0] >> 6) != 2 or packet[1] != 200:
+        return None
+    ssrc, ntp_seconds, ntp_fraction, rtp_timestamp = struct.unpack('!IIII', packet[4:20])
+    return ssrc, ntp_seconds - NTP_EPOCH_OFFSET + ntp_fraction / 4294967296, rtp_timestamp
+
+
 class RTP:
-    """处理RTP数据包的类, 可以解析字节序列和字典格式的数据包, 并将解析的数据序列化为字典"""
+    """处理RTP数据包的类, 可以解析字节序列和字典格式的数据包, 并将解析的数据序列化为字典
+    字节序列也可以是 (RTP头部, 到达时间) 元组, 到达时间由中继在收到数据时记录"""
     def __init__(self, packet):
         self.is_rtp_packet = False  # 标记是否成功解析了一个有效的RTP数据包
         self.payload_type = None  # 载荷类型（音频/视频）
@@ -14,6 +29,8 @@ class RTP:
         # 根据输入的数据包类型进行解析
         if isinstance(packet, dict):
             self.from_dict(packet)
+        elif isinstance(packet, tuple):
+            self.from_bytes(*packet)
         else:
             self.from_bytes(packet)
 
@@ -25,8 +42,8 @@ class RTP:
         self.ssrc = int(packet["ssrc"])
         self.arrival_time = float(packet["arrival_time"])
 
-    def from_bytes(self, packet):
-        """从字节序列初始化RTP对象"""
+    def from_bytes(self, packet, arrival_time = None):
+        """从字节序列初始化RTP对象, 未给出到达时间时以当前时间为到达时间"""
         RTP_HEADER_LENGTH = 12  # RTP头部固定长度
         if len(packet) < RTP_HEADER_LENGTH:
             return  # 如果数据包太短, 则返回而不设置is_rtp_packet
@@ -43,7 +60,7 @@ class RTP:
         self.seq = rtp_header[2]
         self.timestamp = rtp_header[3]
         self.ssrc = rtp_header[4]
-        self.arrival_time = time.perf_counter() # 记录当前时间为到达时间
+        self.arrival_time = arrival_time if arrival_time is not None else time.time() # 记录到达时间
 
 
     def to_dict(self):
@@ -1,7 +1,53 @@
-
-import av
+from __future__ import annotations
 import time
+import queue
+import threading
 import multiprocessing
+from Stats import StatsBlock
+from Trace import Tracer
+from Latency import ArrivalClock
+from Profiler import install_profiler
+from StreamInfo import StreamChannel, publish_stream_info
+from EventBus import EventBus
+from EventCapture import EventCapture
+from LazyImport import lazy_import
+
+av = lazy_import("av")
+
+
+class DecodeWorker(threading.Thread):
+    """一个轨道的解码线程: 解复用线程放入包, 本线程解码并分发帧
+    音频和视频各用一个, 视频解码再慢也不会推迟音频帧的分发; 队列满时解复用线程等待(不丢弃压缩包, 以免之后的帧无法解码)"""
+    def __init__(self, name, handle, maxsize:int = 256):
+        super().__init__(name=name, daemon=True)
+        self.handle = handle  # 解码并分发一个包的函数
+        self.packets = queue.Queue(maxsize)  # 待解码的包, None表示结束
+        self.error = None  # 解码中的异常, 由解复用线程在下一次放入时重新抛出
+        self.reported = False  # 异常是否已经抛给解复用线程
+
+    def put(self, packet):
+        if self.error is not None:
+            self.reported = True
+            raise self.error
+        self.packets.put(packet)
+
+    def run(self):
+        while True:
+            packet = self.packets.get()
+            if packet is None:
+                return
+            if self.error is None:  # 出错后只取出剩余的包, 不阻塞解复用线程
+                try:
+                    self.handle(packet)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        """解码完已放入的包后结束, 解复用线程还没有得知的解码异常(如最后几个包中的)在此输出"""
+        self.packets.put(None)
+        self.join()
+        if self.error is not None and not self.reported:
+            print(f"There is an Exception in {self.name}:{self.error}\r\n")
 
 
 class RTSPStreamHandler(multiprocessing.Process):
@@ -9,20 +55,55 @@ class RTSPStreamHandler(multiprocessing.Process):
     def __init__(self,
                  video_frame_ques,
                  audio_frame_ques,
-                 stream_info_dict,
+                 stream_info,
                  stop_event,
                  rtsp_url:str = None,
                  options:str = None,
+                 stats:StatsBlock = None,
+                 arrival_clock:ArrivalClock = None,
+                 stream_ready = None,
+                 reconnect:bool = True,
+                 reconnect_delay:float = 0.5,
+                 reconnect_max_delay:float = 10.0,
+                 resume:bool = False,
+                 transport:str = 'tcp',
+                 event_bus:EventBus = None,
+                 capture_options:dict = None,
+                 decode_workers:bool = True,
+                 decode_threads:int = 0,
+                 thread_type:str = 'AUTO',
                  ):
         
         super().__init__()
         self.video_frame_ques = video_frame_ques  # 视频帧队列列表
         self.audio_frame_ques = audio_frame_ques  # 音频帧队列列表
-        self.stream_info_dict = stream_info_dict  # 存储流信息的字典
+        self.stream_info = stream_info  # 流信息的广播通道(StreamChannel), 旧入口脚本中为Manager字典
+        self.stream_values = {}  # 最近一次发布的流信息
         self.stop_event = stop_event  # 控制停止的事件
         self.rtsp_url = rtsp_url or "rtsp://127.0.0.1:12024/stream"  # RTSP流的URL
-        self.options = options or {"rtsp_transport": "tcp", "stimeout": "10000000", "max_delay": "5000000"}  # RTSP流的连接选项
+        self.options = options or {"rtsp_transport": transport, "stimeout": "10000000", "max_delay": "5000000"}  # RTSP流的连接选项, transport为'tcp'(交织)或'udp'
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.arrival_clock = arrival_clock  # RTP时间戳 -> 到达时间映射, 由中继写入
+        self.stream_ready = stream_ready  # 使用Manager字典时, 流信息写入后设置, 唤醒等待流信息的进程
+        self.first_frame = True  # 是否尚未解码出第一帧
+        self.reconnect = reconnect  # 流中断后是否重连, 为False时流中断即停止整个流水线
+        self.reconnect_delay = reconnect_delay  # 第一次重连前的等待(秒), 之后每次失败加倍
+        self.reconnect_max_delay = reconnect_max_delay  # 重连等待的上限(秒)
+        self.resume = resume  # 被Supervisor重启时为True, 直接重连并接续原来的时间轴
+        self.pts_offsets = {}  # 轨道 -> 加到帧时间戳上的偏移, 使时间轴跨越断流保持连续
+        self.gap_tracks = set()  # 尚未接续时间轴的轨道
+        self.gap_since = 0.0  # 断流前最后一帧的解码时间(time.time()), 为0时没有缺口
+        self.event_bus = event_bus  # 事件总线, 有时在本进程中进行触发式事件录制
+        self.capture_options = capture_options or {}  # EventCapture的参数, 见config.json的event_capture
+        self.capture = None  # 事件录制, 在子进程中创建
+        self.decode_workers = decode_workers  # 音频和视频是否各在一个解码线程中解码, 为False时在解复用循环中依次解码
+        self.decode_threads = decode_threads  # 视频解码器的线程数, 0为按CPU核数自动选择
+        self.thread_type = thread_type  # 视频解码器的多线程方式: 'SLICE'(片级, 不增加延迟), 'FRAME'(帧级, 延迟增加线程数帧), 'AUTO'(两者)
     
+    def open_stream(self):
+        """打开RTSP流, 返回交给receive的容器, 失败时抛出av.AVError或OSError"""
+        return av.open(self.rtsp_url, options=self.options)
+
     def open_container(self, max_retries = 5, retry_delay = 3):
         """尝试打开RTSP流, 如果失败则重试, 直到达到最大重试次数或接收到停止事件"""
         retries = 0
@@ -30,18 +111,98 @@ class RTSPStreamHandler(multiprocessing.Process):
             if self.stop_event.is_set():
                 return
             try:
-                container = av.open(self.rtsp_url, options=self.options)
+                container = self.open_stream()
                 return container
-            except av.AVError as e:
+            except (av.AVError, OSError) as e:
                 retries += 1
                 print(f"Attempt {retries} failed: {e}")
                 if retries < max_retries:
                     print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
+                    self.wait(retry_delay)
                 else:
                     print("Could not open the URL.")
                     return None
 
+    def reconnect_container(self):
+        """流中断后按指数退避重连, 直到成功或接收到停止事件"""
+        delay = self.reconnect_delay
+        attempts = 0
+        while not self.stop_event.is_set():
+            attempts += 1
+            self.stats.beat("RTSPStreamHandler")
+            try:
+                container = self.open_stream()
+                print(f"Reconnected after {attempts} attempt(s).\r\n")
+                return container
+            except (av.AVError, OSError) as e:
+                print(f"Reconnect attempt {attempts} failed: {e}, retrying in {delay:.1f} seconds...")
+            self.wait(delay)
+            delay = min(delay * 2, self.reconnect_max_delay)
+        return None
+
+    def wait(self, seconds):
+        """等待期间保持心跳, 接收到停止事件时提前返回"""
+        deadline = time.monotonic() + seconds
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            self.stats.beat("RTSPStreamHandler")
+            time.sleep(min(0.5, max(deadline - time.monotonic(), 0)))
+
+    def start_gap(self):
+        """记录断流: 之后每个轨道的第一帧按断流的实际时长接续时间轴"""
+        self.gap_since = self.stats.get("stream_last_frame_time_seconds")
+        self.gap_tracks = {'video', 'audio'}
+
+    def continue_timeline(self, track, data):
+        """将序列化帧的时间戳接到会话时间轴上
+        重连(或本进程重启)后每个轨道的第一帧: 时间轴按断流的实际时长推进, 并在该帧上附带缺口 "gap": (开始pts, 结束pts)"""
+        if data["pts"] is None:
+            return
+        time_base = data["time_base"]
+        if track in self.gap_tracks:
+            self.gap_tracks.discard(track)
+            last_seconds = self.stats.get(f"stream_{track}_pts_seconds")
+            if self.gap_since and last_seconds:
+                start = int(last_seconds / time_base)
+                end = start + max(int((data["enqueue_time"] - self.gap_since) / time_base), 1)
+                self.pts_offsets[track] = end - data["pts"]
+                data["gap"] = (start, end)
+        data["pts"] += self.pts_offsets.get(track, 0)
+        self.stats.set(f"stream_{track}_pts_seconds", float(data["pts"] * time_base))
+        self.stats.set("stream_last_frame_time_seconds", data["enqueue_time"])
+
+    def describe_streams(self, video_stream, audio_stream):
+        """由打开的流生成流描述, 前七个键与原来的stream_info_dict相同"""
+        def time_base(stream):
+            return [stream.time_base.numerator, stream.time_base.denominator] if stream else None
+        return {
+            "status": "start",
+            "video": video_stream is not None,
+            "audio": audio_stream is not None,
+            "video_sample_rate": int(1 / video_stream.time_base) if video_stream else None,
+            "audio_sample_rate": int(1 / audio_stream.time_base) if audio_stream else None,
+            "video_width": video_stream.width if video_stream else None,
+            "video_height": video_stream.height if video_stream else None,
+            "video_codec": video_stream.codec_context.name if video_stream else None,
+            "video_time_base": time_base(video_stream),
+            "video_fps": float(video_stream.average_rate) if video_stream and video_stream.average_rate else None,
+            "audio_codec": audio_stream.codec_context.name if audio_stream else None,
+            "audio_time_base": time_base(audio_stream),
+            "audio_rate": audio_stream.codec_context.sample_rate if audio_stream else None,
+            "audio_channels": audio_stream.codec_context.channels if audio_stream else None,
+            "audio_layout": audio_stream.codec_context.layout.name if audio_stream else None,
+        }
+
+    def publish(self, values:dict):
+        """发布流描述, 每次发布都是新的版本"""
+        self.stream_values = values
+        publish_stream_info(self.stream_info, values)
+
+    def record_first_frame(self):
+        """记录从流水线启动到解码出第一帧的时间"""
+        started = self.stats.get("pipeline_start_time_seconds")
+        if started and not self.stats.get("stream_first_frame_seconds"):  # 重启后的进程不覆盖
+            self.stats.set("stream_first_frame_seconds", time.time() - started)
+
     def serialize_video_frame(self, frame:av.VideoFrame):
         """将视频帧序列化为二进制数据"""
         array = frame.to_ndarray(format="yuv420p")
@@ -52,6 +213,7 @@ class RTSPStreamHandler(multiprocessing.Process):
                 "pts":frame.pts,
                 "time_base":frame.time_base,
                 "pict_type":frame.pict_type,
+                "enqueue_time": time.time(),
             }
     
     def serialize_audio_frame(self, frame:av.AudioFrame):
@@ -65,62 +227,128 @@ class RTSPStreamHandler(multiprocessing.Process):
                 "time_base": frame.time_base,
                 "layout": frame.layout.name,
                 "sample_rate": frame.sample_rate,
+                "enqueue_time": time.time(),
         }
     
 
+    def configure_decoder(self, codec_context):
+        """视频解码器启用编解码器级的多线程, 须在第一次解码前设置, 高分辨率的流可以使用多个核"""
+        codec_context.thread_type = self.thread_type
+        codec_context.thread_count = self.decode_threads
+
+    def decode_packet(self, packet, tracer:Tracer, tolerance:int = 0):
+        """解码一个包并分发得到的帧, 启用解码线程时在该轨道的解码线程中调用"""
+        decode_start = time.perf_counter()
+        frames = packet.decode()
+        if frames and self.first_frame:
+            self.first_frame = False
+            self.record_first_frame()
+        tracer.record(f"{packet.stream.type}_decode", decode_start, packet.pts)
+        for frame in frames:
+            self.dispatch_frame(frame, tracer, tolerance)
+
+    def dispatch_frame(self, frame, tracer:Tracer, tolerance:int = 0):
+        """序列化解码得到的帧, 附上到达时间并接续时间轴后放入该类型的所有队列, 队列满时丢弃
+        Args:
+            tolerance (int): 查找到达时间时允许的时间戳误差
+        """
+        if isinstance(frame, av.VideoFrame):
+            track, ques, serialize = 'video', self.video_frame_ques, self.serialize_video_frame
+        else:
+            track, ques, serialize = 'audio', self.audio_frame_ques, self.serialize_audio_frame
+        self.stats.inc(f"stream_{track}_frames_decoded_total")
+        serialize_start = time.perf_counter()
+        serialized_frame = serialize(frame)
+        tracer.record(f"{track}_serialize", serialize_start, frame.pts)
+        if self.arrival_clock:
+            serialized_frame["arrival_time"] = self.arrival_clock.lookup(track, frame.pts, tolerance)
+            if serialized_frame["arrival_time"] is None:
+                self.stats.inc(f"stream_{track}_arrival_misses_total")
+        self.continue_timeline(track, serialized_frame)
+        for que in ques:
+            if not que.full():
+                que.put(serialized_frame)
+            else:
+                self.stats.inc(f"stream_{track}_frames_dropped_total")
+
     def run(self):
-        """进程的主执行函数, 负责管理RTSP流的接收和处理流程"""
-        container = self.open_container()
-        if container is not None:
-            video_stream = None
-            audio_stream = None
-            
-            for stream in container.streams:
-                if stream.type == "video":
-                    video_stream = stream
-                if stream.type == "audio":
-                    audio_stream = stream
-                
-            self.stream_info_dict.update({
-                    "status": "start",
-                    "video": video_stream is not None,
-                    "audio": audio_stream is not None,
-                    "video_sample_rate": int(1 / video_stream.time_base) if video_stream else None,
-                    "audio_sample_rate": int(1 / audio_stream.time_base) if audio_stream else None,
-                    "video_width": video_stream.width if video_stream else None,
-                    "video_height": video_stream.height if video_stream else None,
-                })
-            
-            while not self.stop_event.is_set():
-                try:
-                    for packet in container.demux(video_stream, audio_stream):
-                        if self.stop_event.is_set():
-                            break
-                        for frame in packet.decode():
-                            if isinstance(frame, av.VideoFrame):
-                                serialized_video_frame = self.serialize_video_frame(frame)
-                                for video_que in self.video_frame_ques:
-                                    if not video_que.full():
-                                        video_que.put(serialized_video_frame)
-                                continue
-                            if isinstance(frame, av.AudioFrame):
-                                serialized_audio_frame = self.serialize_audio_frame(frame)
-                                for audio_que in self.audio_frame_ques:
-                                    if not audio_que.full():
-                                        audio_que.put(serialized_audio_frame)
-                                continue
-                except Exception as e:
-                    print(f"There is an Exception in RTSPStreamHandler:{e}\r\n")
-                    break
+        """进程的主执行函数, 负责管理RTSP流的接收和处理流程, 流中断后重连并接续时间轴"""
+        install_profiler("RTSPStreamHandler")
+        tracer = Tracer(self.stats, "RTSPStreamHandler")
+        if self.event_bus is not None:
+            self.capture = EventCapture(self.event_bus, stats=self.stats, **self.capture_options)
+        self.start_gap()  # 新会话没有断流前的帧, 不会产生缺口
+        if self.resume and isinstance(self.stream_info, StreamChannel):
+            current = self.stream_info.get()
+            self.stream_values = {key: value for key, value in current.items() if key != "version"} if current else {}
+        container = self.reconnect_container() if self.resume else self.open_container()
+        while container is not None:
+            self.receive(container, tracer)
+            if self.capture:
+                self.capture.finish()  # 流中断时结束进行中的片段, 片段中的包都来自同一连接
             container.close()
+            if self.stop_event.is_set() or not self.reconnect:
+                break
+            self.stats.inc("stream_reconnects_total")
+            self.start_gap()
+            container = self.reconnect_container()
+        tracer.dump()
         self.stop_event.set()
         time.sleep(0.1)
-        self.stream_info_dict.update({"status":'end'})
+        self.publish(dict(self.stream_values, status='end'))
+        if self.stream_ready:
+            self.stream_ready.set()  # 流未能打开时同样唤醒等待的进程
+
+    def receive(self, container, tracer:Tracer):
+        """从打开的容器中解复用、解码并分发帧, 流结束或出错时返回"""
+        video_stream = None
+        audio_stream = None
         
+        for stream in container.streams:
+            if stream.type == "video":
+                video_stream = stream
+            if stream.type == "audio":
+                audio_stream = stream
             
-
+        values = self.describe_streams(video_stream, audio_stream)
+        if values != self.stream_values:
+            self.publish(values)  # 重连后流参数变化时以新的版本号重新发布
+        if self.stream_ready:
+            self.stream_ready.set()
+        if self.capture:
+            self.capture.set_sources({stream.type: {"type": stream.type, "template": stream}
+                                      for stream in (video_stream, audio_stream) if stream is not None})
+        # 没有消费者的流只解复用(保持RTSP会话的数据流动), 不解码
+        decode_streams = [stream for stream, ques in ((video_stream, self.video_frame_ques), (audio_stream, self.audio_frame_ques))
+                          if stream is not None and ques]
         
-
-
-
-
+        if video_stream in decode_streams:
+            self.configure_decoder(video_stream.codec_context)
+        # 查找到达时间时允许的时间戳误差: 100毫秒
+        tolerances = {stream: int(0.1 / stream.time_base) for stream in decode_streams}
+        # 解复用与解码分离: 每个轨道一个解码线程(PyAV解码时释放GIL)
+        workers = {}
+        if self.decode_workers:
+            for stream in decode_streams:
+                workers[stream] = DecodeWorker(f"{stream.type}-decoder",
+                                               lambda packet, tolerance=tolerances[stream]: self.decode_packet(packet, tracer, tolerance))
+                workers[stream].start()
+        try:
+            demux_start = time.perf_counter()
+            for packet in container.demux(video_stream, audio_stream):
+                if self.stop_event.is_set():
+                    break
+                tracer.record("demux", demux_start, packet.pts)
+                self.stats.inc("stream_packets_demuxed_total")
+                self.stats.beat("RTSPStreamHandler")
+                if self.capture and packet.pts is not None:
+                    self.capture.add(packet.stream.type, bytes(packet), packet.pts, packet.dts, packet.is_keyframe, packet.time_base)
+                if packet.stream in workers:
+                    workers[packet.stream].put(packet)
+                elif packet.stream in decode_streams:
+                    self.decode_packet(packet, tracer, tolerances[packet.stream])
+                demux_start = time.perf_counter()
+        except Exception as e:
+            print(f"There is an Exception in RTSPStreamHandler:{e}\r\n")
+        for worker in workers.values():
+            worker.close()
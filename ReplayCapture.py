@@ -0,0 +1,118 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+from Capture import CaptureReader
+from Forwarder import ServerPacketHandler
+from AnalyzeNet import NetAnalyProcesser
+from StreamInfo import StreamChannel
+from Stats import StatsBlock
+
+
+class ReplaySink:
+    """只回放中继解析路径时替代初始化管道, 记录发送的初始化信息"""
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+
+def replay(path, speed = 1.0, server_host = None, relay_only = False, prefix = None, sync_interval = 1.0):
+    """将抓包文件回放给ServerPacketHandler, 默认同时运行NetAnalyProcesser生成网络指标
+    Args:
+        path (str): 抓包文件路径
+        speed (float): 回放速度倍数, 1为原始节奏, 0为尽可能快
+        server_host (str): NetAnalyProcesser用于ping的地址, 为None时不ping(结果可复现)
+        relay_only (bool): 只运行中继的解析路径(RTP包放入进程内队列), 用于测量解析吞吐量
+        prefix (str): 结果文件名前缀, 默认为抓包文件名, 避免覆盖实时分析的结果
+        sync_interval (float): 音画同步报告的间隔(秒), 为None时不分析
+    Returns:
+        dict: 回放统计
+    """
+    reader = CaptureReader(path)
+    stats = StatsBlock()
+    net_analyzer = None
+    if relay_only:
+        stop_event = threading.Event()
+        rtp_que = queue.SimpleQueue()
+        pipeline = ReplaySink()
+    else:
+        # 与main中相同的进程结构: Manager队列传递RTP头部, StreamChannel传递各轨道的初始化信息
+        manager = multiprocessing.Manager()
+        stop_event = manager.Event()
+        rtp_que = manager.Queue()
+        pipeline = StreamChannel()
+        prefix = prefix or os.path.splitext(os.path.basename(path))[0]
+        net_analyzer = NetAnalyProcesser(rtp_que, server_host, pipeline, stop_event, stats=stats,
+                                         sync_interval=sync_interval, prefix=prefix)
+        net_analyzer.start()
+
+    handler = ServerPacketHandler(None, None, stop_event, rtp_que, pipeline, stats)
+    first_time = None
+    offset = None
+    records = 0
+    start = time.perf_counter()
+    for recv_time, data in reader:
+        if first_time is None:
+            # 接收时间整体平移到当前时间, 保持包间间隔不变, 抖动等指标与抓包时一致
+            first_time = recv_time
+            offset = time.time() - recv_time
+        if speed > 0:
+            delay = (recv_time - first_time) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        handler.prev_recv_time = handler.recv_time
+        handler.recv_time = recv_time + offset
+        handler.recv_len = len(data)
+        handler.data_handler(data)
+        handler.buffer = b''
+        records += 1
+    feed_seconds = time.perf_counter() - start
+
+    stop_event.set()
+    if net_analyzer:
+        net_analyzer.join()
+    elapsed = time.perf_counter() - start
+    reader.close()
+
+    packets = stats.get("relay_rtp_packets_total")
+    capture_seconds = (recv_time - first_time) if first_time is not None else 0
+    return {
+        "records": records,
+        "rtp_packets": packets,
+        "capture_seconds": capture_seconds,
+        "feed_seconds": feed_seconds,
+        "elapsed_seconds": elapsed,
+        "relay_packets_per_s": packets / feed_seconds if feed_seconds else 0,
+        "net_packets_processed": stats.get("net_rtp_packets_processed_total"),
+        "net_packets_per_s": stats.get("net_rtp_packets_processed_total") / elapsed if elapsed else 0,
+        "line_rate_multiple": capture_seconds / elapsed if elapsed else 0,
+    }
+
+
+# 用法: python ReplayCapture.py results/captures/20240501-120000-0.rcap            # 原始节奏
+#       python ReplayCapture.py results/captures/20240501-120000-0.rcap --speed 0  # 尽可能快
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a relay capture through ServerPacketHandler and NetAnalyProcesser.")
+    parser.add_argument("capture", help="capture file written by the relay (capture.enabled in config.json)")
+    parser.add_argument("--speed", type=float, default=1.0, help="pacing multiple, 1 = original pacing, 0 = as fast as possible")
+    parser.add_argument("--ping", default=None, help="host to ping for the delay metric (default: no ping, delay reported as 0)")
+    parser.add_argument("--relay-only", action="store_true", help="only run the relay parsing path, no network analysis")
+    parser.add_argument("--prefix", default=None, help="result file name prefix (default: capture file name)")
+    parser.add_argument("--sync-interval", type=float, default=1.0, help="A/V sync report interval in seconds, 0 = no sync analysis")
+    parser.add_argument("--info", action="store_true", help="print the capture summary and exit")
+    args = parser.parse_args()
+
+    if args.info:
+        reader = CaptureReader(args.capture)
+        count, total, first, last = reader.summary()
+        print(f"Metadata: {reader.metadata}")
+        print(f"Records: {count}, Bytes: {total}, Duration: {(last - first) if count else 0:.2f} s")
+        reader.close()
+    else:
+        result = replay(args.capture, args.speed, args.ping, args.relay_only, args.prefix, args.sync_interval or None)
+        for key, value in result.items():
+            print(f"{key:<24}{value:.2f}" if isinstance(value, float) else f"{key:<24}{value}")
@@ -0,0 +1,213 @@
+import os
+import abc
+import json
+import time
+import struct
+import threading
+
+
+def pts_to_srt_time(pts, sample_rate):
+    """将PTS时间(基于样本率的时间戳)转换为SRT字幕文件中的时间格式
+    Args:
+        pts (int): 时间戳(Presentation Time Stamp)
+        sample_rate (int): 用于时间计算的样本率
+    Returns:
+        str: 转换后的时间字符串，格式为 '小时:分钟:秒,毫秒'
+    """
+    play_time = pts / sample_rate
+    hours = int(play_time // 3600)
+    minutes = int((play_time % 3600) // 60)
+    seconds = int(play_time % 60)
+    milliseconds = int((play_time - int(play_time)) * 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+
+class BufferedSink(abc.ABC):
+    """带缓冲的结果输出基类, 记录先编码进内存缓冲区, 由ResultWriter决定何时落盘"""
+    suffix = ''
+
+    def __init__(self, path, sample_rate, append = False):
+        self.path = path + self.suffix  # 输出文件路径
+        self.sample_rate = sample_rate  # 用于时间计算的样本率
+        self.buffer = bytearray()  # 待写入的数据
+        append = append and os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        self.entries = self.count_entries() if append else 0  # 文件中已有的记录数
+        self.file = open(self.path, 'ab' if append else 'wb')  # 文件在整个会话期间只打开一次
+        if not append:
+            self.write_header()
+
+    def write_header(self):
+        """写入文件头, 默认无文件头"""
+        pass
+
+    @abc.abstractmethod
+    def encode(self, index, start, end, text) -> bytes:
+        """将一条记录编码为字节, 由子类实现"""
+
+    @abc.abstractmethod
+    def count_entries(self):
+        """统计已有文件中的记录数, 接续写入时序号从其后开始, 由子类实现"""
+
+    def append(self, index, start, end, text):
+        """将一条记录追加到缓冲区"""
+        self.buffer += self.encode(index, start, end, text)
+
+    def flush(self, fsync = False):
+        """将缓冲区写入文件, fsync为True时同时强制刷入磁盘"""
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer.clear()
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self, fsync = False):
+        """写出剩余数据并关闭文件"""
+        self.flush(fsync)
+        self.file.close()
+
+
+class SrtSink(BufferedSink):
+    """SRT字幕格式输出"""
+    suffix = '.srt'
+
+    def encode(self, index, start, end, text):
+        start_time = pts_to_srt_time(start, self.sample_rate)
+        end_time = pts_to_srt_time(end, self.sample_rate)
+        return f"{index}\n{start_time} --> {end_time}\n{text}\n\n".encode('utf-8')
+
+    def count_entries(self):
+        with open(self.path, 'rb') as file:
+            return file.read().count(b' --> ')
+
+
+class JsonLinesSink(BufferedSink):
+    """JSON Lines格式输出, 每行一条记录, 时间同时给出pts和秒"""
+    suffix = '.jsonl'
+
+    def encode(self, index, start, end, text):
+        record = {
+            "index": index,
+            "start_pts": start,
+            "end_pts": end,
+            "start": start / self.sample_rate,
+            "end": end / self.sample_rate,
+            "text": text,
+        }
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+
+    def count_entries(self):
+        with open(self.path, 'rb') as file:
+            return file.read().count(b'\n')
+
+
+class BinarySink(BufferedSink):
+    """紧凑的二进制格式输出
+    文件头: magic(4字节 b'RSRB') + 版本(uint8) + 样本率(uint32)
+    记录: 序号(uint32) + 开始pts(int64) + 结束pts(int64) + 文本长度(uint16) + UTF-8文本"""
+    suffix = '.bin'
+    MAGIC = b'RSRB'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBI')
+    RECORD = struct.Struct('<IqqH')
+
+    def write_header(self):
+        self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.sample_rate))
+
+    def encode(self, index, start, end, text):
+        data = text.encode('utf-8')[:0xFFFF]
+        return self.RECORD.pack(index, start, end, len(data)) + data
+
+    def count_entries(self):
+        return len(self.read(self.path)[1])
+
+    @classmethod
+    def read(cls, path):
+        """读取二进制结果文件, 返回 (样本率, [(序号, 开始pts, 结束pts, 文本), ...])"""
+        with open(path, 'rb') as file:
+            data = file.read()
+        magic, version, sample_rate = cls.HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"Unsupported result file: {path}")
+        records = []
+        offset = cls.HEADER.size
+        while offset + cls.RECORD.size <= len(data):
+            index, start, end, length = cls.RECORD.unpack_from(data, offset)
+            offset += cls.RECORD.size
+            records.append((index, start, end, data[offset:offset + length].decode('utf-8')))
+            offset += length
+        return sample_rate, records
+
+
+SINKS = {
+    'srt': SrtSink,
+    'jsonl': JsonLinesSink,
+    'binary': BinarySink,
+}
+
+
+class ResultWriter:
+    """结果写入器, 文件句柄常驻, 记录先写入缓冲区, 按时间间隔或缓冲大小批量落盘
+    落盘间隔由后台定时线程保证, 报告稀疏(如长时间没有识别结果)时缓冲的记录也不会滞留
+    fsync策略: 'none' 交由操作系统决定; 'flush' 每次落盘后fsync; 'close' 仅在关闭时fsync"""
+    def __init__(self,
+                 path:str,
+                 sample_rate:int,
+                 formats = None,
+                 flush_interval:float = 1.0,
+                 flush_bytes:int = 65536,
+                 fsync:str = 'none',
+                 append:bool = False):
+        formats = formats or ['srt']
+        for fmt in formats:
+            if fmt not in SINKS:
+                raise ValueError(f"Unknown result format: {fmt}")
+        if fsync not in ('none', 'flush', 'close'):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.sinks = [SINKS[fmt](path, sample_rate, append) for fmt in formats]  # 输出目标列表
+        self.next_index = max(sink.entries for sink in self.sinks) + 1  # 接续写入时的下一个序号
+        self.flush_interval = flush_interval  # 最长落盘间隔(秒)
+        self.flush_bytes = flush_bytes  # 缓冲区达到该大小时立即落盘
+        self.fsync = fsync  # fsync策略
+        self.last_flush = time.monotonic()  # 上次落盘的时间
+        self.lock = threading.RLock()  # 写入线程与定时落盘线程共用缓冲区和文件
+        self.closed = threading.Event()
+        self.timer = None  # 定时落盘线程
+        if flush_interval > 0:
+            self.timer = threading.Thread(target=self.flush_periodically, name="ResultWriterFlush", daemon=True)
+            self.timer.start()
+
+    def write(self, index, start, end, text):
+        """写入一条记录, 必要时触发落盘"""
+        with self.lock:
+            for sink in self.sinks:
+                sink.append(index, start, end, text)
+            if time.monotonic() - self.last_flush >= self.flush_interval \
+                    or max(len(sink.buffer) for sink in self.sinks) >= self.flush_bytes:
+                self.flush()
+
+    def flush(self):
+        """将所有输出目标的缓冲区写入文件"""
+        with self.lock:
+            if self.closed.is_set():
+                return
+            for sink in self.sinks:
+                sink.flush(self.fsync == 'flush')
+            self.last_flush = time.monotonic()
+
+    def flush_periodically(self):
+        """定时落盘线程: 距上次落盘超过flush_interval且有缓冲的记录时落盘"""
+        while not self.closed.wait(self.flush_interval / 2):
+            with self.lock:
+                if time.monotonic() - self.last_flush >= self.flush_interval and any(sink.buffer for sink in self.sinks):
+                    self.flush()
+
+    def close(self):
+        """写出剩余数据并关闭所有输出目标"""
+        with self.lock:
+            self.closed.set()
+            for sink in self.sinks:
+                if not sink.file.closed:
+                    sink.close(self.fsync != 'none')
+        if self.timer is not None and self.timer is not threading.current_thread():
+            self.timer.join()
@@ -1,22 +1,28 @@
-
-import av
+from __future__ import annotations
 import os
 import time
 import queue
 import threading
-import numpy as np
 import multiprocessing
 from Srt import Srt
-from vosk import Model, KaldiRecognizer
+from Stats import StatsBlock
+from Profiler import install_profiler
+from StreamInfo import StreamGap, wait_for_stream
+from LazyImport import lazy_import
 import json 
 
+av = lazy_import("av")
+np = lazy_import("numpy")
+vosk = lazy_import("vosk")
+
 class DataHandler(threading.Thread):
     """处理音频数据的线程, 负责从进程队列中取出音频帧数据, 反序列化, 并放入线程队列中"""
-    def __init__(self, input_que:multiprocessing.Queue, frame_que:queue.Queue, stop_event:threading.Event):
+    def __init__(self, input_que:multiprocessing.Queue, frame_ques:list, stop_event:threading.Event, stats:StatsBlock = None):
         super().__init__()
         self.input_que = input_que  # 进程间通信的队列
-        self.frame_que = frame_que  # 线程间通信的队列
+        self.frame_ques = frame_ques  # 线程间通信的队列列表, 每个识别线程一个
         self.stop_event = stop_event  # 停止事件
+        self.stats = stats or StatsBlock()  # 共享内存统计块
 
     def deserialize_audio_frame(self, data):
         """从二进制数据反序列化音频帧"""
@@ -33,7 +39,13 @@ class DataHandler(threading.Thread):
         while not self.stop_event.is_set() or not self.input_que.empty():
             try:
                 data = self.input_que.get_nowait()
-                self.frame_que.put(self.deserialize_audio_frame(data))
+                frame = self.deserialize_audio_frame(data)
+                # 每帧只计一次, 与同时运行的识别线程个数无关
+                self.stats.inc("speech_frames_processed_total")
+                for frame_que in self.frame_ques:
+                    if data.get("gap"):
+                        frame_que.put((StreamGap(*data["gap"]), None))
+                    frame_que.put((frame, data.get("arrival_time")))
 
             except queue.Empty:
                 time.sleep(0.1)
@@ -41,22 +53,29 @@ class DataHandler(threading.Thread):
 
 
 
+def load_model():
+    """加载Vosk语音模型, 同一进程内的多个识别器可共享同一个模型"""
+    script_dir = os.path.dirname(__file__)
+    model_path = os.path.join(script_dir, 'Vosk-model-small-cn-0.22') # Vosk模型路径
+    return vosk.Model(model_path)
+
+
 class SpeechRecognizer(threading.Thread):
     """音频识别线程, 从队列中取出音频帧进行语音识别, 并将识别结果写入SRT文件"""
-    def __init__(self, sample_rate, frame_que: queue.Queue, stop_event):
+    def __init__(self, sample_rate, frame_que: queue.Queue, stop_event, model = None, stats:StatsBlock = None, srt:Srt = None, resume = False):
         super().__init__()
         self.sample_rate = sample_rate  # 音频采样率
         self.frame_que = frame_que  # 音频帧队列
         self.stop_event = stop_event  # 停止事件
+        self.model = model  # 共享的Vosk模型, 为None时在线程启动时加载
+        self.stats = stats or StatsBlock()  # 共享内存统计块
         self.last_pts = 0  # 上一个音频帧的时间戳
-        self.srt = Srt("Speech-Text", sample_rate)  # 初始化SRT文件处理类
+        self.srt = srt or Srt("Speech-Text", sample_rate, append=resume)  # 初始化SRT文件处理类
 
     def init_recognizer(self, sample_rate):
         """初始化Vosk语音识别器"""
-        script_dir = os.path.dirname(__file__)
-        model_path = os.path.join(script_dir, 'Vosk-model-small-cn-0.22') # Vosk模型路径
-        model = Model(model_path)
-        return KaldiRecognizer(model, sample_rate)
+        model = self.model or load_model()
+        return vosk.KaldiRecognizer(model, sample_rate)
     
     def recognize_speech(self, frame_bytes):
         """处理音频数据, 进行语音识别"""
@@ -64,48 +83,192 @@ class SpeechRecognizer(threading.Thread):
             result = self.recognizer.Result()
             return f"{json.loads(result)['text']}"
     
-    def process_frame(self, frame:av.AudioFrame):
-        """处理单个音频帧, 从中识别语音并更新SRT文件"""
+    def process_frame(self, frame:av.AudioFrame, arrival_time = None):
+        """处理单个音频帧, 从中识别语音并更新SRT文件, arrival_time为该帧的线上到达时间"""
+        self.stats.set("speech_processed_pts_seconds", frame.time or 0)
         frame_bytes = frame.to_ndarray().astype('int16').tobytes()
         result = self.recognize_speech(frame_bytes)
         if result:
-            self.srt.write_srt(result, self.last_pts, frame.pts)
+            self.srt.write_srt(result, self.last_pts, frame.pts, arrival_time=arrival_time)
             self.last_pts = frame.pts
 
+    def finish(self, end_pts):
+        """输出识别器中尚未结束的语句, 离线分析在每段音频结束时调用"""
+        text = json.loads(self.recognizer.FinalResult())['text']
+        if text:
+            self.srt.write_srt(text, self.last_pts, end_pts)
+            self.last_pts = end_pts
+
+    def mark_gap(self, gap:StreamGap):
+        """断流缺口: 先输出断流前尚未结束的语句, 再标记缺口"""
+        self.finish(gap.start_pts)
+        self.srt.write_gap(gap.start_pts, gap.end_pts)
+        self.last_pts = gap.end_pts
+
+    def run(self):
+        """线程主函数, 处理队列中的音频帧直到接收到停止事件"""
+        self.recognizer = self.init_recognizer(self.sample_rate)
+        while not self.stop_event.is_set() or not self.frame_que.empty():
+            try:
+                frame, arrival_time = self.frame_que.get_nowait()
+                if isinstance(frame, StreamGap):
+                    self.mark_gap(frame)
+                    continue
+                self.process_frame(frame, arrival_time)
+
+            except queue.Empty:
+                time.sleep(0.1)
+        self.srt.close()
+
+
+class KeywordSpotter(threading.Thread):
+    """关键词识别线程, 使用短语列表(Vosk语法)限制识别范围, 只输出命中的关键词事件
+    相比开放词表的完整识别, 解码搜索空间小得多, 适合报警短语检测"""
+    def __init__(self, sample_rate, keywords:list, frame_que: queue.Queue, stop_event, model = None, stats:StatsBlock = None, srt:Srt = None, resume = False, event_bus = None, sample_que = None):
+        super().__init__()
+        self.sample_rate = sample_rate  # 音频采样率
+        self.keywords = keywords  # 关键词(短语)列表
+        self.frame_que = frame_que  # 音频帧队列
+        self.stop_event = stop_event  # 停止事件
+        self.model = model  # 共享的Vosk模型, 为None时在线程启动时加载
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.first_pts = None  # 识别器接收到的第一帧的时间戳, 识别结果中的时间以此为起点
+        self.srt = srt or Srt("Speech-Keyword", sample_rate, sample_que=sample_que, append=resume, event_bus=event_bus)  # 关键词事件的SRT文件
+
+    def init_recognizer(self, sample_rate):
+        """初始化限定语法的Vosk识别器, 加入[unk]避免将词表外的语音强行识别为关键词"""
+        model = self.model or load_model()
+        grammar = json.dumps(self.keywords + ["[unk]"], ensure_ascii=False)
+        recognizer = vosk.KaldiRecognizer(model, sample_rate, grammar)
+        recognizer.SetWords(True)
+        return recognizer
+
+    def match_keywords(self, result:dict):
+        """将识别结果与关键词列表匹配, 返回关键词事件列表"""
+        words = [word for word in result.get("result", []) if word["word"] != "[unk]"]
+        if not words:
+            return []
+        events = []
+        text = "".join(word["word"] for word in words)
+        for keyword in self.keywords:
+            phrase = keyword.replace(" ", "")
+            if not phrase:
+                continue
+            # 同一句中多次出现的关键词各产生一个事件
+            position = text.find(phrase)
+            while position >= 0:
+                # 找出组成该关键词的识别词, 用于计算置信度和起止时间
+                matched, offset = [], 0
+                for word in words:
+                    if offset + len(word["word"]) > position and offset < position + len(phrase):
+                        matched.append(word)
+                    offset += len(word["word"])
+                events.append({
+                    "keyword": keyword,
+                    "confidence": float(np.mean([word["conf"] for word in matched])),
+                    "start_pts": self.first_pts + int(matched[0]["start"] * self.sample_rate),
+                    "end_pts": self.first_pts + int(matched[-1]["end"] * self.sample_rate),
+                })
+                position = text.find(phrase, position + len(phrase))
+        return events
+
+    def process_frame(self, frame:av.AudioFrame, arrival_time = None):
+        """处理单个音频帧, 识别出关键词时写入事件, arrival_time为该帧的线上到达时间"""
+        self.stats.set("speech_processed_pts_seconds", frame.time or 0)
+        if self.first_pts is None:
+            self.first_pts = frame.pts
+        frame_bytes = frame.to_ndarray().astype('int16').tobytes()
+        if self.recognizer.AcceptWaveform(frame_bytes):
+            result = json.loads(self.recognizer.Result())
+            for event in self.match_keywords(result):
+                self.srt.write_srt(f"Keyword: {event['keyword']}, Confidence: {event['confidence']:.2f}", event["start_pts"], event["end_pts"], {"confidence": event['confidence']}, arrival_time)
+
+    def finish(self, end_pts = None):
+        """输出识别器中尚未结束的语句里的关键词, 离线分析在每段音频结束时调用"""
+        if self.first_pts is None:
+            return
+        result = json.loads(self.recognizer.FinalResult())
+        for event in self.match_keywords(result):
+            self.srt.write_srt(f"Keyword: {event['keyword']}, Confidence: {event['confidence']:.2f}", event["start_pts"], event["end_pts"], {"confidence": event['confidence']})
+
+    def mark_gap(self, gap:StreamGap):
+        """断流缺口: 输出断流前的关键词并标记缺口, 识别结果中的时间以第一帧为起点, 重连后换用新的识别器"""
+        self.finish()
+        self.srt.write_gap(gap.start_pts, gap.end_pts)
+        self.recognizer = self.init_recognizer(self.sample_rate)
+        self.first_pts = None
+
     def run(self):
         """线程主函数, 处理队列中的音频帧直到接收到停止事件"""
         self.recognizer = self.init_recognizer(self.sample_rate)
         while not self.stop_event.is_set() or not self.frame_que.empty():
             try:
-                frame = self.frame_que.get_nowait()
-                self.process_frame(frame)
+                frame, arrival_time = self.frame_que.get_nowait()
+                if isinstance(frame, StreamGap):
+                    self.mark_gap(frame)
+                    continue
+                self.process_frame(frame, arrival_time)
 
             except queue.Empty:
                 time.sleep(0.1)
+        self.srt.close()
 
 
 class SpeechRecognizeProcesser(multiprocessing.Process):
-    """负责语音识别的多进程类"""
-    def __init__(self, input_que, stream_info_dict, stop_event,):
+    """负责语音识别的多进程类
+    mode: 'full' 完整转写, 'keyword' 仅关键词识别, 'both' 两者同时运行并共享同一个模型"""
+    def __init__(self, input_que, stream_info, stop_event, mode = 'full', keywords = None, stats:StatsBlock = None, stream_ready = None, resume = False, event_bus = None, sample_que = None):
         super().__init__()
         self.input_que = input_que
-        self.stream_info_dict = stream_info_dict
+        self.stream_info = stream_info  # 流信息(StreamChannel或Manager字典)
         self.stop_event = stop_event
+        self.mode = mode
+        self.keywords = keywords or []
+        self.stats = stats or StatsBlock()  # 共享内存统计块
+        self.stream_ready = stream_ready  # 使用Manager字典时, 流信息写入后设置的事件
+        self.resume = resume  # 被Supervisor重启时为True, 接续已有的结果文件
+        self.event_bus = event_bus  # 事件总线, 识别出关键词时发布事件
+        self.sample_que = sample_que  # 时间序列样本队列, 关键词事件参与跨模态关联
+        # 配置错误在启动时报告, 否则进程照常消费音频帧并发送心跳, 却不运行任何识别器
+        if mode not in ('full', 'keyword', 'both'):
+            raise ValueError(f"Unknown speech_mode: {mode}")
+        if mode == 'keyword' and not self.keywords:
+            raise ValueError("speech_mode 'keyword' needs a non-empty keywords list in config.json.")
+        if mode == 'both' and not self.keywords:
+            print("Warning: keywords in config.json is empty, speech_mode 'both' only runs the full transcription.\r\n")
        
 
     def run(self):
         """进程主函数, 初始化并启动音频处理和语音识别线程"""
-        while self.stream_info_dict['status'] == None:
-            time.sleep(0.01)
+        install_profiler("SpeechRecognizeProcesser")
+        stream_info = wait_for_stream(self.stream_info, self.stream_ready, self.stop_event,
+                                      beat=lambda: self.stats.beat("SpeechRecognizeProcesser"))
+        if stream_info is None:
+            return
 
-        if self.stream_info_dict['audio']:
-            frame_que = queue.Queue()
-            data_handler = DataHandler(self.input_que, frame_que, self.stop_event)
-            speech_recoginzer = SpeechRecognizer(self.stream_info_dict['audio_sample_rate'], frame_que, self.stop_event)
+        if stream_info['audio']:
+            model = load_model()
+            sample_rate = stream_info['audio_sample_rate']
+            frame_ques = []
+            recognizers = []
+            if self.mode in ('full', 'both'):
+                frame_que = queue.Queue()
+                frame_ques.append(frame_que)
+                recognizers.append(SpeechRecognizer(sample_rate, frame_que, self.stop_event, model, self.stats, resume=self.resume))
+            if self.mode in ('keyword', 'both') and self.keywords:
+                frame_que = queue.Queue()
+                frame_ques.append(frame_que)
+                recognizers.append(KeywordSpotter(sample_rate, self.keywords, frame_que, self.stop_event, model, self.stats, resume=self.resume, event_bus=self.event_bus, sample_que=self.sample_que))
+            data_handler = DataHandler(self.input_que, frame_ques, self.stop_event, self.stats)
 
-            speech_recoginzer.start()
+            for recognizer in recognizers:
+                recognizer.start()
             data_handler.start()
             while not self.stop_event.is_set():
+                # 工作线程都在运行时才发送心跳, 线程异常退出后由Supervisor重启本进程
+                if data_handler.is_alive() and all(recognizer.is_alive() for recognizer in recognizers):
+                    self.stats.beat("SpeechRecognizeProcesser")
                 time.sleep(0.5)
             data_handler.join()
-            speech_recoginzer.join()
+            for recognizer in recognizers:
+                recognizer.join()
@@ -1,26 +1,85 @@
 import os
+import math
+import time
+from LoadConfig import CONFIG, results_dir
+from MetricStore import MetricStore
+from EventBus import TriggerPublisher
+from ResultWriter import ResultWriter, pts_to_srt_time
+
+def gap_text(start, end, sample_rate):
+    """断流缺口的字幕文本"""
+    return f"Stream Gap: {(end - start) / sample_rate:.1f} s, reconnected"
+
+
+class NullSrt():
+    """不写入任何文件的Srt替代品, 用于基准测试等不需要输出结果的场景"""
+    def __init__(self, sample_rate = 1):
+        self.sample_rate = sample_rate
+        self.index = 1
+
+    def write_srt(self, text, start, end, metrics = None, arrival_time = None):
+        self.index += 1
+
+    def write_gap(self, start, end):
+        self.write_srt(gap_text(start, end, self.sample_rate), start, end)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SrtCollector(NullSrt):
+    """将字幕条目保存在内存中, 离线分析时各分段分别收集, 最后按时间戳合并写入文件"""
+    def __init__(self, sample_rate = 1):
+        super().__init__(sample_rate)
+        self.entries = []  # (开始时间戳, 结束时间戳, 文本, 指标)
+
+    def write_srt(self, text, start, end, metrics = None, arrival_time = None):
+        self.entries.append((start, end, text, metrics))
+        self.index += 1
+
+
 class Srt():
-    def __init__(self, filename, sample_rate):
+    def __init__(self, filename, sample_rate, options = None, sample_que = None, append = False, event_bus = None, store = True):
         """
-        初始化Srt类, 设置字幕文件路径, 并准备写入
+        初始化Srt类, 设置结果文件路径, 并准备写入
         Args:
             filename (str): 字幕文件的基础名称
             sample_rate (int): 用于时间计算的样本率
+            options (dict): 结果写入器配置, 默认读取config.json中的result_writer项
+            sample_que (Queue): 时间序列样本队列, 不为None时将数值指标连同报告在墙上时间轴上的区间推送给主进程
+            append (bool): 接续已有的结果文件(进程被Supervisor重启时), 而不是覆盖
+            event_bus (EventBus): 事件总线, 不为None时按config.json中的triggers规则检查数值指标并发布事件
+            store (bool): 是否写入持久化指标存储(config.json中metric_store启用时), 离线分析为False,
+                          否则录像的指标会以分析时的时间记在实时流的名下
         """
-        # 获取脚本文件所在目录
-        script_dir = os.path.dirname(__file__)
-        # 创建存放结果的目录，如果不存在则创建
-        dir = os.path.join(script_dir, 'results')
-        if not os.path.exists(dir):
-             os.mkdir(dir)
-        # 构造字幕文件的完整路径
-        path = os.path.join(dir, f"{filename}.srt")
-        # 打开字幕文件准备写入，如果文件不存在会自动创建
-        open(path, 'w', encoding='utf-8')
+        # 存放结果的目录, 不存在时创建
+        dir = results_dir()
+        # 构造结果文件的基础路径(不含扩展名), 各输出格式自行添加扩展名
+        path = os.path.join(dir, filename)
+        options = options if options is not None else CONFIG.get("result_writer", {})
+        # 创建结果写入器, 文件句柄在会话期间保持打开
+        self.writer = ResultWriter(path, sample_rate, append=append, **options)
         
+        # 可选的持久化指标存储, 记录报告中的数值指标
+        store_options = CONFIG.get("metric_store", {})
+        self.store = None
+        if store and store_options.get("enabled"):
+            self.store = MetricStore(store_options.get("path"),
+                                     store_options.get("batch_size", 200),
+                                     store_options.get("flush_interval", 2.0))
+        self.name = filename
+        self.stream_name = CONFIG.get("stream_name")
+        self.sample_que = sample_que
+        self.alert_ms = CONFIG.get("e2e_alert_ms", 3000)  # 端到端延迟告警阈值(毫秒)
+        self.last_alert = 0.0  # 上次告警的时间
+        self.triggers = TriggerPublisher(event_bus, filename) if event_bus is not None else None
+
         # 存储文件路径、初始化字幕序号和样本率
-        self.path = path
-        self.index = 1
+        self.path = f"{path}.srt"
+        self.index = self.writer.next_index
         self.sample_rate = sample_rate
 
     def pts_to_srt_time(self, pts):
@@ -30,24 +89,58 @@ class Srt():
         Returns:
             str: 转换后的时间字符串，格式为 '小时:分钟:秒,毫秒'
         """
-        play_time = pts / self.sample_rate
-        hours = int(play_time // 3600)
-        minutes = int((play_time % 3600) // 60)
-        seconds = int(play_time % 60)
-        milliseconds = int((play_time - int(play_time)) * 1000)    
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+        return pts_to_srt_time(pts, self.sample_rate)
 
 
-    def write_srt(self, text, start, end):
-        """将一条字幕写入文件
+    def write_srt(self, text, start, end, metrics = None, arrival_time = None):
+        """将一条字幕写入缓冲区, 由结果写入器按策略批量落盘
         Args:
             text (str): 字幕文本
             start (int): 字幕开始时间(pts)
             end (int): 字幕结束时间(pts)
+            metrics (dict): 该条字幕对应的数值指标, 如 {"loss_rate_pct": 1.2}
+            arrival_time (float): 该条报告中最新数据的线上到达时间(time.time()), 给出时在报告中附带端到端延迟
         """
-        with open(self.path, 'a', encoding='utf-8') as file:
-            file.write(f"{self.index}\n")
-            file.write(f"{self.pts_to_srt_time(start)} --> {self.pts_to_srt_time(end)}\n")
-            file.write(f"{text}\n\n")
-            self.index += 1
+        if arrival_time:
+            delay_ms = (time.time() - arrival_time) * 1000
+            text = f"{text}, E2E Delay: {delay_ms:.0f} ms"
+            metrics = dict(metrics or {}, e2e_delay_ms=delay_ms)
+            self.check_lag(delay_ms)
+        self.writer.write(self.index, start, end, text)
+        self.index += 1
+        if not metrics:
+            return
+        if self.triggers:
+            self.triggers.check(text, metrics, arrival_time)
+        now = time.time()
+        if self.sample_que is not None:
+            # 报告覆盖的数据在墙上时间轴上的区间: 以最新数据的线上到达时间(没有时为报告时间)为终点, 各分析器的时间基不同也可以直接比较
+            wall_end = arrival_time or now
+            self.sample_que.put((self.stream_name, self.name, now, metrics, (wall_end - (end - start) / self.sample_rate, wall_end)))
+        if self.store:
+            for key, value in metrics.items():
+                if value is not None and math.isfinite(value):  # NaN违反指标表的NOT NULL约束
+                    self.store.add(self.stream_name, f"{self.name}/{key}", value, now, start, end)
+
+    def write_gap(self, start, end):
+        """标记断流造成的缺口, 重连后时间轴按断流的实际时长接续, 缺口前后的报告不会合并"""
+        self.write_srt(gap_text(start, end, self.sample_rate), start, end)
+
+    def check_lag(self, delay_ms):
+        """端到端延迟超过阈值时告警, 每个结果文件最多每10秒告警一次"""
+        if delay_ms > self.alert_ms and time.monotonic() - self.last_alert > 10:
+            print(f"Warning: {self.name} is {delay_ms:.0f} ms behind live.\r\n")
+            self.last_alert = time.monotonic()
+
+    def flush(self):
+        """立即将缓冲的字幕写入文件"""
+        self.writer.flush()
+        if self.store:
+            self.store.flush()
+
+    def close(self):
+        """写出剩余字幕并关闭文件"""
+        self.writer.close()
+        if self.store:
+            self.store.close()
 
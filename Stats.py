@@ -0,0 +1,236 @@
+import math
+import time
+import multiprocessing
+
+
+# 统计字段定义: (名称, 类型, 说明), 每个字段在共享内存中占一个double
+FIELDS = (
+    # 主进程
+    ("pipeline_start_time_seconds", "gauge", "Unix time the pipeline was started"),
+    # RTSPForwarder (进程内接入时由RTSPIngest写入)
+    ("relay_bytes_total", "counter", "Bytes relayed from the RTSP server to the client, or received by the in-process ingest"),
+    ("relay_rtp_packets_total", "counter", "RTP packets seen by the relay or the in-process ingest"),
+    # RTSPStreamHandler
+    ("stream_packets_demuxed_total", "counter", "Packets demuxed from the RTSP stream"),
+    ("stream_video_frames_decoded_total", "counter", "Video frames decoded"),
+    ("stream_audio_frames_decoded_total", "counter", "Audio frames decoded"),
+    ("stream_video_frames_dropped_total", "counter", "Video frames not delivered because a consumer queue was full"),
+    ("stream_audio_frames_dropped_total", "counter", "Audio frames not delivered because a consumer queue was full"),
+    ("stream_video_pts_seconds", "gauge", "Presentation time of the newest decoded video frame"),
+    ("stream_audio_pts_seconds", "gauge", "Presentation time of the newest decoded audio frame"),
+    ("stream_first_frame_seconds", "gauge", "Seconds from pipeline start to the first decoded frame"),
+    ("stream_last_frame_time_seconds", "gauge", "Unix time the newest frame was decoded"),
+    ("stream_reconnects_total", "counter", "Reconnects to the RTSP source after the stream was lost"),
+    ("stream_video_arrival_misses_total", "counter", "Decoded video frames whose wire-arrival time was not found"),
+    ("stream_audio_arrival_misses_total", "counter", "Decoded audio frames whose wire-arrival time was not found"),
+    ("capture_ring_bytes", "gauge", "Compressed bytes held in the pre-event ring"),
+    ("capture_events_total", "counter", "Trigger events received by the event capture"),
+    ("capture_clips_total", "counter", "Event clips written"),
+    # TSFileHandler
+    ("record_video_frames_encoded_total", "counter", "Video frames encoded into the TS file"),
+    ("record_audio_frames_encoded_total", "counter", "Audio frames encoded into the TS file"),
+    ("record_mux_errors_total", "counter", "Packets that failed to mux into the TS file"),
+    ("record_video_encode_fps", "gauge", "Video encode rate over the last second"),
+    # VideoAnalyProcesser
+    ("video_frames_analyzed_total", "counter", "Video frames analyzed"),
+    ("video_analyzed_pts_seconds", "gauge", "Presentation time of the newest analyzed video frame"),
+    # AudioAnalyProcesser
+    ("audio_frames_analyzed_total", "counter", "Audio frames analyzed"),
+    ("audio_analyzed_pts_seconds", "gauge", "Presentation time of the newest analyzed audio frame"),
+    # SpeechRecognizeProcesser
+    ("speech_frames_processed_total", "counter", "Audio frames fed to speech recognizers"),
+    ("speech_processed_pts_seconds", "gauge", "Presentation time of the newest recognized audio frame"),
+    # NetAnalyProcesser
+    ("net_rtp_packets_processed_total", "counter", "RTP headers processed by the net analyzer"),
+    ("net_rtp_packets_lost_total", "counter", "RTP packets estimated lost"),
+    # Supervisor (主进程)
+    ("supervisor_restarts_total", "counter", "Pipeline processes restarted after a crash or a missed heartbeat"),
+    # Correlator (主进程)
+    ("correlation_incidents_total", "counter", "Incidents emitted by the cross-modal correlation rules"),
+)
+
+# 有多个写入线程的计数器 -> 写入者个数
+# 每个写入者累加自己的槽(inc的writer参数), 读取时求和, 不需要加锁; 其余字段都只有一个写入者
+WRITERS = {
+    "relay_bytes_total": 2,          # 0: 服务器端TCP转发线程(或RTSPIngest), 1: UDP中继线程
+    "relay_rtp_packets_total": 2,
+    "net_rtp_packets_lost_total": 2, # 0: 视频轨道的分析线程, 1: 音频轨道的分析线程
+}
+
+# 流水线各阶段, 每个阶段一个耗时直方图, 只由一个进程写入
+STAGES = (
+    "demux",                 # RTSPStreamHandler: 从容器读取一个包
+    "video_decode",          # RTSPStreamHandler: 视频包解码
+    "audio_decode",          # RTSPStreamHandler: 音频包解码
+    "video_serialize",       # RTSPStreamHandler: serialize_video_frame
+    "audio_serialize",       # RTSPStreamHandler: serialize_audio_frame
+    "video_queue_transit",   # 进程间队列: 视频帧入队到被VideoAnalyProcesser取出
+    "video_deserialize",     # VideoAnalyProcesser: deserialize_video_frame
+    "analyze_frames",        # VideoAnalyProcesser: analyze_frames (每个窗口)
+    "video_srt_write",       # VideoAnalyProcesser: 写入Video-Status
+    "audio_queue_transit",   # 进程间队列: 音频帧入队到被AudioAnalyProcesser取出
+    "audio_deserialize",     # AudioAnalyProcesser: deserialize_audio_frame
+    "audio_analyze",         # AudioAnalyProcesser: process_frame
+)
+
+# 直方图: 以微秒为单位的对数分桶, 每倍频程4个桶, 覆盖1微秒到约16秒
+HIST_BINS_PER_OCTAVE = 4
+HIST_BINS = 24 * HIST_BINS_PER_OCTAVE
+HIST_SLOTS = HIST_BINS + 2  # 分桶计数 + 总次数 + 总耗时
+
+# 心跳: 各进程在主循环中写入当前时间(time.time()), 由主进程中的Supervisor检查
+PROCESSES = (
+    "RTSPForwarder",
+    "RTSPStreamHandler",
+    "TSFileHandler",
+    "NetAnalyProcesser",
+    "AudioAnalyProcesser",
+    "VideoAnalyProcesser",
+    "SpeechRecognizeProcesser",
+)
+
+# 分析延迟: 分析器 -> (解码端pts字段, 分析端pts字段)
+ANALYZER_LAG = {
+    "video": ("stream_video_pts_seconds", "video_analyzed_pts_seconds"),
+    "audio": ("stream_audio_pts_seconds", "audio_analyzed_pts_seconds"),
+    "speech": ("stream_audio_pts_seconds", "speech_processed_pts_seconds"),
+}
+
+
+def resident_bytes(pid):
+    """读取进程的常驻内存(字节), 仅Linux, 进程不存在或无法读取时返回None"""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+
+
+class StatsBlock:
+    """基于共享内存的统计块, 由主进程创建后传给各子进程
+    写入是对共享内存的直接赋值, 不经过任何IPC, 也不加锁: 每个槽只有一个写入线程,
+    有多个写入者的计数器(WRITERS)每个写入者各占一个槽, 否则 += 的读-改-写会互相覆盖丢失计数"""
+    def __init__(self, fields = FIELDS, stages = STAGES, processes = PROCESSES, writers = WRITERS):
+        self.fields = fields
+        self.stages = stages
+        self.index = {name: i for i, (name, _, _) in enumerate(fields)}  # 字段名 -> 下标
+        # 阶段名 -> 直方图在共享内存中的起始下标, 直方图区位于字段区之后
+        self.hist_index = {stage: len(fields) + i * HIST_SLOTS for i, stage in enumerate(stages)}
+        # 进程名 -> 心跳在共享内存中的下标, 心跳区位于直方图区之后
+        heartbeat_base = len(fields) + len(stages) * HIST_SLOTS
+        self.heartbeat_index = {process: heartbeat_base + i for i, process in enumerate(processes)}
+        # 字段名 -> 其余写入者的槽的起始下标(写入者0使用字段本身的槽), 位于心跳区之后
+        self.writer_index = {}
+        size = heartbeat_base + len(processes)
+        for name, count in writers.items():
+            if name in self.index:
+                self.writer_index[name] = size
+                size += count - 1
+        self.writer_slots = {name: [self.index[name]] + list(range(base, base + writers[name] - 1))
+                             for name, base in self.writer_index.items()}  # 字段名 -> 所有写入者的槽
+        self.array = multiprocessing.RawArray('d', size)  # 无锁共享内存
+
+    def inc(self, name, value = 1, writer = 0):
+        """计数器加值, 有多个写入者的计数器由writer指定写入者的序号"""
+        self.array[self.writer_index[name] + writer - 1 if writer else self.index[name]] += value
+
+    def set(self, name, value):
+        """设置仪表值"""
+        self.array[self.index[name]] = value
+
+    def get(self, name):
+        slots = self.writer_slots.get(name)
+        if slots:
+            return sum(self.array[slot] for slot in slots)
+        return self.array[self.index[name]]
+
+    def beat(self, process):
+        """写入进程心跳"""
+        self.array[self.heartbeat_index[process]] = time.time()
+
+    def heartbeat(self, process):
+        """返回进程最近一次心跳的时间, 尚未发出心跳时返回0"""
+        index = self.heartbeat_index.get(process)
+        return self.array[index] if index is not None else 0.0
+
+    def observe(self, stage, seconds):
+        """记录一次阶段耗时"""
+        base = self.hist_index[stage]
+        micros = seconds * 1e6
+        bin = int(math.log2(micros) * HIST_BINS_PER_OCTAVE) if micros > 1 else 0
+        self.array[base + min(bin, HIST_BINS - 1)] += 1
+        self.array[base + HIST_BINS] += 1
+        self.array[base + HIST_BINS + 1] += seconds
+
+    def stage_summary(self, stage):
+        """返回阶段耗时汇总 {count, mean, p50, p99}, 时间单位为秒, 分位数取所在分桶的几何中点"""
+        base = self.hist_index[stage]
+        bins = self.array[base:base + HIST_SLOTS]
+        count = bins[HIST_BINS]
+        if count == 0:
+            return {"count": 0, "mean": None, "p50": None, "p99": None}
+        summary = {"count": int(count), "mean": bins[HIST_BINS + 1] / count}
+        for name, q in (("p50", 0.5), ("p99", 0.99)):
+            target, cumulative = q * count, 0
+            for bin in range(HIST_BINS):
+                cumulative += bins[bin]
+                if cumulative >= target:
+                    summary[name] = 2 ** ((bin + 0.5) / HIST_BINS_PER_OCTAVE) / 1e6
+                    break
+        return summary
+
+    def snapshot(self):
+        """返回所有字段当前值的字典"""
+        values = self.array[:len(self.fields)]
+        snapshot = {name: values[i] for i, (name, _, _) in enumerate(self.fields)}
+        for name, slots in self.writer_slots.items():
+            snapshot[name] = sum(self.array[slot] for slot in slots)
+        return snapshot
+
+    def render_prometheus(self, queues = None, processes = None):
+        """按Prometheus文本格式输出所有指标
+        Args:
+            queues (dict): 队列名 -> 队列, 用于在抓取时输出队列深度
+            processes (dict): 进程名 -> 进程, 用于在抓取时输出各进程的常驻内存
+        """
+        values = self.snapshot()
+        lines = []
+        for name, kind, help_text in self.fields:
+            lines.append(f"# HELP rtsp_{name} {help_text}")
+            lines.append(f"# TYPE rtsp_{name} {kind}")
+            lines.append(f"rtsp_{name} {values[name]:g}")
+
+        lines.append("# HELP rtsp_analyzer_lag_seconds Media time the analyzer is behind the decoder")
+        lines.append("# TYPE rtsp_analyzer_lag_seconds gauge")
+        for analyzer, (decoded, analyzed) in ANALYZER_LAG.items():
+            lag = max(values[decoded] - values[analyzed], 0) if values[analyzed] else 0
+            lines.append(f'rtsp_analyzer_lag_seconds{{analyzer="{analyzer}"}} {lag:g}')
+
+        if queues:
+            lines.append("# HELP rtsp_queue_depth Items waiting in an inter-process queue")
+            lines.append("# TYPE rtsp_queue_depth gauge")
+            for queue_name, que in queues.items():
+                try:
+                    depth = que.qsize()
+                except (OSError, EOFError, NotImplementedError):
+                    continue
+                lines.append(f'rtsp_queue_depth{{queue="{queue_name}"}} {depth}')
+
+        lines.append("# HELP rtsp_process_heartbeat_age_seconds Seconds since a pipeline process last sent a heartbeat")
+        lines.append("# TYPE rtsp_process_heartbeat_age_seconds gauge")
+        now = time.time()
+        for process_name in self.heartbeat_index:
+            heartbeat = self.heartbeat(process_name)
+            if heartbeat:
+                lines.append(f'rtsp_process_heartbeat_age_seconds{{process="{process_name}"}} {now - heartbeat:.3f}')
+
+        if processes:
+            lines.append("# HELP rtsp_process_resident_bytes Resident memory of a pipeline process")
+            lines.append("# TYPE rtsp_process_resident_bytes gauge")
+            for process_name, process in processes.items():
+                rss = resident_bytes(process.pid) if process.pid else None
+                if rss is not None:
+                    lines.append(f'rtsp_process_resident_bytes{{process="{process_name}"}} {rss}')
+        return "\n".join(lines) + "\n"
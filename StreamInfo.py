@@ -0,0 +1,138 @@
+import json
+import time
+import multiprocessing
+from typing import NamedTuple
+from collections.abc import Mapping
+
+
+class StreamDescriptor(Mapping):
+    """不可变的流描述, 由RTSPStreamHandler在流打开后发布一次, 流参数变化时以新版本重新发布
+    键与原来的stream_info_dict相同(status, video, audio, video_sample_rate, ...), 另有各轨道的编码、时间基等"""
+    def __init__(self, values:dict, version:int = 0):
+        self._values = dict(values, version=version)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"StreamDescriptor({self._values})"
+
+    @property
+    def version(self):
+        return self._values["version"]
+
+
+class StreamGap(NamedTuple):
+    """断流造成的时间轴缺口, 由RTSPStreamHandler附在重连后每个轨道的第一帧上("gap"键), 消费者据此标记缺口
+    时间戳单位为该轨道的time_base"""
+    start_pts: int
+    end_pts: int
+
+
+class StreamChannel:
+    """流描述的广播通道, 代替Manager().dict(): 不经过manager服务进程
+    发布者将描述序列化为JSON写入共享内存并递增版本号, 通过条件变量唤醒所有等待者
+    消费者在本地缓存描述, 之后只比较共享内存中的版本号(一次内存读取)判断是否有更新"""
+    def __init__(self, capacity:int = 8192):
+        self.capacity = capacity
+        self.data = multiprocessing.RawArray('c', capacity)  # JSON编码的描述
+        self.header = multiprocessing.RawArray('q', 2)  # 版本号, 数据长度
+        self.condition = multiprocessing.Condition()
+        self.cached = None  # 本进程缓存的描述
+
+    @property
+    def version(self):
+        """当前发布的版本号, 0表示尚未发布"""
+        return self.header[0]
+
+    def publish(self, values:dict):
+        """发布新版本的流描述, 返回版本号"""
+        encoded = json.dumps(values).encode('utf-8')
+        if len(encoded) > self.capacity:
+            raise ValueError(f"Stream descriptor is {len(encoded)} bytes, channel capacity is {self.capacity}.")
+        with self.condition:
+            self.data[:len(encoded)] = encoded
+            self.header[1] = len(encoded)
+            self.header[0] += 1
+            self.condition.notify_all()
+            return self.header[0]
+
+    def get(self):
+        """返回最新的流描述, 版本未变化时直接返回本地缓存; 尚未发布时返回None"""
+        if self.cached is not None and self.cached.version == self.header[0]:
+            return self.cached
+        with self.condition:
+            version, length = self.header[0], self.header[1]
+            if version == 0:
+                return None
+            self.cached = StreamDescriptor(json.loads(self.data[:length].decode('utf-8')), version)
+        return self.cached
+
+    def changed(self, descriptor:StreamDescriptor):
+        """流描述在descriptor之后是否发布了新版本"""
+        return descriptor is None or self.header[0] != descriptor.version
+
+    def wait(self, after_version:int = 0, stop_event = None, timeout:float = None):
+        """等待版本号大于after_version的流描述发布, 收到停止事件或超时时返回None"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while self.header[0] <= after_version:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                remaining = deadline - time.monotonic() if deadline is not None else 0.5
+                if remaining <= 0:
+                    return None
+                self.condition.wait(min(remaining, 0.5))
+        return self.get()
+
+
+def publish_stream_info(stream_info, values:dict):
+    """发布流信息, stream_info可以是StreamChannel或(旧入口脚本中的)Manager字典"""
+    if isinstance(stream_info, StreamChannel):
+        stream_info.publish(values)
+    else:
+        stream_info.update(values)
+
+
+def publish_tracks(channel, tracks:list):
+    """发布一次会话中各轨道的初始化信息(中继从RTSP响应中解析, 进程内接入从第一个RTP包取得)
+    channel为StreamChannel时保留最新版本, 被Supervisor重启的NetAnalyProcesser可以重新读取;
+    为Pipe时(旧的入口脚本)逐个发送, 最后发送'start'"""
+    if isinstance(channel, StreamChannel):
+        channel.publish({"tracks": tracks})
+    else:
+        for track in tracks:
+            channel.send(track)
+        channel.send('start')
+
+
+def wait_for_stream(stream_info, stream_ready = None, stop_event = None, beat = None):
+    """等待RTSPStreamHandler打开流并发布流信息
+    stream_info为StreamChannel时等待广播; 为Manager字典时等待stream_ready事件, 没有事件时(旧的入口脚本)退回轮询
+    beat为等待期间每秒调用一次的心跳函数: 流迟迟不能打开时进程仍是健康的, 不被Supervisor当作启动后无响应
+    Returns:
+        Mapping: 流信息, 流打开前收到停止事件时返回None
+    """
+    if isinstance(stream_info, StreamChannel):
+        while True:
+            descriptor = stream_info.wait(stop_event=stop_event, timeout=1.0)
+            if descriptor is not None or (stop_event is not None and stop_event.is_set()):
+                return descriptor
+            if beat:
+                beat()
+    if stream_ready is None:
+        while stream_info['status'] == None:
+            time.sleep(0.01)
+        return stream_info
+    while not stream_ready.wait(0.5):
+        if stop_event is not None and stop_event.is_set():
+            return None
+        if beat:
+            beat()
+    return stream_info
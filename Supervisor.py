@@ -0,0 +1,101 @@
+import time
+import threading
+from Stats import StatsBlock
+
+
+class Supervisor(threading.Thread):
+    """流水线进程的监督线程, 运行在主进程中
+    各进程在主循环中写入心跳(StatsBlock.beat), 等待流信息时也保持心跳. 进程异常退出, 启动后startup_timeout秒内没有发出心跳,
+    或发出过心跳后超过heartbeat_timeout未再更新时, 终止该进程并以resume=True重新创建: 新进程接续原来的队列、结果文件和时间轴, 其余进程不受影响
+    同一进程连续重启时按指数退避, 稳定运行stable_seconds后退避清零"""
+    def __init__(self,
+                 factories:dict,
+                 stop_event,
+                 stats:StatsBlock,
+                 heartbeat_timeout:float = 15.0,
+                 startup_timeout:float = 60.0,
+                 check_interval:float = 1.0,
+                 restart_backoff:float = 1.0,
+                 max_restart_backoff:float = 30.0,
+                 stable_seconds:float = 60.0):
+        super().__init__(daemon=True)
+        self.factories = factories  # 进程名 -> 创建进程的函数, 参数resume表示是否接续之前的会话
+        self.stop_event = stop_event  # 停止事件, 设置后不再检查和重启
+        self.stats = stats  # 共享内存统计块, 读取各进程的心跳
+        self.heartbeat_timeout = heartbeat_timeout  # 心跳超时(秒), 应大于RTSP读取超时
+        self.startup_timeout = startup_timeout  # 启动后第一次心跳的超时(秒), 应大于加载语音模型的时间
+        self.check_interval = check_interval  # 检查间隔(秒)
+        self.restart_backoff = restart_backoff  # 第一次重启前的等待(秒)
+        self.max_restart_backoff = max_restart_backoff  # 重启等待的上限(秒)
+        self.stable_seconds = stable_seconds  # 运行超过该时长视为已恢复, 退避清零
+        self.processes = {}  # 进程名 -> 当前运行的进程, 重启时原地替换, 主进程和查询服务共用这个字典
+        self.started = {}  # 进程名 -> 当前进程的启动时间
+        self.failures = {}  # 进程名 -> 连续重启次数
+        self.pending = {}  # 进程名 -> 计划重启的时间
+
+    def start_processes(self):
+        """创建并启动所有进程: 按factories的逆序启动, 消费者先于转发器和流处理器"""
+        for name in reversed(list(self.factories)):
+            self.launch(name, resume=False)
+
+    def launch(self, name, resume):
+        """创建并启动一个进程"""
+        process = self.factories[name](resume)
+        process.start()
+        self.processes[name] = process
+        self.started[name] = time.time()
+        return process
+
+    def check(self, name, process):
+        """检查进程是否健康, 返回需要重启的原因, 健康时返回None"""
+        if not process.is_alive():
+            if process.exitcode == 0:
+                return None  # 正常退出(如流中没有该进程处理的轨道), 不重启
+            return f"exited with code {process.exitcode}"
+        heartbeat = self.stats.heartbeat(name)
+        now = time.time()
+        if heartbeat > self.started[name]:
+            if now - heartbeat > self.heartbeat_timeout:
+                return f"sent no heartbeat for {now - heartbeat:.0f} s"
+        elif now - self.started[name] > self.startup_timeout:
+            # 加载模型时尚未开始心跳, 给出较长的启动时间; 超过后视为卡在启动阶段
+            return f"sent no heartbeat {now - self.started[name]:.0f} s after start"
+        return None
+
+    def stop_process(self, process):
+        """终止不健康的进程, 不响应SIGTERM时强制结束"""
+        if process.is_alive():
+            process.terminate()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+        process.join()
+
+    def run(self):
+        """周期性检查所有进程, 按退避时间重启不健康的进程"""
+        while not self.stop_event.wait(self.check_interval):
+            now = time.time()
+            for name, process in list(self.processes.items()):
+                if name in self.pending:
+                    if now >= self.pending[name]:
+                        del self.pending[name]
+                        process = self.launch(name, resume=True)
+                        self.stats.inc("supervisor_restarts_total")
+                        print(f"Supervisor: restarted {name}, pid={process.pid}\r\n")
+                    continue
+                reason = self.check(name, process)
+                if reason is None:
+                    if now - self.started[name] > self.stable_seconds:
+                        self.failures[name] = 0
+                    continue
+                failures = self.failures.get(name, 0)
+                delay = min(self.restart_backoff * 2 ** failures, self.max_restart_backoff)
+                print(f"Supervisor: {name} (pid={process.pid}) {reason}, restarting in {delay:.1f} s\r\n")
+                self.stop_process(process)
+                self.failures[name] = failures + 1
+                self.pending[name] = now + delay
+
+    def join_processes(self):
+        """等待所有进程结束"""
+        for process in self.processes.values():
+            process.join()
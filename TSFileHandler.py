@@ -1,14 +1,82 @@
+from __future__ import annotations
 import os
-import av
+import math
 import time
+import struct
 import queue
 import threading
-import numpy as np
 import multiprocessing
+from collections import OrderedDict
+from Stats import StatsBlock
+from Profiler import install_profiler
+from LoadConfig import results_dir
+from StreamInfo import wait_for_stream
+from LazyImport import lazy_import
+
+av = lazy_import("av")
+np = lazy_import("numpy")
+
+TS_PACKET_SIZE = 188  # MPEG-TS包长
+
+
+class KeyframeIndex:
+    """录制文件的关键帧索引, 与录制文件并列(<文件名>.idx), 定长记录的二进制格式
+    文件头: magic(4字节 b'RKFI') + 版本(uint8)
+    记录: 段起始偏移(int64) + pts(int64) + 字节偏移(int64) + 秒数(double) + 墙上时间(double, 未知时为NaN)
+    每次打开录制文件(包括被Supervisor重启后追加)写入一条段记录(pts为SEGMENT, 字节偏移为段起始偏移, 墙上时间为打开时间),
+    之后每个视频关键帧一条: 编码pts及其秒数、关键帧在文件中的字节偏移和墙上时间.
+    记录定长且按写入顺序排列, ExportClip对索引二分查找, 导出耗时与录制长度无关
+    偏移取写入关键帧前文件的当前位置并按TS包对齐: 复用器还有未写出的缓冲, 因此是关键帧实际位置的下界"""
+    MAGIC = b'RKFI'
+    VERSION = 1
+    HEADER = struct.Struct('<4sB')
+    RECORD = struct.Struct('<qqqdd')
+    SEGMENT = -(1 << 63)  # 段记录的pts
+
+    def __init__(self, path, file, append = False, max_pending = 512):
+        self.file = file  # 录制文件, 读取当前写入位置
+        self.segment = file.tell()  # 本段在文件中的起始偏移, 段首是复用器写入的节目表
+        self.index_file = self.open(path, append)
+        self.wall_times = OrderedDict()  # 编码前的帧pts -> 墙上时间, 编码器有延迟, 关键帧输出时按pts查找
+        self.max_pending = max_pending
+        self.write(self.segment, self.SEGMENT, self.segment, math.nan, time.time())
+
+    def open(self, path, append):
+        """打开索引文件; 接续时去掉录制中断留下的不完整记录, 文件头不符(如旧格式)时重新建立"""
+        if append and os.path.exists(path):
+            index_file = open(path, 'r+b', buffering=0)
+            header = index_file.read(self.HEADER.size)
+            if header == self.HEADER.pack(self.MAGIC, self.VERSION):
+                size = os.path.getsize(path)
+                index_file.truncate(size - (size - self.HEADER.size) % self.RECORD.size)
+                index_file.seek(0, os.SEEK_END)
+                return index_file
+            index_file.close()
+        index_file = open(path, 'wb', buffering=0)
+        index_file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+        return index_file
+
+    def write(self, segment, pts, offset, seconds, wall_time):
+        self.index_file.write(self.RECORD.pack(segment, pts, offset, seconds, math.nan if wall_time is None else wall_time))
+
+    def remember(self, pts, wall_time):
+        """记录送入编码器的帧的墙上时间"""
+        self.wall_times[pts] = wall_time
+        if len(self.wall_times) > self.max_pending:
+            self.wall_times.popitem(last=False)
+
+    def add(self, packet):
+        """记录一个关键帧, 在复用该包之前调用"""
+        offset = self.segment + (self.file.tell() - self.segment) // TS_PACKET_SIZE * TS_PACKET_SIZE
+        self.write(self.segment, packet.pts, offset, float(packet.pts * packet.time_base), self.wall_times.get(packet.pts))
+
+    def close(self):
+        self.index_file.close()
+
 
 class StreamWriter(threading.Thread):
     """用于将音视频帧编码并写入容器的线程"""
-    def __init__(self, track_name, queue, stream, container, deserialize_func, rlock, stop_event):
+    def __init__(self, track_name, queue, stream, container, deserialize_func, rlock, stop_event, stats:StatsBlock, index:KeyframeIndex = None):
         super().__init__()
         self.track_name = track_name  # 轨道名称，如'audio'或'video'
         self.queue = queue  # 存储音视频帧数据的队列
@@ -17,20 +85,36 @@ class StreamWriter(threading.Thread):
         self.deserialize_func = deserialize_func  # 函数用于反序列化帧数据
         self.rlock = rlock  # 重入锁，用于同步写入容器
         self.stop_event = stop_event  # 停止事件，用于终止线程
+        self.stats = stats  # 共享内存统计块
+        self.index = index  # 关键帧索引, 仅视频轨道
         
 
     def run(self):
         """线程的执行函数，从队列中不断取出帧数据，编码后写入容器"""
+        encoded_name = f"record_{self.track_name}_frames_encoded_total"
+        fps_start, fps_count = time.monotonic(), 0
         while not self.stop_event.is_set():
             try:
                 data = self.queue.get_nowait()
                 frame = self.deserialize_func(data)
+                if self.index:
+                    self.index.remember(frame.pts, data.get("arrival_time") or data["enqueue_time"])
                 packet = self.stream.encode(frame)
+                self.stats.inc(encoded_name)
+                if self.track_name == 'video':
+                    fps_count += 1
+                    if time.monotonic() - fps_start >= 1:
+                        self.stats.set("record_video_encode_fps", fps_count / (time.monotonic() - fps_start))
+                        fps_start, fps_count = time.monotonic(), 0
                 with self.rlock:
+                    if self.index:
+                        for keyframe in packet:
+                            if keyframe.is_keyframe and keyframe.pts is not None:
+                                self.index.add(keyframe)
                     try:
                         self.container.mux(packet)
                     except Exception as e:
-                        pass
+                        self.stats.inc("record_mux_errors_total")
                         # 发生异常时可以选择记录或处理
                         # print(f"Exception while muxing {self.track_name} frame: {e}")
                         # 一般报错为 [error 22]， 帧数据错误，可能是网络丢包造成的
@@ -44,18 +128,24 @@ class TSFileHandler(multiprocessing.Process):
     def __init__(self, \
                 video_frame_que,\
                 audio_frame_que,\
-                stream_info_dict,\
+                stream_info,\
                 stop_event,\
-                path = None,):
+                path = None,\
+                stats:StatsBlock = None,\
+                stream_ready = None,\
+                resume = False,\
+                keyframe_interval = 2.0):
         super().__init__()
         self.frame_ques = {'video': video_frame_que, 'audio': audio_frame_que}  # 存储音视频帧的队列
-        self.stream_info_dict = stream_info_dict  # 包含流信息的字典
+        self.stream_info = stream_info  # 流信息(StreamChannel或Manager字典)
         self.stop_event = stop_event # 停止事件
-        script_dir = os.path.dirname(__file__)
-        dir = os.path.join(script_dir, 'results')
         path = path or 'output_stream.ts'
-        path = os.path.join(dir, path)
+        path = os.path.join(results_dir(), path)
         self.path = path # 输出文件的路径
+        self.stats = stats or StatsBlock() # 共享内存统计块
+        self.stream_ready = stream_ready # 使用Manager字典时, 流信息写入后设置的事件
+        self.resume = resume # 被Supervisor重启时为True, 接着已有的录制文件写入而不是覆盖
+        self.keyframe_interval = keyframe_interval # 关键帧间隔(秒), 决定导出片段起点的精度
     
 
     def deserialize_audio_frame(self, data):
@@ -81,28 +171,35 @@ class TSFileHandler(multiprocessing.Process):
     
     def run(self):
         """进程的主执行函数，初始化音视频流和编码器，启动编码线程"""
-        container = av.open(self.path, mode='w',format='mpegts')    
+        install_profiler("TSFileHandler")
+         # 等待流信息可用
+        stream_info = wait_for_stream(self.stream_info, self.stream_ready, self.stop_event,
+                                      beat=lambda: self.stats.beat("TSFileHandler"))
+        if stream_info is None:
+            return
+
+        # MPEG-TS可以直接拼接: 重启后以追加方式打开, 新的节目表和时间戳接在原有内容之后
+        file = open(self.path, 'ab' if self.resume else 'wb')
+        container = av.open(file, mode='w',format='mpegts')    
+        index = KeyframeIndex(self.path + '.idx', file, append=self.resume)
         video_stream = None
         audio_stream = None
         rlock = threading.RLock()
         stream_writers = []
 
-         # 等待流信息可用
-        while self.stream_info_dict['status'] == None:
-            time.sleep(0.01)
-
          # 根据流信息初始化视频和音频流
-        if self.stream_info_dict['video']:
-            video_stream = container.add_stream(codec_name='h264', rate=self.stream_info_dict["video_sample_rate"])
-            video_stream.width = self.stream_info_dict["video_width"]
-            video_stream.height = self.stream_info_dict["video_height"]
+        if stream_info['video']:
+            video_stream = container.add_stream(codec_name='h264', rate=stream_info["video_sample_rate"])
+            video_stream.width = stream_info["video_width"]
+            video_stream.height = stream_info["video_height"]
             video_stream.pix_fmt = 'yuv420p'
             video_stream.bit_rate = 3000000
-            stream_writers.append(StreamWriter('video', self.frame_ques['video'], video_stream, container, self.deserialize_video_frame, rlock, self.stop_event))
+            video_stream.codec_context.gop_size = max(1, round(self.keyframe_interval * (stream_info.get("video_fps") or 25)))
+            stream_writers.append(StreamWriter('video', self.frame_ques['video'], video_stream, container, self.deserialize_video_frame, rlock, self.stop_event, self.stats, index))
 
-        if self.stream_info_dict['audio']:    
-            audio_stream = container.add_stream(codec_name='aac', rate=self.stream_info_dict.get("sample_rate"))
-            stream_writers.append(StreamWriter('audio', self.frame_ques['audio'], audio_stream, container, self.deserialize_audio_frame, rlock, self.stop_event))
+        if stream_info['audio']:    
+            audio_stream = container.add_stream(codec_name='aac', rate=stream_info.get("sample_rate"))
+            stream_writers.append(StreamWriter('audio', self.frame_ques['audio'], audio_stream, container, self.deserialize_audio_frame, rlock, self.stop_event, self.stats))
             
 
 
@@ -111,6 +208,9 @@ class TSFileHandler(multiprocessing.Process):
     
         
         while not self.stop_event.is_set():
+            # 编码线程都在运行时才发送心跳, 线程异常退出后由Supervisor重启本进程
+            if all(sw.is_alive() for sw in stream_writers):
+                self.stats.beat("TSFileHandler")
             time.sleep(1)
         
         # 等待所有编码线程结束
@@ -118,6 +218,8 @@ class TSFileHandler(multiprocessing.Process):
             sw.join()
             
         container.close() # 关闭容器，完成文件写入
+        file.close()
+        index.close()
 
 
 
@@ -0,0 +1,242 @@
+import os
+import json
+import math
+import time
+import signal
+import queue
+import threading
+from array import array
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Trace import format_stage_report
+
+
+# 各级分辨率: (桶宽度秒数, 桶数量), 依次保留1小时的秒级、1天的分钟级和90天的小时级数据
+RESOLUTIONS = ((1, 3600), (60, 1440), (3600, 24 * 90))
+
+
+class MetricRing:
+    """单个指标的定长环形时间序列, 每个分辨率一段连续的array存储, 内存占用不随运行时间增长
+    每个桶记录: 桶起始时间, 样本数, 和, 最小值, 最大值"""
+    FIELDS = 5
+
+    def __init__(self, resolutions = RESOLUTIONS):
+        self.resolutions = resolutions
+        self.tiers = [array('d', [math.nan]) * (capacity * self.FIELDS) for _, capacity in resolutions]
+
+    def add(self, ts, value):
+        """添加一个样本, 同时汇总到各级分辨率"""
+        for tier, (step, capacity) in zip(self.tiers, self.resolutions):
+            bucket = ts // step
+            i = int(bucket % capacity) * self.FIELDS
+            start = bucket * step
+            if tier[i] != start:
+                # 桶已过期(或未使用), 用新样本覆盖
+                tier[i] = start
+                tier[i + 1] = 1
+                tier[i + 2] = value
+                tier[i + 3] = value
+                tier[i + 4] = value
+            else:
+                tier[i + 1] += 1
+                tier[i + 2] += value
+                tier[i + 3] = min(tier[i + 3], value)
+                tier[i + 4] = max(tier[i + 4], value)
+
+    def select_tier(self, start, resolution = None):
+        """选择分辨率: 指定时取对应级别, 否则取能覆盖起始时间的最细级别"""
+        if resolution is not None:
+            for index, (step, _) in enumerate(self.resolutions):
+                if step == resolution:
+                    return index
+            raise ValueError(f"Unsupported resolution: {resolution}")
+        now = time.time()
+        for index, (step, capacity) in enumerate(self.resolutions):
+            if now - start <= step * capacity:
+                return index
+        return len(self.resolutions) - 1
+
+    def query(self, start, end, resolution = None):
+        """返回时间范围内的桶 [(桶起始时间, 样本数, 均值, 最小值, 最大值), ...]"""
+        index = self.select_tier(start, resolution)
+        tier = self.tiers[index]
+        step, capacity = self.resolutions[index]
+        first = int(max(start // step, end // step - capacity + 1))
+        points = []
+        for bucket in range(first, int(end // step) + 1):
+            i = (bucket % capacity) * self.FIELDS
+            if tier[i] == bucket * step:
+                points.append((tier[i], int(tier[i + 1]), tier[i + 2] / tier[i + 1], tier[i + 3], tier[i + 4]))
+        return points
+
+    def aggregate(self, start, end, resolution = None):
+        """返回时间范围内的汇总值 {count, mean, min, max}"""
+        points = self.query(start, end, resolution)
+        count = sum(point[1] for point in points)
+        if count == 0:
+            return {"count": 0, "mean": None, "min": None, "max": None}
+        return {
+            "count": count,
+            "mean": sum(point[1] * point[2] for point in points) / count,
+            "min": min(point[3] for point in points),
+            "max": max(point[4] for point in points),
+        }
+
+
+class TimeSeriesStore:
+    """按(流, 指标)管理多个MetricRing, 供采集线程写入和查询接口读取"""
+    def __init__(self, resolutions = RESOLUTIONS):
+        self.resolutions = resolutions
+        self.rings = {}  # (流, 指标) -> MetricRing
+        self.lock = threading.Lock()
+
+    def add(self, stream, metric, ts, value):
+        with self.lock:
+            ring = self.rings.get((stream, metric))
+            if ring is None:
+                ring = self.rings[(stream, metric)] = MetricRing(self.resolutions)
+            ring.add(ts, value)
+
+    def series(self):
+        with self.lock:
+            return sorted(self.rings.keys())
+
+    def query(self, stream, metric, start, end, resolution = None):
+        with self.lock:
+            ring = self.rings.get((stream, metric))
+            return ring.query(start, end, resolution) if ring else []
+
+    def aggregate(self, stream, metric, start, end, resolution = None):
+        with self.lock:
+            ring = self.rings.get((stream, metric))
+            if ring is None:
+                return {"count": 0, "mean": None, "min": None, "max": None}
+            return ring.aggregate(start, end, resolution)
+
+
+class TimeSeriesCollector(threading.Thread):
+    """从样本队列中取出分析器推送的指标, 写入时间序列存储, 并交给关联引擎
+    队列元素: (流名称, 来源名称, 时间戳, {指标名: 数值}, (墙上时间轴上的开始, 结束))"""
+    def __init__(self, sample_que, store:TimeSeriesStore, stop_event, correlator = None):
+        super().__init__(daemon=True)
+        self.sample_que = sample_que
+        self.store = store  # 为None时不保存时间序列(只做关联)
+        self.stop_event = stop_event
+        self.correlator = correlator  # Correlation.Correlator, 为None时不做关联
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                stream, name, ts, metrics, (start, end) = self.sample_que.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break  # 管理器进程已退出
+            if self.store:
+                for key, value in metrics.items():
+                    if value is not None and math.isfinite(value):
+                        self.store.add(stream, f"{name}/{key}", ts, float(value))
+            if self.correlator:
+                self.correlator.add(name, start, end, metrics)
+        if self.correlator:
+            self.correlator.close()
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """本地查询接口
+    GET /series                                            列出所有(流, 指标)
+    GET /range?stream=&metric=&start=&end=&resolution=     返回时间范围内的桶
+    GET /aggregate?stream=&metric=&start=&end=&resolution= 返回时间范围内的汇总值
+    GET /metrics                                           Prometheus文本格式的流水线运行指标
+    GET /stages                                            各阶段耗时的p50/p99报告
+    GET /profile?process=&kind=stack|memory                向指定进程发送性能分析信号(见Profiler.py)
+    start/end为Unix时间戳, 负数表示相对当前时间的秒数(如start=-3600)"""
+
+    def log_message(self, format, *args):
+        pass  # 不在控制台输出访问日志
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, status, text, content_type = "text/plain; version=0.0.4; charset=utf-8"):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def parse_time(self, params, key, default):
+        value = float(params.get(key, [default])[0])
+        return time.time() + value if value <= 0 else value
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        store:TimeSeriesStore = self.server.store
+        try:
+            if url.path == "/metrics" and self.server.stats is not None:
+                self.send_text(200, self.server.stats.render_prometheus(self.server.queues, self.server.processes))
+                return
+            if url.path == "/stages" and self.server.stats is not None:
+                self.send_text(200, format_stage_report(self.server.stats) + "\n", "text/plain; charset=utf-8")
+                return
+            if url.path == "/profile" and self.server.processes and hasattr(signal, 'SIGUSR1'):
+                process = self.server.processes[params["process"][0]]
+                kind = params.get("kind", ["stack"])[0]
+                if kind not in ("stack", "memory"):
+                    raise ValueError(f"Unknown profile kind: {kind}")
+                os.kill(process.pid, signal.SIGUSR1 if kind == "stack" else signal.SIGUSR2)
+                self.send_json(200, {"process": params["process"][0], "pid": process.pid, "kind": kind})
+                return
+            if store is None:
+                self.send_json(404, {"error": "time series disabled"})
+                return
+            if url.path == "/series":
+                self.send_json(200, [{"stream": stream, "metric": metric} for stream, metric in store.series()])
+                return
+            if url.path in ("/range", "/aggregate"):
+                stream = params["stream"][0]
+                metric = params["metric"][0]
+                start = self.parse_time(params, "start", -3600)
+                end = self.parse_time(params, "end", 0)
+                resolution = int(params["resolution"][0]) if "resolution" in params else None
+                if url.path == "/range":
+                    points = store.query(stream, metric, start, end, resolution)
+                    self.send_json(200, [dict(zip(("ts", "count", "mean", "min", "max"), point)) for point in points])
+                else:
+                    self.send_json(200, store.aggregate(stream, metric, start, end, resolution))
+                return
+            self.send_json(404, {"error": "not found"})
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+
+
+class QueryServer(threading.Thread):
+    """在主进程中运行的本地HTTP查询服务
+    Args:
+        store (TimeSeriesStore): 时间序列存储, 为None时不提供时间序列查询
+        stats (StatsBlock): 共享内存统计块, 为None时不提供/metrics
+        queues (dict): 队列名 -> 队列, 抓取/metrics时输出队列深度
+        processes (dict): 进程名 -> 进程, 用于/profile
+    """
+    def __init__(self, store:TimeSeriesStore = None, host = '127.0.0.1', port = 12025, stats = None, queues = None, processes = None):
+        super().__init__(daemon=True)
+        self.server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+        # 请求处理器通过self.server访问以下对象
+        self.server.store = store
+        self.server.stats = stats
+        self.server.queues = queues
+        self.server.processes = processes
+
+    def run(self):
+        self.server.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
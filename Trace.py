@@ -0,0 +1,65 @@
+import os
+import json
+import time
+from collections import deque
+from Stats import StatsBlock
+from LoadConfig import CONFIG, results_dir
+
+
+class Tracer:
+    """阶段计时与采样追踪
+    每次计时都记入共享内存中的阶段直方图; 按pts采样的帧额外记录一条追踪span,
+    采样只由pts决定, 因此同一帧在各个进程中要么都被记录, 要么都不被记录"""
+    def __init__(self, stats:StatsBlock, name:str, sample_every:int = None, max_spans:int = 20000):
+        sample_every = sample_every or CONFIG.get("tracing", {}).get("sample_every", 100)
+        self.stats = stats  # 共享内存统计块
+        self.name = name  # 进程名称, 用于追踪文件命名
+        self.threshold = (1 << 32) // max(sample_every, 1)  # 采样阈值, 约每sample_every帧采样一帧
+        self.spans = deque(maxlen=max_spans)  # 采样到的span, 超出后丢弃最旧的
+
+    def sampled(self, pts):
+        """判断该pts对应的帧是否被采样(乘法哈希, 跨进程结果一致)"""
+        return pts is not None and (pts * 2654435761) % (1 << 32) < self.threshold
+
+    def record(self, stage, start, pts = None):
+        """记录一个阶段的耗时
+        Args:
+            stage (str): 阶段名称, 见Stats.STAGES
+            start (float): 阶段开始时的time.perf_counter()
+            pts (int): 帧的pts, 被采样时记录span
+        Returns:
+            float: 阶段耗时(秒)
+        """
+        duration = time.perf_counter() - start
+        self.stats.observe(stage, duration)
+        if self.sampled(pts):
+            self.spans.append((pts, stage, time.time() - duration, duration))
+        return duration
+
+    def record_duration(self, stage, duration, pts = None):
+        """记录一个已知耗时的阶段, 用于跨进程的阶段(如队列传输)"""
+        self.stats.observe(stage, duration)
+        if self.sampled(pts):
+            self.spans.append((pts, stage, time.time() - duration, duration))
+
+    def dump(self):
+        """将采样的span写入results/traces/<进程名>-<pid>.jsonl"""
+        if not self.spans:
+            return
+        path = os.path.join(results_dir('traces'), f"{self.name}-{os.getpid()}.jsonl")
+        with open(path, 'w', encoding='utf-8') as file:
+            for pts, stage, start, duration in self.spans:
+                file.write(json.dumps({"pts": pts, "stage": stage, "start": start, "duration": duration}) + "\n")
+
+
+def format_stage_report(stats:StatsBlock):
+    """生成各阶段耗时的p50/p99报告文本"""
+    lines = [f"{'stage':<22}{'count':>10}{'mean(ms)':>12}{'p50(ms)':>12}{'p99(ms)':>12}"]
+    for stage in stats.stages:
+        summary = stats.stage_summary(stage)
+        if summary["count"] == 0:
+            lines.append(f"{stage:<22}{0:>10}{'-':>12}{'-':>12}{'-':>12}")
+        else:
+            lines.append(f"{stage:<22}{summary['count']:>10}{summary['mean'] * 1000:>12.3f}"
+                         f"{summary['p50'] * 1000:>12.3f}{summary['p99'] * 1000:>12.3f}")
+    return "\n".join(lines)
@@ -0,0 +1,216 @@
+import os
+import json
+import mmap
+import time
+import argparse
+import tempfile
+import multiprocessing
+import av
+import webrtcvad
+from vosk import KaldiRecognizer
+from Srt import Srt
+from SpeechRecognize import load_model
+
+
+SAMPLE_RATE = 8000  # 转写使用的采样率, 与设备的G.711音频相同
+VAD_FRAME_SAMPLES = 240  # VAD帧长30ms
+BYTES_PER_SAMPLE = 2  # s16
+MAX_DRIFT = 0.1  # 帧的时间戳超前已写入的样本超过该值(秒)时视为缺口, 以静音补齐
+
+_model = None  # Vosk模型, fork前在父进程加载, 各工作进程通过写时复制共享同一份内存
+
+
+def init_worker():
+    """不支持fork的平台上工作进程无法继承父进程的模型, 各自加载一次"""
+    global _model
+    if _model is None:
+        _model = load_model()
+
+
+def extract_audio(path, pcm_path, vad_mode = 2):
+    """解码文件的音频流, 重采样为8kHz单声道s16写入pcm_path, 同时对每个30ms帧做语音活动检测
+    样本位置与AnalyzeFile的其他结果一致, 相对于文件的起始时间(container.start_time):
+    音频晚于文件起点开始、或中间有缺口(如断流、Supervisor重启后追加的录制)时按帧的时间戳以静音补齐
+    Returns:
+        (bytearray: 每个VAD帧是否为语音(0/1), int: 总样本数)
+    """
+    vad = webrtcvad.Vad(vad_mode)
+    flags = bytearray()
+    pending = b''  # 不足一个VAD帧的剩余数据
+    samples = 0
+    container = av.open(path)
+    if not container.streams.audio:
+        container.close()
+        raise ValueError(f"{path} has no audio stream.")
+    origin = container.start_time / av.time_base if container.start_time is not None else 0.0  # 文件起始时间(秒)
+    resampler = av.AudioResampler(format='s16', layout='mono', rate=SAMPLE_RATE)
+    frame_bytes = VAD_FRAME_SAMPLES * BYTES_PER_SAMPLE
+    with open(pcm_path, 'wb') as pcm:
+        def append(data):
+            nonlocal pending, samples
+            pcm.write(data)
+            samples += len(data) // BYTES_PER_SAMPLE
+            pending += data
+            offset = 0
+            while len(pending) - offset >= frame_bytes:
+                flags.append(vad.is_speech(pending[offset:offset + frame_bytes], SAMPLE_RATE))
+                offset += frame_bytes
+            pending = pending[offset:]
+
+        def write(frame):
+            if frame is not None and frame.time is not None:
+                gap = round((frame.time - origin) * SAMPLE_RATE) - samples
+                if gap > MAX_DRIFT * SAMPLE_RATE:
+                    # 以静音补齐到帧的时间戳, 每次最多1秒
+                    for begin in range(0, gap, SAMPLE_RATE):
+                        append(bytes(min(SAMPLE_RATE, gap - begin) * BYTES_PER_SAMPLE))
+            for resampled in resampler.resample(frame):
+                append(resampled.to_ndarray().tobytes())
+
+        for frame in container.decode(audio=0):
+            write(frame)
+        write(None)
+    container.close()
+    return flags, samples
+
+
+def find_segments(flags, min_silence = 0.5, max_segment = 30.0, padding = 0.3):
+    """按静音切分: 连续静音超过min_silence处断开, 语音段超过max_segment时强制断开, 全静音部分直接跳过
+    Returns:
+        list: [(开始样本, 结束样本)]
+    """
+    frame_seconds = VAD_FRAME_SAMPLES / SAMPLE_RATE
+    min_silence_frames = max(1, int(min_silence / frame_seconds))
+    max_segment_frames = max(1, int(max_segment / frame_seconds))
+    pad = int(padding / frame_seconds)
+    segments = []
+    start = None
+    last_speech = None
+    silence = 0
+    for index, speech in enumerate(flags):
+        if speech:
+            if start is None:
+                start = max(0, index - pad)
+            last_speech = index
+            silence = 0
+        elif start is not None:
+            silence += 1
+            if silence >= min_silence_frames:
+                segments.append((start, min(len(flags), last_speech + 1 + pad)))
+                start = None
+        if start is not None and index + 1 - start >= max_segment_frames:
+            segments.append((start, index + 1))
+            start, last_speech = index + 1, index
+    if start is not None:
+        segments.append((start, min(len(flags), last_speech + 1 + pad)))
+    return [(begin * VAD_FRAME_SAMPLES, end * VAD_FRAME_SAMPLES) for begin, end in segments if end > begin]
+
+
+def batch_segments(segments, batch_seconds = 60.0):
+    """将语音段合并为任务, 每个任务包含约batch_seconds的音频, 减少进程间调度开销"""
+    batches, batch, length = [], [], 0
+    for begin, end in segments:
+        batch.append((begin, end))
+        length += end - begin
+        if length >= batch_seconds * SAMPLE_RATE:
+            batches.append(batch)
+            batch, length = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def transcribe_segments(args):
+    """在工作进程中转写一组语音段, 时间戳换算为全局样本数
+    每段使用新的识别器: 识别结果中的时间相对于识别器收到的第一个样本
+    Returns:
+        list: [(开始样本, 结束样本, 文本)]
+    """
+    pcm_path, segments = args
+    entries = []
+    with open(pcm_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as pcm:
+        for begin, end in segments:
+            recognizer = KaldiRecognizer(_model, SAMPLE_RATE)
+            recognizer.SetWords(True)
+            results = []
+            for offset in range(begin, end, 4000):
+                chunk = pcm[offset * BYTES_PER_SAMPLE:min(offset + 4000, end) * BYTES_PER_SAMPLE]
+                if recognizer.AcceptWaveform(chunk):
+                    results.append(json.loads(recognizer.Result()))
+            results.append(json.loads(recognizer.FinalResult()))
+            for result in results:
+                if not result.get('text'):
+                    continue
+                words = result.get('result') or []
+                start = begin + int(words[0]['start'] * SAMPLE_RATE) if words else begin
+                stop = begin + int(words[-1]['end'] * SAMPLE_RATE) if words else end
+                entries.append((start, stop, result['text']))
+    return entries
+
+
+def transcribe_file(path, workers = None, name = None, min_silence = 0.5, max_segment = 30.0):
+    """批量转写录制文件中的音频: VAD按静音切分, 进程池并行识别, 按全局时间戳合并为一个SRT
+    Args:
+        path (str): 录音/录像文件路径
+        workers (int): 工作进程数, 默认为CPU核数
+        name (str): 结果文件名(不含扩展名), 默认为 <输入文件名>-Speech-Text
+        min_silence (float): 视为分段边界的最短静音(秒)
+        max_segment (float): 单个语音段的最长时长(秒)
+    Returns:
+        dict: 转写统计
+    """
+    global _model
+    workers = workers or os.cpu_count() or 1
+    name = name or f"{os.path.splitext(os.path.basename(path))[0]}-Speech-Text"
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        pcm_path = os.path.join(tmp, 'audio.pcm')
+        flags, samples = extract_audio(path, pcm_path)
+        segments = find_segments(flags, min_silence, max_segment)
+        batches = batch_segments(segments)
+        extract_seconds = time.perf_counter() - start
+
+        # fork时工作进程直接继承父进程已加载的模型(写时复制, 只占一份内存), 否则各进程自行加载
+        if 'fork' in multiprocessing.get_all_start_methods():
+            _model = load_model()
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        entries = []
+        if batches:
+            with context.Pool(min(workers, len(batches)), initializer=init_worker) as pool:
+                for batch_entries in pool.imap_unordered(transcribe_segments, [(pcm_path, batch) for batch in batches]):
+                    entries.extend(batch_entries)
+
+    srt = Srt(name, SAMPLE_RATE, store=False)
+    for entry_start, entry_end, text in sorted(entries):
+        srt.write_srt(text, entry_start, entry_end)
+    srt.close()
+    elapsed = time.perf_counter() - start
+    speech_samples = sum(end - begin for begin, end in segments)
+    return {
+        "path": srt.path,
+        "media_seconds": samples / SAMPLE_RATE,
+        "speech_seconds": speech_samples / SAMPLE_RATE,
+        "segments": len(segments),
+        "entries": len(entries),
+        "extract_seconds": extract_seconds,
+        "elapsed_seconds": elapsed,
+        "speedup": samples / SAMPLE_RATE / elapsed if elapsed else 0,
+    }
+
+
+# 用法: python TranscribeFile.py results/output_stream.ts --workers 16
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch transcription of recorded audio, split at silence and recognized in parallel.")
+    parser.add_argument("file", help="recorded audio or video file")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--name", default=None, help="result file name without extension (default: <file>-Speech-Text)")
+    parser.add_argument("--min-silence", type=float, default=0.5, help="shortest silence treated as a segment boundary (s)")
+    parser.add_argument("--max-segment", type=float, default=30.0, help="longest segment before a forced split (s)")
+    args = parser.parse_args()
+
+    result = transcribe_file(args.file, args.workers, args.name, args.min_silence, args.max_segment)
+    print(f"Transcribed {result['media_seconds']:.1f} s of audio ({result['speech_seconds']:.1f} s speech in "
+          f"{result['segments']} segments) in {result['elapsed_seconds']:.1f} s, {result['speedup']:.1f}x real time")
+    print(f"{result['entries']} entries written to {result['path']}")
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import queue
+import timeit
+import struct
+import platform
+import argparse
+import threading
+import subprocess
+from fractions import Fraction
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import av
+import numpy as np
+from RTP import RTP
+from Srt import NullSrt
+from Forwarder import ServerPacketHandler
+from AnalyzeNet import NetAnalyzerForEachTrack, SharedValue
+from AnalyzeVideo import VideoAnalyzer, FrameFaultDetector, DataHandler as VideoDataHandler
+from AnalyzeAudio import AudioAnalyzer, DataHandler as AudioDataHandler
+from RTSPStreamHandler import RTSPStreamHandler
+from TSFileHandler import TSFileHandler
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hotpath_baseline.json')
+RESOLUTIONS = {"720p": (1280, 720), "1080p": (1920, 1080), "4k": (3840, 2160)}
+AUDIO_RATE = 8000  # 设备的G.711音频为8kHz
+AUDIO_SAMPLES = 160  # 20ms一帧
+VIDEO_RTP_SIZE = 1400  # 视频RTP包大小(FU-A分片后的典型值)
+AUDIO_RTP_SIZE = 172  # G.711 20ms RTP包大小(12字节头部 + 160字节载荷)
+
+
+def synthetic_video_frame(width, height, seed = 0):
+    """生成带有渐变和噪声的yuv420p视频帧, 既有平坦区域也有纹理区域"""
+    rng = np.random.default_rng(seed)
+    y = (np.add.outer(np.arange(height), np.arange(width)) % 256).astype(np.uint8)
+    y[:height // 2] = rng.integers(0, 256, (height // 2, width), dtype=np.uint8)
+    uv = np.full((height // 2, width), 128, dtype=np.uint8)
+    frame = av.VideoFrame.from_ndarray(np.vstack([y, uv]), format="yuv420p")
+    frame.pts = 0
+    frame.time_base = Fraction(1, 90000)
+    return frame
+
+
+def synthetic_audio_frame(pts = 0, seed = 0):
+    """生成一帧8kHz单声道s16音频(正弦语音段叠加噪声)"""
+    rng = np.random.default_rng(seed)
+    t = (np.arange(AUDIO_SAMPLES) + pts) / AUDIO_RATE
+    samples = 8000 * np.sin(2 * np.pi * 440 * t) + rng.normal(0, 300, AUDIO_SAMPLES)
+    frame = av.AudioFrame.from_ndarray(samples.astype(np.int16).reshape(1, -1), format='s16', layout='mono')
+    frame.sample_rate = AUDIO_RATE
+    frame.pts = pts
+    frame.time_base = Fraction(1, AUDIO_RATE)
+    return frame
+
+
+def rtp_header(payload_type, seq, timestamp, ssrc, marker = False):
+    return struct.pack('!BBHII', 0x80, (0x80 if marker else 0) | payload_type, seq & 0xFFFF, timestamp & 0xFFFFFFFF, ssrc)
+
+
+def interleaved_chunk(size = 4096):
+    """生成一次TCP读取的数据: 交错的视频(channel 0)和音频(channel 2)RTP包, 总长度不超过size"""
+    chunk = b''
+    seq = 0
+    while True:
+        channel, length, payload_type = (2, AUDIO_RTP_SIZE, 8) if seq % 4 == 3 else (0, VIDEO_RTP_SIZE, 96)
+        packet = rtp_header(payload_type, seq, seq * 3000, 0x1234) + bytes(length - 12)
+        framed = b'$' + bytes([channel]) + struct.pack('!H', length) + packet
+        if len(chunk) + len(framed) > size:
+            return chunk, seq
+        chunk += framed
+        seq += 1
+
+
+class Case:
+    """一个基准测试用例: fn每次调用处理units个单位(帧/包), 结果记为单位耗时"""
+    def __init__(self, name, fn, number, units = 1):
+        self.name = name
+        self.fn = fn
+        self.number = number
+        self.units = units
+
+
+def video_cases(resolutions):
+    analyzer = VideoAnalyzer(25, queue.Queue(), threading.Event(), srt=NullSrt())
+    cases = []
+    for label in resolutions:
+        width, height = RESOLUTIONS[label]
+        frame = synthetic_video_frame(width, height)
+        serialized = RTSPStreamHandler.serialize_video_frame(None, frame)
+        number = 2 if label == "4k" else 5
+        cases += [
+            Case(f"video.mosaic_ratio[{label}]", lambda f=frame: analyzer.estimate_mosaic_ratio(f), number),
+            Case(f"video.green_ratio[{label}]", lambda f=frame: analyzer.estimate_green_ratio(f), number),
+            Case(f"video.faults[{label}]", lambda f=frame, d=FrameFaultDetector(): d.update(f), 200),
+            Case(f"video.serialize[{label}]", lambda f=frame: RTSPStreamHandler.serialize_video_frame(None, f), number),
+            Case(f"video.deserialize.record[{label}]", lambda d=serialized: TSFileHandler.deserialize_video_frame(None, d), number),
+            Case(f"video.deserialize.analyze[{label}]", lambda d=serialized: VideoDataHandler.deserialize_video_frame(None, d), number),
+        ]
+    return cases
+
+
+def audio_cases():
+    analyzer = AudioAnalyzer(AUDIO_RATE, queue.Queue(), threading.Event(), srt=NullSrt())
+    frames = [synthetic_audio_frame(i * AUDIO_SAMPLES, i) for i in range(50)]
+    serialized = RTSPStreamHandler.serialize_audio_frame(None, frames[0])
+    counter = iter(range(1 << 62))
+
+    def process():
+        # 循环使用50帧的数据, 但pts一直递增, 这样每0.45秒会走一次写结果的分支, 不会被当作时间戳回退
+        index = next(counter)
+        frame = frames[index % len(frames)]
+        frame.pts = index * AUDIO_SAMPLES
+        analyzer.process_frame(frame)
+
+    return [
+        Case("audio.process_frame", process, 500),
+        Case("audio.serialize", lambda: RTSPStreamHandler.serialize_audio_frame(None, frames[0]), 2000),
+        Case("audio.deserialize.record", lambda: TSFileHandler.deserialize_audio_frame(None, serialized), 2000),
+        Case("audio.deserialize.analyze", lambda: AudioDataHandler.deserialize_audio_frame(None, serialized), 2000),
+    ]
+
+
+def speech_cases():
+    """需要Vosk及其模型, 不可用时跳过"""
+    try:
+        from SpeechRecognize import SpeechRecognizer, load_model
+        model = load_model()
+    except Exception as e:
+        print(f"Skipping speech benchmarks: {e}")
+        return []
+    recognizer = SpeechRecognizer(AUDIO_RATE, queue.Queue(), threading.Event(), model, srt=NullSrt())
+    recognizer.recognizer = recognizer.init_recognizer(AUDIO_RATE)
+    frames = [synthetic_audio_frame(i * AUDIO_SAMPLES, i) for i in range(50)]
+    counter = iter(range(1 << 62))
+
+    def process():
+        index = next(counter)
+        frame = frames[index % len(frames)]
+        frame.pts = index * AUDIO_SAMPLES
+        recognizer.process_frame(frame)
+
+    return [Case("speech.process_frame", process, 200)]
+
+
+def net_cases():
+    init_data = {"type": "video", "track_id": 0, "ssrc": 0x1234, "sample_rate": 90000, "init_seq": 0, "init_timestamp": 0}
+    analyzer = NetAnalyzerForEachTrack(init_data, queue.Queue(), SharedValue(), threading.Event(), srt=NullSrt())
+    state = {"seq": 0, "time": time.time()}
+
+    def handle():
+        # 30fps视频, 每帧4个包, 偶尔丢包
+        state["seq"] += 2 if state["seq"] % 1000 == 999 else 1
+        state["time"] += 1 / 120
+        seq = state["seq"]
+        analyzer.rtp_packet_handler(RTP((rtp_header(96, seq, (seq // 4) * 3000, 0x1234), state["time"])))
+
+    header = rtp_header(96, 1, 3000, 0x1234)
+    arrival = time.time()
+    return [
+        Case("rtp.from_bytes", lambda: RTP((header, arrival)), 20000),
+        Case("net.rtp_packet_handler", handle, 20000),
+    ]
+
+
+def relay_cases():
+    handler = ServerPacketHandler(None, None, threading.Event(), queue.SimpleQueue(), None)
+    handler.init_info = [{"type": "video"}, {"type": "audio"}]
+    chunk, packets = interleaved_chunk()
+
+    def handle():
+        handler.recv_time = time.time()
+        handler.recv_len = len(chunk)
+        handler.data_handler(chunk)
+        handler.buffer = b''
+        handler.rtp_queue = queue.SimpleQueue()
+
+    return [Case("relay.data_handler[4096B]", handle, 2000, units=packets)]
+
+
+def collect_cases(args):
+    cases = video_cases(args.resolutions) + audio_cases() + net_cases() + relay_cases()
+    if not args.skip_speech:
+        cases += speech_cases()
+    if args.filter:
+        cases = [case for case in cases if args.filter in case.name]
+    return cases
+
+
+def run_cases(cases, repeat):
+    """每个用例取repeat次中最快的一次, 返回 {用例名: 单位耗时(秒)}"""
+    results = {}
+    for case in cases:
+        case.fn()  # 预热
+        timings = timeit.repeat(case.fn, number=case.number, repeat=repeat)
+        results[case.name] = min(timings) / case.number / case.units
+        print(f"  {case.name:<36}{format_seconds(results[case.name]):>12}")
+    return results
+
+
+def format_seconds(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_info():
+    return {"node": platform.node(), "machine": platform.machine(), "python": platform.python_version(), "cpus": os.cpu_count()}
+
+
+def compare(results, baseline, tolerance):
+    """与基线比较, 返回变慢超过容差的用例列表"""
+    regressions = []
+    if baseline.get("machine") != machine_info():
+        print(f"Warning: baseline was recorded on {baseline.get('machine')}, timings may not be comparable.")
+    print(f"\nCompared with {baseline.get('version')} (tolerance {tolerance * 100:.0f} %):")
+    for name, value in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"  {name:<36}{'new':>12}")
+            continue
+        change = (value - old) / old
+        flag = "  REGRESSION" if change > tolerance else ""
+        print(f"  {name:<36}{format_seconds(old):>12} -> {format_seconds(value):>12} ({change * 100:+.1f} %){flag}")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def save_baseline(path, results):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({"version": git_version(), "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   "machine": machine_info(), "results": results}, file, indent=2)
+    print(f"Baseline written to {path}")
+
+
+# 基线记录的是单位耗时, 只在录制它的机器上有意义, 因此不随仓库提交:
+# 在作为参考的机器(CI runner或固定的测试机)上第一次运行时先用 --update-baseline 录制,
+# 之后在同一台机器上不带参数运行即可检测回归; 换机器后需要重新录制
+# 用法: python benchmarks/BenchHotPaths.py --update-baseline  # 第一步: 录制(或更新)本机的基线
+#       python benchmarks/BenchHotPaths.py                    # 与本机基线比较, 没有基线时报错
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the per-frame and per-packet hot paths.")
+    parser.add_argument("--resolutions", nargs="+", default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument("--filter", default=None, help="only run cases whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repetitions, the fastest one is kept")
+    parser.add_argument("--skip-speech", action="store_true", help="skip the Vosk benchmark (loads the model)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing (0.25 = 25 %%)")
+    parser.add_argument("--update-baseline", action="store_true", help="overwrite the baseline with this run")
+    parser.add_argument("--output", default=None, help="write this run's results to a JSON file")
+    args = parser.parse_args()
+
+    print("Running hot path benchmarks (time per frame/packet, best of runs):")
+    results = run_cases(collect_cases(args), args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({"version": git_version(), "machine": machine_info(), "results": results}, file, indent=2)
+
+    if args.update_baseline:
+        save_baseline(args.baseline, results)
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        # 没有基线时不能静默通过, 否则CI中基线丢失后回归永远检测不到
+        print(f"Error: baseline {args.baseline} not found. Baselines are machine specific and not committed; "
+              f"record one on this machine first with --update-baseline.")
+        sys.exit(2)
+    with open(args.baseline, encoding='utf-8') as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,231 @@
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SyntheticSource import SyntheticRTSPServer, add_source_arguments, source_options
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# 吞吐量统计: 结果名 -> /metrics中的计数器
+THROUGHPUT = {
+    "relay_rtp_packets_per_s": "rtsp_relay_rtp_packets_total",
+    "demux_packets_per_s": "rtsp_stream_packets_demuxed_total",
+    "decode_video_fps": "rtsp_stream_video_frames_decoded_total",
+    "decode_audio_fps": "rtsp_stream_audio_frames_decoded_total",
+    "encode_video_fps": "rtsp_record_video_frames_encoded_total",
+    "analyze_video_fps": "rtsp_video_frames_analyzed_total",
+    "analyze_audio_fps": "rtsp_audio_frames_analyzed_total",
+    "speech_fps": "rtsp_speech_frames_processed_total",
+    "net_rtp_packets_per_s": "rtsp_net_rtp_packets_processed_total",
+}
+
+
+def scrape_metrics(port):
+    """抓取主进程的/metrics, 返回 {指标名(含标签): 数值}"""
+    text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2).read().decode()
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+def child_pids(pid):
+    """返回进程的所有后代进程(读取/proc, 仅Linux)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as file:
+                    fields = file.read().rsplit(')', 1)[1].split()
+                children.setdefault(int(fields[1]), []).append(int(entry))
+            except OSError:
+                continue
+    result, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def process_usage(pid):
+    """返回 (CPU时间(秒), 常驻内存(KiB)), 进程已退出时返回None"""
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as file:
+            rss = int(re.search(r"VmRSS:\s+(\d+)", file.read()).group(1))
+    except (OSError, AttributeError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, rss
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    server = SyntheticRTSPServer('127.0.0.1', args.port, **source_options(args))
+    server.start()
+
+    # 以仓库的配置为基础, 将RTSP地址指向本地测试源
+    with open(os.path.join(REPO_DIR, 'config.json'), encoding='utf-8') as file:
+        config = json.load(file)
+    config['rtsp_url'] = f"rtsp://127.0.0.1:{args.port}/stream"
+    config.setdefault('timeseries', {})['port'] = args.metrics_port
+    # 录制文件、结果文件和事故记录写入临时目录, 不覆盖实时分析的results
+    results = tempfile.TemporaryDirectory(prefix='bench-results-')
+    config['results_dir'] = results.name
+    config.setdefault('metric_store', {})['path'] = None
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(config, config_file)
+    config_file.close()
+
+    env = dict(os.environ, RTSP_CONFIG=config_file.name, PYTHONUNBUFFERED='1')
+    main = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, args.main)], cwd=REPO_DIR, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    names = {}  # pid -> 进程名
+    started = threading.Event()
+
+    def read_output():
+        for line in main.stdout:
+            if args.verbose:
+                sys.stdout.write(line)
+            match = re.search(r"Process PIDs: (.*)", line)
+            if match:
+                for item in match.group(1).split(', '):
+                    name, pid = item.split('=')
+                    names[int(pid)] = name
+            if "Press 'Enter' to stop" in line:
+                started.set()
+    threading.Thread(target=read_output, daemon=True).start()
+
+    start_time = time.monotonic()
+    if not started.wait(args.startup_timeout):
+        main.kill()
+        server.shutdown()
+        results.cleanup()
+        raise RuntimeError("Pipeline did not start.")
+    startup_seconds = time.monotonic() - start_time
+    time.sleep(args.warmup)
+
+    def sample():
+        pids = child_pids(main.pid) + [main.pid]
+        return time.monotonic(), scrape_metrics(args.metrics_port), {pid: process_usage(pid) for pid in pids}
+
+    first = sample()
+    peak_lag, peak_depth = {}, {}
+    rss_series = {}
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        now, metrics, usage = sample()
+        for name, value in metrics.items():
+            if name.startswith('rtsp_analyzer_lag_seconds'):
+                peak_lag[name] = max(peak_lag.get(name, 0), value)
+            if name.startswith('rtsp_queue_depth'):
+                peak_depth[name] = max(peak_depth.get(name, 0), value)
+        for pid, value in usage.items():
+            if value:
+                rss_series.setdefault(pid, []).append(value[1])
+    last = sample()
+
+    main.stdin.write("\n")
+    main.stdin.flush()
+    try:
+        main.wait(args.shutdown_timeout)
+    except subprocess.TimeoutExpired:
+        main.kill()
+    server.shutdown()
+    os.unlink(config_file.name)
+    results.cleanup()
+
+    elapsed = last[0] - first[0]
+    processes = {}
+    for pid, end in last[2].items():
+        begin = first[2].get(pid)
+        if not begin or not end:
+            continue
+        name = names.get(pid, 'main' if pid == main.pid else f'helper-{pid}')
+        series = rss_series.get(pid, [end[1]])
+        processes[name] = {
+            "cpu_pct": (end[0] - begin[0]) / elapsed * 100,
+            "rss_start_kib": begin[1],
+            "rss_end_kib": end[1],
+            "rss_growth_kib_per_min": (series[-1] - series[0]) / elapsed * 60 if len(series) > 1 else 0,
+        }
+    return {
+        "version": git_version(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "source": source_options(args),
+        "duration_s": elapsed,
+        "startup_s": startup_seconds,
+        "time_to_first_frame_s": last[1].get("rtsp_stream_first_frame_seconds"),
+        "throughput": {key: (last[1].get(metric, 0) - first[1].get(metric, 0)) / elapsed for key, metric in THROUGHPUT.items()},
+        # 找不到线上到达时间的帧的比例, 测试源发送RTCP SR, FFmpeg按SR重新对齐pts后仍应接近0
+        "arrival_miss_ratio": {track: arrival_miss_ratio(first[1], last[1], track) for track in ('video', 'audio')},
+        "peak_analyzer_lag_s": peak_lag,
+        "peak_queue_depth": peak_depth,
+        "processes": processes,
+    }
+
+
+def arrival_miss_ratio(first, last, track):
+    """测量期间解码的帧中找不到线上到达时间的比例"""
+    decoded = last.get(f"rtsp_stream_{track}_frames_decoded_total", 0) - first.get(f"rtsp_stream_{track}_frames_decoded_total", 0)
+    misses = last.get(f"rtsp_stream_{track}_arrival_misses_total", 0) - first.get(f"rtsp_stream_{track}_arrival_misses_total", 0)
+    return misses / decoded if decoded else None
+
+
+def compare(result, baseline_path):
+    """与之前保存的结果对比吞吐量和CPU占用"""
+    with open(baseline_path, encoding='utf-8') as file:
+        baseline = json.load(file)
+    print(f"\nCompared with {baseline.get('version')} ({baseline_path}):")
+    for key, value in result["throughput"].items():
+        old = baseline["throughput"].get(key)
+        if old:
+            print(f"  {key:<26}{old:>10.2f} -> {value:>10.2f} ({(value - old) / old * 100:+.1f} %)")
+    for name, usage in result["processes"].items():
+        old = baseline["processes"].get(name)
+        if old:
+            print(f"  cpu {name:<22}{old['cpu_pct']:>9.1f}% -> {usage['cpu_pct']:>9.1f}%")
+
+
+# 用法: python benchmarks/BenchPipeline.py --width 1920 --height 1080 --fps 30 --duration 60 --output results.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark against a local synthetic RTSP source.")
+    add_source_arguments(parser)
+    parser.add_argument("--main", default="main.0.3.0.py", help="pipeline entry point relative to the repository")
+    parser.add_argument("--duration", type=float, default=30, help="measurement duration in seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds to wait after the stream starts")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--shutdown-timeout", type=float, default=30)
+    parser.add_argument("--metrics-port", type=int, default=12025)
+    parser.add_argument("--output", default=None, help="write the JSON result to this file")
+    parser.add_argument("--compare", default=None, help="previous JSON result to compare against")
+    parser.add_argument("--verbose", action="store_true", help="echo pipeline output")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=2)
+    if args.compare:
+        compare(result, args.compare)
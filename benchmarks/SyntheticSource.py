@@ -0,0 +1,409 @@
+import os
+import re
+import sys
+import time
+import base64
+import random
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+import numpy as np
+import av
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from RTP import NTP_EPOCH_OFFSET
+
+
+MTU = 1400  # 单个RTP包的最大载荷长度
+RTP_HEADER = struct.Struct('!BBHII')
+SENDER_REPORT = struct.Struct('!BBHIIIIII')  # RTCP SR: 头部, SSRC, NTP时间, RTP时间戳, 发送的包数和字节数
+VIDEO_CLOCK = 90000  # H.264的RTP时钟频率
+
+
+def split_annexb(data:bytes):
+    """将Annex-B格式的H.264数据按起始码拆分为NAL单元"""
+    nals = []
+    for part in re.split(b'\x00\x00\x01', data):
+        part = part.rstrip(b'\x00')
+        if part:
+            nals.append(part)
+    return nals
+
+
+def packetize_h264(access_unit:bytes):
+    """按RFC 6184将一个访问单元打包为RTP载荷列表, 超过MTU的NAL使用FU-A分片"""
+    payloads = []
+    for nal in split_annexb(access_unit):
+        if len(nal) <= MTU:
+            payloads.append(nal)
+            continue
+        indicator = (nal[0] & 0xE0) | 28
+        nal_type = nal[0] & 0x1F
+        body = nal[1:]
+        for offset in range(0, len(body), MTU):
+            start = 0x80 if offset == 0 else 0
+            end = 0x40 if offset + MTU >= len(body) else 0
+            payloads.append(bytes([indicator, start | end | nal_type]) + body[offset:offset + MTU])
+    return payloads
+
+
+def packetize_aac(access_unit:bytes):
+    """按RFC 3640(AAC-hbr)打包一个AAC访问单元: AU-headers-length + AU-header(13位长度, 3位索引)"""
+    return [struct.pack('!HH', 16, len(access_unit) << 3) + access_unit]
+
+
+class MediaLoop:
+    """预先编码一段合成(或录制的)音视频并打包为RTP载荷, 推流时循环播放, 避免源端编码成为瓶颈
+    frames: [(媒体类型, 以RTP时钟计的时间戳, [载荷, ...]), ...], 按时间排序"""
+    def __init__(self, width = 1280, height = 720, fps = 25, bitrate = 2000000,
+                 audio_codec = 'pcma', loop_seconds = 10, input_path = None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.bitrate = bitrate
+        self.audio_codec = audio_codec
+        self.audio_rate = 8000 if audio_codec in ('pcma', 'pcmu') else 16000
+        self.loop_seconds = loop_seconds
+        self.sps = None
+        self.pps = None
+        self.audio_config = None  # AAC的AudioSpecificConfig
+        self.frames = []
+        if input_path:
+            self.load_recording(input_path)
+        else:
+            self.encode_video()
+        self.encode_audio()
+        self.frames.sort(key=lambda item: item[1] / (VIDEO_CLOCK if item[0] == 'video' else self.audio_rate))
+
+    def remember_parameter_sets(self, access_unit):
+        """从访问单元中取出SPS/PPS, 用于SDP的sprop-parameter-sets"""
+        for nal in split_annexb(access_unit):
+            if nal[0] & 0x1F == 7 and self.sps is None:
+                self.sps = nal
+            if nal[0] & 0x1F == 8 and self.pps is None:
+                self.pps = nal
+
+    def synthetic_frame(self, index):
+        """生成一帧合成画面: 移动的渐变背景和一个移动的方块"""
+        x = np.arange(self.width, dtype=np.uint16)
+        y = np.arange(self.height, dtype=np.uint16)[:, None]
+        image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        image[..., 0] = (x + index * 4) % 256
+        image[..., 1] = (y + index * 2) % 256
+        image[..., 2] = ((x + y) // 4 + index) % 256
+        size = self.height // 6
+        left = (index * 8) % max(self.width - size, 1)
+        top = (index * 4) % max(self.height - size, 1)
+        image[top:top + size, left:left + size] = 255
+        return av.VideoFrame.from_ndarray(image, format='rgb24').reformat(format='yuv420p')
+
+    def encode_video(self):
+        """编码loop_seconds秒的合成H.264视频"""
+        codec = av.CodecContext.create('libx264', 'w')
+        codec.width = self.width
+        codec.height = self.height
+        codec.pix_fmt = 'yuv420p'
+        codec.time_base = f"1/{self.fps}"
+        codec.framerate = self.fps
+        codec.bit_rate = self.bitrate
+        codec.gop_size = self.fps * 2
+        codec.options = {'preset': 'veryfast', 'tune': 'zerolatency'}
+        step = VIDEO_CLOCK // self.fps
+        count = 0
+        for index in range(self.loop_seconds * self.fps):
+            frame = self.synthetic_frame(index)
+            frame.pts = index
+            for packet in codec.encode(frame):
+                self.add_video(bytes(packet), count * step)
+                count += 1
+        for packet in codec.encode(None):
+            self.add_video(bytes(packet), count * step)
+            count += 1
+
+    def add_video(self, access_unit, timestamp):
+        self.remember_parameter_sets(access_unit)
+        self.frames.append(('video', timestamp, packetize_h264(access_unit)))
+
+    def load_recording(self, path):
+        """读取录制文件中的H.264视频(流复制, 不重新编码), 分辨率和帧率以录制文件为准"""
+        container = av.open(path)
+        stream = container.streams.video[0]
+        self.width, self.height = stream.width, stream.height
+        self.fps = int(round(stream.average_rate or 25))
+        bsf = None
+        if stream.codec_context.extradata and stream.codec_context.extradata[:1] == b'\x01':
+            # MP4等容器中的avcC格式需要转换为Annex-B
+            bsf = av.BitStreamFilterContext('h264_mp4toannexb', stream)
+        first_pts = None
+        done = False  # 已读到loop_seconds之后, 不再解复用录制文件的剩余部分
+        for packet in container.demux(stream):
+            if packet.pts is None:
+                continue
+            for filtered in (bsf.filter(packet) if bsf else [packet]):
+                first_pts = filtered.pts if first_pts is None else first_pts
+                timestamp = int((filtered.pts - first_pts) * filtered.time_base * VIDEO_CLOCK)
+                if timestamp >= self.loop_seconds * VIDEO_CLOCK:
+                    done = True
+                    break
+                self.add_video(bytes(filtered), timestamp)
+            if done:
+                break
+        container.close()
+        self.frames.sort(key=lambda item: item[1])
+
+    def encode_audio(self):
+        """编码loop_seconds秒的合成音频: 正弦音调叠加周期性的噪声段"""
+        if self.audio_codec == 'none':
+            return
+        rate = self.audio_rate
+        samples = np.arange(rate * self.loop_seconds)
+        tone = 6000 * np.sin(2 * np.pi * 440 * samples / rate)
+        noise = np.random.default_rng(0).normal(0, 2000, samples.shape) * ((samples // rate) % 2)
+        pcm = np.clip(tone + noise, -32768, 32767).astype(np.int16)
+
+        codec_name = {'pcma': 'pcm_alaw', 'pcmu': 'pcm_mulaw', 'aac': 'aac'}[self.audio_codec]
+        codec = av.CodecContext.create(codec_name, 'w')
+        codec.sample_rate = rate
+        codec.layout = 'mono'
+        codec.format = 'fltp' if self.audio_codec == 'aac' else 's16'
+        if self.audio_codec == 'aac':
+            codec.bit_rate = 32000
+        codec.open()
+        frame_size = codec.frame_size or rate // 50  # G.711每20毫秒一包
+        timestamp = 0
+        for offset in range(0, len(pcm) - frame_size + 1, frame_size):
+            chunk = pcm[offset:offset + frame_size]
+            if codec.format.name == 'fltp':
+                frame = av.AudioFrame.from_ndarray((chunk / 32768).astype(np.float32)[None, :], format='fltp', layout='mono')
+            else:
+                frame = av.AudioFrame.from_ndarray(chunk[None, :], format='s16', layout='mono')
+            frame.sample_rate = rate
+            frame.pts = offset
+            for packet in codec.encode(frame):
+                payload = bytes(packet)
+                payloads = packetize_aac(payload) if self.audio_codec == 'aac' else [payload]
+                self.frames.append(('audio', timestamp, payloads))
+                timestamp += frame_size
+        if self.audio_codec == 'aac':
+            self.audio_config = bytes(codec.extradata or b'')
+
+    def sdp(self, host):
+        """生成与设备相同结构的SDP: 每个轨道带 a=control:trackID=N"""
+        sprop = ",".join(base64.b64encode(nal).decode() for nal in (self.sps, self.pps) if nal)
+        lines = [
+            "v=0",
+            f"o=- {int(time.time())} 1 IN IP4 {host}",
+            "s=Synthetic Stream",
+            "t=0 0",
+            "a=control:*",
+            "m=video 0 RTP/AVP 96",
+            "a=rtpmap:96 H264/90000",
+            f"a=fmtp:96 packetization-mode=1;sprop-parameter-sets={sprop}",
+            f"a=framerate:{self.fps}",
+            "a=control:trackID=0",
+        ]
+        if self.audio_codec in ('pcma', 'pcmu'):
+            payload_type = 8 if self.audio_codec == 'pcma' else 0
+            lines += [f"m=audio 0 RTP/AVP {payload_type}",
+                      f"a=rtpmap:{payload_type} {self.audio_codec.upper()}/{self.audio_rate}",
+                      "a=control:trackID=1"]
+        elif self.audio_codec == 'aac':
+            lines += ["m=audio 0 RTP/AVP 97",
+                      f"a=rtpmap:97 MPEG4-GENERIC/{self.audio_rate}/1",
+                      "a=fmtp:97 streamtype=5;profile-level-id=1;mode=AAC-hbr;sizelength=13;indexlength=3;"
+                      f"indexdeltalength=3;config={self.audio_config.hex()}",
+                      "a=control:trackID=1"]
+        return "\r\n".join(lines) + "\r\n"
+
+    @property
+    def audio_payload_type(self):
+        return {'pcma': 8, 'pcmu': 0, 'aac': 97}.get(self.audio_codec)
+
+
+class RTSPSession(socketserver.BaseRequestHandler):
+    """单个RTSP客户端会话, 只支持TCP交织传输(与设备的使用方式一致)"""
+    def setup(self):
+        self.media:MediaLoop = self.server.media
+        self.send_lock = threading.Lock()
+        self.session_id = f"{random.randint(0, 0xFFFFFFFF):08X}"
+        self.tracks = {}  # trackID -> {channel, ssrc, seq, base, packets, octets, last_report}
+        self.sender = None
+        self.closed = threading.Event()
+        self.buffer = b''
+
+    def read_message(self):
+        """读取一个RTSP请求, 跳过客户端发来的交织数据(RTCP接收报告)"""
+        while True:
+            if self.buffer[:1] == b'$' and len(self.buffer) >= 4:
+                length = struct.unpack('!H', self.buffer[2:4])[0]
+                if len(self.buffer) >= 4 + length:
+                    self.buffer = self.buffer[4 + length:]
+                    continue
+            elif b'\r\n\r\n' in self.buffer:
+                head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+                text = head.decode('utf-8', 'replace')
+                match = re.search(r"Content-Length:\s*(\d+)", text, re.IGNORECASE)
+                body_length = int(match.group(1)) if match else 0
+                while len(self.buffer) < body_length:
+                    self.buffer += self.request.recv(4096)
+                self.buffer = self.buffer[body_length:]
+                return text
+            data = self.request.recv(4096)
+            if not data:
+                return None
+            self.buffer += data
+
+    def send(self, data:bytes):
+        with self.send_lock:
+            self.request.sendall(data)
+
+    def respond(self, cseq, headers = None, body = ''):
+        lines = ["RTSP/1.0 200 OK", f"CSeq: {cseq}"]
+        lines += headers or []
+        if body:
+            lines += ["Content-Type: application/sdp", f"Content-Length: {len(body.encode())}"]
+        self.send(("\r\n".join(lines) + "\r\n\r\n" + body).encode())
+
+    def handle(self):
+        while not self.closed.is_set():
+            try:
+                message = self.read_message()
+            except OSError:
+                break
+            if message is None:
+                break
+            method, url = message.split(" ", 2)[:2]
+            cseq = re.search(r"CSeq:\s*(\d+)", message, re.IGNORECASE).group(1)
+            if method == "OPTIONS":
+                self.respond(cseq, ["Public: OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER"])
+            elif method == "DESCRIBE":
+                self.base_url = url.rstrip('/')
+                self.respond(cseq, [f"Content-Base: {self.base_url}/"], self.media.sdp(self.server.server_address[0]))
+            elif method == "SETUP":
+                track_id = int(re.search(r"trackID=(\d+)", url).group(1))
+                match = re.search(r"interleaved=(\d+)-(\d+)", message)
+                channel = int(match.group(1)) if match else track_id * 2
+                ssrc = random.randint(1, 0xFFFFFFFF)
+                self.tracks[track_id] = {"channel": channel, "ssrc": ssrc,
+                                         "seq": random.randint(0, 30000), "base": random.randint(0, 0x7FFFFFFF),
+                                         "packets": 0, "octets": 0, "last_report": 0.0}
+                self.respond(cseq, [f"Transport: RTP/AVP/TCP;unicast;interleaved={channel}-{channel + 1};ssrc={ssrc:08X}",
+                                    f"Session: {self.session_id};timeout=60"])
+            elif method == "PLAY":
+                rtp_info = ",".join(f"url={self.base_url}/trackID={track_id};seq={track['seq']};rtptime={track['base']}"
+                                    for track_id, track in sorted(self.tracks.items()))
+                self.respond(cseq, [f"Session: {self.session_id}", "Range: npt=0.000-", f"RTP-Info: {rtp_info}"])
+                if self.sender is None:
+                    self.sender = threading.Thread(target=self.stream, daemon=True)
+                    self.sender.start()
+            elif method == "TEARDOWN":
+                self.respond(cseq, [f"Session: {self.session_id}"])
+                break
+            else:
+                self.respond(cseq, [f"Session: {self.session_id}"])
+        self.closed.set()
+
+    def sender_report(self, track:dict, wall_time, rtp_timestamp):
+        """交织在RTCP通道上的发送者报告, NTP时间与RTP时间戳对应同一采集时刻"""
+        ntp = wall_time + NTP_EPOCH_OFFSET
+        packet = SENDER_REPORT.pack(0x80, 200, 6, track['ssrc'], int(ntp) & 0xFFFFFFFF, int((ntp % 1) * (1 << 32)),
+                                    rtp_timestamp, track['packets'] & 0xFFFFFFFF, track['octets'] & 0xFFFFFFFF)
+        return struct.pack('!cBH', b'$', track['channel'] + 1, len(packet)) + packet
+
+    def stream(self):
+        """按原始节奏循环发送预先打包的RTP数据, 每个轨道每sender_report_interval秒发送一个RTCP SR(与设备一致)
+        音频SR的NTP时间相对视频偏移sender_report_audio_offset秒(源端的音画采集偏移), FFmpeg收到SR后按NTP时间重新对齐音频的pts"""
+        media = self.media
+        interval = self.server.sender_report_interval
+        audio_offset = self.server.sender_report_audio_offset
+        clocks = {'video': VIDEO_CLOCK, 'audio': media.audio_rate}
+        track_ids = {'video': 0, 'audio': 1}
+        payload_types = {'video': 96, 'audio': media.audio_payload_type}
+        start = time.perf_counter()
+        wall_start = time.time()
+        loop = 0
+        while not self.closed.is_set():
+            for kind, timestamp, payloads in media.frames:
+                track = self.tracks.get(track_ids[kind])
+                if track is None:
+                    continue
+                media_time = loop * media.loop_seconds + timestamp / clocks[kind]
+                delay = start + media_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                rtp_timestamp = (track['base'] + timestamp + loop * media.loop_seconds * clocks[kind]) % (1 << 32)
+                chunks = []
+                for i, payload in enumerate(payloads):
+                    marker = 0x80 if i == len(payloads) - 1 else 0
+                    header = RTP_HEADER.pack(0x80, marker | payload_types[kind], track['seq'], rtp_timestamp, track['ssrc'])
+                    track['seq'] = (track['seq'] + 1) & 0xFFFF
+                    packet = header + payload
+                    chunks.append(struct.pack('!cBH', b'$', track['channel'], len(packet)) + packet)
+                    track['packets'] += 1
+                    track['octets'] += len(payload)
+                if interval and media_time - track['last_report'] >= interval:
+                    track['last_report'] = media_time
+                    capture_time = wall_start + media_time + (audio_offset if kind == 'audio' else 0)
+                    chunks.append(self.sender_report(track, capture_time, rtp_timestamp))
+                try:
+                    self.send(b''.join(chunks))
+                except OSError:
+                    self.closed.set()
+                    return
+                if self.closed.is_set():
+                    return
+            loop += 1
+
+
+class SyntheticRTSPServer(socketserver.ThreadingTCPServer):
+    """本地RTSP测试源, 行为与设备一致: TCP交织传输, SDP中每个轨道以trackID标识"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host = '127.0.0.1', port = 18554, sender_report_interval = 5.0, sender_report_audio_offset = 0.1, **media_options):
+        self.media = MediaLoop(**media_options)
+        self.sender_report_interval = sender_report_interval  # RTCP SR的间隔(秒), 为0时不发送
+        self.sender_report_audio_offset = sender_report_audio_offset  # 音频SR的NTP时间相对视频的偏移(秒)
+        super().__init__((host, port), RTSPSession)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.2}, daemon=True)
+        thread.start()
+        return thread
+
+
+def add_source_arguments(parser:argparse.ArgumentParser):
+    """添加测试源相关的命令行参数"""
+    parser.add_argument("--port", type=int, default=18554)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--bitrate", type=int, default=2000000)
+    parser.add_argument("--audio", choices=("pcma", "pcmu", "aac", "none"), default="pcma")
+    parser.add_argument("--loop-seconds", type=int, default=10)
+    parser.add_argument("--input", default=None, help="recorded file with H.264 video to stream instead of synthetic video")
+    parser.add_argument("--sr-interval", type=float, default=5.0, help="seconds between RTCP sender reports per track, 0 = none")
+    parser.add_argument("--sr-audio-offset", type=float, default=0.1, help="seconds the audio sender reports are offset from video (capture offset at the source)")
+
+
+def source_options(args):
+    return {
+        "width": args.width, "height": args.height, "fps": args.fps, "bitrate": args.bitrate,
+        "audio_codec": args.audio, "loop_seconds": args.loop_seconds, "input_path": args.input,
+        "sender_report_interval": args.sr_interval, "sender_report_audio_offset": args.sr_audio_offset,
+    }
+
+
+# 单独运行时作为本地RTSP源: python benchmarks/SyntheticSource.py --width 1920 --height 1080
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local synthetic RTSP source (TCP interleaved).")
+    add_source_arguments(parser)
+    args = parser.parse_args()
+    server = SyntheticRTSPServer('127.0.0.1', args.port, **source_options(args))
+    print(f"Serving rtsp://127.0.0.1:{args.port}/stream")
+    try:
+        server.serve_forever(poll_interval=0.2)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -4,11 +4,38 @@ import multiprocessing
 from LoadConfig import CONFIG
 from TSFileHandler import TSFileHandler
 from RTSPStreamHandler import RTSPStreamHandler
+from RTSPIngest import RTSPIngest
 from AnalyzeVideo import VideoAnalyProcesser
 from AnalyzeAudio import AudioAnalyProcesser
 from Forwarder import RTSPForwarder
 from AnalyzeNet import NetAnalyProcesser
 from SpeechRecognize import SpeechRecognizeProcesser
+from TimeSeries import TimeSeriesStore, TimeSeriesCollector, QueryServer
+from Stats import StatsBlock, resident_bytes
+from Latency import ArrivalClock
+from Trace import format_stage_report
+from Capture import capture_dir
+from StreamInfo import StreamChannel
+from Supervisor import Supervisor
+from EventBus import EventBus
+from Correlation import Correlator
+
+
+
+def print_startup(stats:StatsBlock, processes:dict, timeout = 10):
+    """输出从启动到解码出第一帧的时间, 以及此时各进程的常驻内存"""
+    deadline = time.time() + timeout
+    while not stats.get("stream_first_frame_seconds") and time.time() < deadline:
+        time.sleep(0.05)
+    first_frame = stats.get("stream_first_frame_seconds")
+    print(f"Time to first frame: {first_frame:.2f} s" if first_frame else "Time to first frame: no frame decoded yet")
+    usage = []
+    for name, process in processes.items():
+        rss = resident_bytes(process.pid)
+        if rss is not None:
+            usage.append(f"{name}={rss / 1048576:.0f}MiB")
+    if usage:
+        print("Process RSS: " + ", ".join(usage))
 
     
 def main():
@@ -21,79 +48,182 @@ def main():
     # 事件，用于跨进程通信，控制停止操作
     stop_event = manager.Event()
 
-    # 共享字典，存储流信息（视频、音频状态和整体状态）
-    stream_info_dict = manager.dict({
-        'video': False,
-        'audio': False,
-        'status': None,
-    }) 
-
-    rtp_que = manager.Queue() # 用于从RTSPForwarder向NetAnalyProcesser传递RTP帧数据
-    pipeline_0, pipeline_1 = multiprocessing.Pipe() # 用于从RTSPForwarder向NetAnalyProcesser传递初始化数据
-
-    # 初始化RTSP转发器
-    rtsp_forwarder = RTSPForwarder(rtp_que, server_host, server_port, pipeline_0, stop_event)
-
-    # 创建视频和音频队列
-    v_que_for_ts = manager.Queue() # 用于从RTSPStreamHandler向TSFileHandler传递视频帧数据
-    a_que_for_ts = manager.Queue() # 用于从RTSPStreamHandler向TSFileHandler传递音频帧数据
-    v_que_for_av = manager.Queue() # 用于从RTSPStreamHandler向VideoAnalyProcesser传递视频帧数据
-    a_que_for_aa = manager.Queue() # 用于从RTSPStreamHandler向AudioAnalyProcesser传递音频帧数据
-    a_que_for_sr = manager.Queue() # 用于从RTSPStreamHandler向SpeechRecognizeProcesser传递音频帧数据
-
-    video_frame_ques = [v_que_for_ts, v_que_for_av] # 用于传递视频帧的队列列表
-    audio_frame_ques = [a_que_for_ts, a_que_for_aa, a_que_for_sr] # 用于传递音频帧的队列列表
-
-    # 初始化RTSP流处理器，负责获取视频和音频流以及帧数据
-    rtsp_stream_handler = RTSPStreamHandler(
+    # 流信息的广播通道: 流打开后发布一次不可变的流描述(轨道、编码、采样率、尺寸、时间基), 各进程缓存在本地
+    stream_channel = StreamChannel()
+
+    # 共享内存统计块, 各进程直接写入计数器和仪表, 主进程通过/metrics输出
+    stats = StatsBlock()
+    # 中继记录的RTP时间戳 -> 线上到达时间映射, 用于计算各报告的端到端延迟
+    arrival_clock = ArrivalClock()
+
+    # 时间序列: 各分析器将数值指标推送到样本队列, 由主进程汇总到定长环形存储并提供本地查询接口
+    timeseries_config = CONFIG.get('timeseries', {})
+    # 跨模态关联: 同一样本队列中的报告映射到墙上时间轴, 按correlation.rules产生带原因标签的事故
+    correlation_config = CONFIG.get('correlation', {})
+    correlator = None
+    if correlation_config.get('enabled', True):
+        correlator = Correlator(correlation_config.get('rules', []), correlation_config.get('lateness', 5.0),
+                                stats=stats, stream_name=CONFIG.get('stream_name'))
+    sample_que = None
+    timeseries_store = None
+    if timeseries_config.get('enabled', True) or correlator:
+        sample_que = manager.Queue()
+        if timeseries_config.get('enabled', True):
+            timeseries_store = TimeSeriesStore()
+        TimeSeriesCollector(sample_que, timeseries_store, stop_event, correlator).start()
+
+    # 可按配置关闭部分分析器, 关闭的分析器不创建队列也不启动进程
+    analyzers = CONFIG.get('analyzers', {})
+    enabled = {name: analyzers.get(name, True) for name in ('record', 'video', 'audio', 'speech', 'net')}
+    stats.set("pipeline_start_time_seconds", time.time())
+
+    rtp_que = None # 用于从RTSPForwarder向NetAnalyProcesser传递RTP帧数据
+    # 用于从RTSPForwarder向NetAnalyProcesser传递各轨道的初始化数据, 保留最新版本, 被Supervisor重启的NetAnalyProcesser重新读取
+    track_channel = None
+    if enabled['net']:
+        rtp_que = manager.Queue()
+        track_channel = StreamChannel()
+
+    # 可选: 中继将服务器发来的原始字节流连同接收时间写入抓包文件, 用ReplayCapture.py离线回放
+    capture_config = CONFIG.get('capture', {})
+    capture_path = (capture_config.get('dir') or capture_dir()) if capture_config.get('enabled') else None
+
+    # 可选: 触发式事件录制. 分析器的指标超过config.json中triggers的阈值时经事件总线通知流处理器,
+    # 流处理器把内存中事件前的压缩包和事件后的包写入results/events, 不重新编码
+    event_config = dict(CONFIG.get('event_capture', {}))
+    event_bus = EventBus(('capture',)) if event_config.pop('enabled', False) else None
+
+    # 创建视频和音频队列, 只为启用的消费者创建
+    queues = {'rtp': rtp_que} if rtp_que is not None else {}
+    for name, consumer in (('video_ts', 'record'),
+                           ('audio_ts', 'record'),
+                           ('video_analyzer', 'video'),
+                           ('audio_analyzer', 'audio'),
+                           ('speech', 'speech')):
+        if enabled[consumer]:
+            queues[name] = manager.Queue()
+    video_frame_ques = [queues[name] for name in ('video_ts', 'video_analyzer') if name in queues] # 用于传递视频帧的队列列表
+    audio_frame_ques = [queues[name] for name in ('audio_ts', 'audio_analyzer', 'speech') if name in queues] # 用于传递音频帧的队列列表
+
+    # 本地HTTP服务: 时间序列查询接口和Prometheus格式的/metrics
+    query_server = QueryServer(timeseries_store,
+                               port=timeseries_config.get('port', 12025),
+                               stats=stats,
+                               queues=queues)
+    query_server.start()
+
+    # 各进程的创建函数: 进程崩溃或心跳超时后, Supervisor以resume=True重新创建, 新进程接续原来的队列、结果文件和时间轴
+    reconnect_config = CONFIG.get('reconnect', {})
+    # 解码: 音频和视频各一个解码线程, 视频解码器启用帧级/片级多线程
+    decoding_config = CONFIG.get('decoding', {})
+    factories = {
+        # 初始化RTSP流处理器，负责获取视频和音频流以及帧数据, 流中断后退避重连
+        'RTSPStreamHandler': lambda resume: RTSPStreamHandler(
                                         video_frame_ques,
                                         audio_frame_ques,
-                                        stream_info_dict,
+                                        stream_channel,
                                         stop_event, 
-                                        f"rtsp://127.0.0.1:12024/{path}")
-    # 初始化TS文件处理器
-    ts_file_handler = TSFileHandler(v_que_for_ts, a_que_for_ts, stream_info_dict, stop_event)
-    # 初始化视频分析处理器
-    video_analyzer = VideoAnalyProcesser(v_que_for_av, stream_info_dict, stop_event)
-    # 初始化音频分析处理器
-    audio_analyzer = AudioAnalyProcesser(a_que_for_aa, stream_info_dict, stop_event)
-    # 初始化网络分析处理器
-    net_analyzer   = NetAnalyProcesser(rtp_que, server_host, pipeline_1, stop_event)
-    # 初始化语音识别器
-    speech_recoginzer = SpeechRecognizeProcesser(a_que_for_sr, stream_info_dict, stop_event)
-
-    
-    speech_recoginzer.start()
-    video_analyzer.start()
-    audio_analyzer.start()
-    net_analyzer.start()
-    ts_file_handler.start()
-    rtsp_forwarder.start()
-    rtsp_stream_handler.start()
-
-    # 主循环：等待停止事件被设置或监控流的状态变化
-    while not stop_event.is_set():
-        if stream_info_dict['status']:
-            if stream_info_dict['status'] == 'start':
-                # 当流开始时，等待用户输入以停止处理
-                print("\r\nPress 'Enter' to stop.\r\n")
-                input()
-            if stream_info_dict['status'] == 'end':
-                # 如果流结束，无需额外操作
-                pass
-            # 设置停止事件，结束所有处理
-            stop_event.set()
-            break
-        time.sleep(0.1)
+                                        f"rtsp://127.0.0.1:12024/{path}",
+                                        stats=stats,
+                                        arrival_clock=arrival_clock,
+                                        reconnect=reconnect_config.get('enabled', True),
+                                        reconnect_delay=reconnect_config.get('initial_delay', 0.5),
+                                        reconnect_max_delay=reconnect_config.get('max_delay', 10.0),
+                                        resume=resume,
+                                        transport=CONFIG.get('rtsp_transport', 'tcp'),
+                                        event_bus=event_bus,
+                                        capture_options=event_config,
+                                        decode_workers=decoding_config.get('workers', True),
+                                        decode_threads=decoding_config.get('threads', 0),
+                                        thread_type=decoding_config.get('thread_type', 'AUTO')),
+        # 初始化RTSP转发器
+        'RTSPForwarder': lambda resume: RTSPForwarder(rtp_que, server_host, server_port, track_channel, stop_event, stats, arrival_clock, capture_path),
+    }
+    if CONFIG.get('ingest', 'relay') == 'direct':
+        # 进程内接入: 直接连接上游服务器, 自行拆包并解码, 不再经过中继和回环端口(不支持抓包和UDP传输)
+        del factories['RTSPForwarder']
+        factories['RTSPStreamHandler'] = lambda resume: RTSPIngest(
+                                        video_frame_ques,
+                                        audio_frame_ques,
+                                        stream_channel,
+                                        stop_event,
+                                        CONFIG.get('rtsp_url'),
+                                        rtp_que,
+                                        track_channel,
+                                        stats=stats,
+                                        arrival_clock=arrival_clock,
+                                        reconnect=reconnect_config.get('enabled', True),
+                                        reconnect_delay=reconnect_config.get('initial_delay', 0.5),
+                                        reconnect_max_delay=reconnect_config.get('max_delay', 10.0),
+                                        resume=resume,
+                                        event_bus=event_bus,
+                                        capture_options=event_config,
+                                        decode_workers=decoding_config.get('workers', True),
+                                        decode_threads=decoding_config.get('threads', 0),
+                                        thread_type=decoding_config.get('thread_type', 'AUTO'))
+    if enabled['record']:
+        # 初始化TS文件处理器
+        # 录制时同时写入关键帧索引(output_stream.ts.idx), 用ExportClip.py按时间直接导出片段
+        factories['TSFileHandler'] = lambda resume: TSFileHandler(queues['video_ts'], queues['audio_ts'], stream_channel, stop_event, stats=stats, resume=resume,
+                                                                  keyframe_interval=CONFIG.get('recording', {}).get('keyframe_interval', 2.0))
+    if enabled['net']:
+        # 初始化网络分析处理器, 同时由RTP时间戳和RTCP发送者报告分析音画同步
+        av_sync_config = CONFIG.get('av_sync', {})
+        factories['NetAnalyProcesser'] = lambda resume: NetAnalyProcesser(rtp_que, server_host, track_channel, stop_event, sample_que, stats, resume=resume, event_bus=event_bus,
+                                                                          sync_interval=av_sync_config.get('interval', 1.0) if av_sync_config.get('enabled', True) else None)
+    if enabled['audio']:
+        # 初始化音频分析处理器
+        factories['AudioAnalyProcesser'] = lambda resume: AudioAnalyProcesser(queues['audio_analyzer'], stream_channel, stop_event, sample_que, stats, resume=resume, event_bus=event_bus)
+    if enabled['video']:
+        # 初始化视频分析处理器
+        factories['VideoAnalyProcesser'] = lambda resume: VideoAnalyProcesser(queues['video_analyzer'], stream_channel, stop_event, sample_que, stats, resume=resume, event_bus=event_bus)
+    if enabled['speech']:
+        # 初始化语音识别器
+        factories['SpeechRecognizeProcesser'] = lambda resume: SpeechRecognizeProcesser(queues['speech'],
+                                                                                        stream_channel,
+                                                                                        stop_event,
+                                                                                        CONFIG.get('speech_mode', 'full'),
+                                                                                        CONFIG.get('keywords'),
+                                                                                        stats,
+                                                                                        resume=resume,
+                                                                                        event_bus=event_bus,
+                                                                                        sample_que=sample_que)
+
+    # 消费者先启动, 转发器和流处理器最后启动; 各进程只在用到时导入自己的重量级依赖
+    supervisor_config = CONFIG.get('supervisor', {})
+    supervisor = Supervisor(factories, stop_event, stats,
+                            heartbeat_timeout=supervisor_config.get('heartbeat_timeout', 15.0),
+                            startup_timeout=supervisor_config.get('startup_timeout', 60.0),
+                            check_interval=supervisor_config.get('check_interval', 1.0),
+                            restart_backoff=supervisor_config.get('restart_backoff', 1.0),
+                            max_restart_backoff=supervisor_config.get('max_restart_backoff', 30.0))
+    supervisor.start_processes()
+    processes = supervisor.processes  # 重启时原地替换, /metrics 和 /profile 总是看到当前的进程
+    if supervisor_config.get('enabled', True):
+        supervisor.start()
+
+    # 各进程可按需进行性能分析: kill -USR1 <pid> 栈采样, kill -USR2 <pid> 内存快照, 或通过 /profile 接口
+    query_server.server.processes = processes
+    print("Process PIDs: " + ", ".join(f"{name}={process.pid}" for name, process in processes.items()) + "\r\n")
+
+    # 主循环：等待流打开(或打开失败)
+    descriptor = stream_channel.wait(stop_event=stop_event)
+    if descriptor is not None and descriptor['status'] == 'start':
+        print_startup(stats, processes)
+        # 当流开始时，等待用户输入以停止处理
+        print("\r\nPress 'Enter' to stop.\r\n")
+        input()
+    # 设置停止事件，结束所有处理
+    stop_event.set()
     
     # 确保所有事件和线程都被清理和同步
-    rtsp_stream_handler.join()
-    rtsp_forwarder.join()
-    ts_file_handler.join()
-    net_analyzer.join()
-    audio_analyzer.join()
-    video_analyzer.join()
-    speech_recoginzer.join()
+    if supervisor.is_alive():
+        supervisor.join()
+    supervisor.join_processes()
+    query_server.stop()
+
+    # 输出各阶段耗时报告(运行中可通过 /stages 随时查看)
+    print(format_stage_report(stats))
    
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import os
+import json
+import queue
+import threading
+import pytest
+from Correlation import Correlator
+from AnalyzeAudio import peak_dbfs
+
+
+def config_rule(name):
+    """config.json中correlation.rules里的规则"""
+    with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.json'), 'r') as file:
+        rules = json.load(file)["correlation"]["rules"]
+    return next(rule for rule in rules if rule["name"] == name)
+
+
+def read_incidents(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return [json.loads(line) for line in file]
+
+
+def silent_windows(windows, samples = 3600, noise = 0):
+    """静音的0.45秒窗口(8000Hz), noise为底噪的峰值幅度"""
+    return [[noise if i % 2 else -noise for i in range(samples)] for _ in range(windows)]
+
+
+def audio_metrics(window):
+    """与AudioAnalyzer报告相同的指标: 没有语音时max_voice_db为0, peak_dbfs为窗口内的峰值电平"""
+    peak = max(abs(sample) for sample in window)
+    return {"max_voice_db": 0, "max_noise_db": 0, "voice_noise_ratio": None, "peak_dbfs": peak_dbfs(peak)}
+
+
+@pytest.mark.parametrize("noise", [0, 3, 20])
+def test_silence_with_audio_loss(tmp_path, noise):
+    path = str(tmp_path / "Incidents.jsonl")
+    correlator = Correlator([config_rule("silence_with_audio_loss")], path=path)
+    for i, window in enumerate(silent_windows(4, noise=noise)):
+        correlator.add("Audio-Status", 100 + 0.45 * i, 100.45 + 0.45 * i, audio_metrics(window))
+    correlator.add("audio-Net-Status", 100.0, 101.0, {"loss_rate_pct": 12.0})
+    correlator.close()
+    incidents = read_incidents(path)
+    assert [incident["rule"] for incident in incidents] == ["silence_with_audio_loss"]
+    assert incidents[0]["cause"] == "network"
+
+
+def test_audible_audio_with_loss_is_not_silence(tmp_path):
+    path = str(tmp_path / "Incidents.jsonl")
+    correlator = Correlator([config_rule("silence_with_audio_loss")], path=path)
+    for i, window in enumerate(silent_windows(4, noise=3000)):
+        correlator.add("Audio-Status", 100 + 0.45 * i, 100.45 + 0.45 * i, audio_metrics(window))
+    correlator.add("audio-Net-Status", 100.0, 101.0, {"loss_rate_pct": 12.0})
+    correlator.close()
+    assert read_incidents(path) == []
+
+
+def test_silent_frames_through_audio_analyzer(tmp_path):
+    """静音帧经过AudioAnalyzer得到的报告触发规则"""
+    np = pytest.importorskip("numpy")
+    av = pytest.importorskip("av")
+    pytest.importorskip("webrtcvad")
+    from Srt import SrtCollector
+    from AnalyzeAudio import AudioAnalyzer
+    collector = SrtCollector(8000)
+    analyzer = AudioAnalyzer(8000, queue.Queue(), threading.Event(), srt=collector)
+    for i in range(100):
+        frame = av.AudioFrame.from_ndarray(np.zeros((1, 160), dtype=np.int16), format='s16', layout='mono')
+        frame.sample_rate = 8000
+        frame.pts = 160 * i
+        analyzer.process_frame(frame)
+    assert collector.entries
+
+    path = str(tmp_path / "Incidents.jsonl")
+    correlator = Correlator([config_rule("silence_with_audio_loss")], path=path)
+    for start, end, _, metrics in collector.entries:
+        correlator.add("Audio-Status", 100 + start / 8000, 100 + end / 8000, metrics)
+    correlator.add("audio-Net-Status", 100.0, 102.0, {"loss_rate_pct": 12.0})
+    correlator.close()
+    assert [incident["rule"] for incident in read_incidents(path)] == ["silence_with_audio_loss"]
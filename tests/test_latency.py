@@ -0,0 +1,131 @@
+import time
+import random
+import pytest
+from Latency import ArrivalClock, MAX_TIMESTAMP, timestamp_delta
+
+
+class RtpDemux:
+    """FFmpeg rtpdec中一个流的pts计算(finalize_packet和rtcp_parse_packet), 用于检验ArrivalClock的反推
+    NTP时间以秒表示, 与ArrivalClock.sender_report的参数相同"""
+    def __init__(self, clock_rate, base_timestamp = 0, range_start = 0.0):
+        self.clock_rate = clock_rate
+        self.base_timestamp = base_timestamp  # RTP-Info中的rtptime, 为0时取第一个包的时间戳
+        self.range_start_offset = round(range_start * clock_rate)
+        self.timestamp = 0
+        self.unwrapped_timestamp = 0
+        self.last_rtcp_ntp_time = None
+        self.last_rtcp_timestamp = None
+        self.first_rtcp_ntp_time = None
+        self.rtcp_ts_offset = 0
+
+    def sender_report(self, ntp, rtp_timestamp):
+        self.last_rtcp_ntp_time = ntp
+        self.last_rtcp_timestamp = rtp_timestamp
+        if self.first_rtcp_ntp_time is None:
+            self.first_rtcp_ntp_time = ntp
+            if not self.base_timestamp:
+                self.base_timestamp = rtp_timestamp
+            self.rtcp_ts_offset = timestamp_delta(rtp_timestamp, self.base_timestamp)
+            return True  # rtsp.c把第一个SR的NTP时间和偏移传给其他流
+        return False
+
+    def share_first_report(self, other:"RtpDemux"):
+        """rtsp.c: 其他流还没有收到SR时采用本流第一个SR的NTP时间, 偏移换算到其他流的时钟"""
+        if other.first_rtcp_ntp_time is None:
+            other.first_rtcp_ntp_time = self.first_rtcp_ntp_time
+            other.rtcp_ts_offset = round(self.rtcp_ts_offset * other.clock_rate / self.clock_rate)
+
+    def pts(self, timestamp, streams = 2):
+        if self.last_rtcp_ntp_time is not None and streams > 1:
+            addend = round((self.last_rtcp_ntp_time - self.first_rtcp_ntp_time) * self.clock_rate)
+            delta = timestamp_delta(timestamp, self.last_rtcp_timestamp)
+            return self.range_start_offset + self.rtcp_ts_offset + addend + delta
+        if not self.base_timestamp:
+            self.base_timestamp = timestamp
+        if not self.timestamp:
+            self.unwrapped_timestamp += timestamp
+        else:
+            self.unwrapped_timestamp += timestamp_delta(timestamp, self.timestamp)
+        self.timestamp = timestamp
+        return self.unwrapped_timestamp + self.range_start_offset - self.base_timestamp
+
+
+def simulate(audio_offset, base = None, range_start = 0.0, seconds = 20.0, lag = 8):
+    """视频25fps(90kHz)和音频每20ms一个包(8kHz)交错到达, 每5秒各发送一个SR, 音频SR的NTP时间偏移audio_offset秒
+    中继按到达顺序记录时间戳和SR, 解码端落后lag个包按rtpdec的pts查找, 返回 (查找次数, 错误次数)"""
+    rng = random.Random(7)
+    clock = ArrivalClock(capacity=1024)
+    clock.reset(streams=2)
+    rates = {'video': 90000, 'audio': 8000}
+    bases = base or {'video': rng.randrange(MAX_TIMESTAMP), 'audio': rng.randrange(MAX_TIMESTAMP)}
+    demux = {kind: RtpDemux(rates[kind], bases[kind], range_start) for kind in rates}
+    for kind in rates:
+        clock.configure(kind, rates[kind], bases[kind], range_start)
+    events = []  # (发送时间, 类型, 是否SR)
+    for i in range(int(seconds * 25)):
+        events.append((i / 25, 'video', False))
+    for i in range(int(seconds * 50)):
+        events.append((i / 50 + 0.003, 'audio', False))
+    for kind in rates:
+        for t in range(1, int(seconds / 5) + 1):
+            events.append((t * 5 - 0.001, kind, True))
+    events.sort()
+
+    start = time.time()
+    pending = []  # (类型, pts, 到达时间)
+    lookups = errors = 0
+    for send_time, kind, is_report in events:
+        timestamp = (bases[kind] + round(send_time * rates[kind])) % MAX_TIMESTAMP
+        if is_report:
+            ntp = 3.9e9 + send_time + (audio_offset if kind == 'audio' else 0.0)
+            clock.sender_report(kind, ntp, timestamp)
+            if demux[kind].sender_report(ntp, timestamp):
+                for other in demux.values():
+                    if other is not demux[kind]:
+                        demux[kind].share_first_report(other)
+            continue
+        arrival = start + send_time + 0.05
+        clock.stamp(kind, timestamp, arrival)
+        pending.append((kind, demux[kind].pts(timestamp), arrival))
+        while len(pending) > lag:
+            lookup_kind, pts, expected = pending.pop(0)
+            lookups += 1
+            errors += clock.lookup(lookup_kind, pts) != expected
+    return lookups, errors
+
+
+@pytest.mark.parametrize("audio_offset", [0.0, 0.3, -0.2])
+def test_lookup_follows_rtcp_rebasing(audio_offset):
+    """SR把pts改为按发送端NTP时间对齐后, 查找仍然得到每个包自己的到达时间"""
+    lookups, errors = simulate(audio_offset)
+    assert lookups > 1000
+    assert errors == 0
+
+
+def test_lookup_with_range_start_and_wrap():
+    """Range起点不为0, 且时间戳在会话中回绕"""
+    base = {'video': MAX_TIMESTAMP - 90000 * 3, 'audio': MAX_TIMESTAMP - 8000 * 7}
+    lookups, errors = simulate(0.25, base=base, range_start=12.5)
+    assert errors == 0
+
+
+def test_single_stream_ignores_sender_reports():
+    """只有一个流时rtpdec不按SR对齐, pts只由起始时间戳决定"""
+    clock = ArrivalClock()
+    clock.reset(streams=1)
+    clock.configure('audio', 8000, 1000)
+    clock.stamp('audio', 1000, 10.0)
+    clock.sender_report('audio', 3.9e9, 5000)
+    clock.stamp('audio', 1160, 10.02)
+    assert clock.lookup('audio', 160) == 10.02
+
+
+def test_lookup_nearest_within_tolerance():
+    """没有完全相同的时间戳时(如AAC包中第一个之后的AU)取容差内最近的记录, 超出容差时返回None"""
+    clock = ArrivalClock()
+    clock.reset()
+    for i in range(1000):
+        clock.stamp('audio', 1024 * 4 * i, 100.0 + i)
+    assert clock.lookup('audio', 1024 * 4 * 500 + 1024, tolerance=2048) == 600.0
+    assert clock.lookup('audio', 1024 * 4 * 500 + 3072, tolerance=2048) == 601.0
+    assert clock.lookup('audio', 1024 * 4 * 2000, tolerance=2048) is None
@@ -0,0 +1,191 @@
+import base64
+import RTSPIngest
+from RTSPIngest import (START_CODE, H264Depacketizer, H265Depacketizer, AACDepacketizer, IngestTrack,
+                        RTSPAuthenticator, RTSPClient, parse_sdp)
+from Latency import MAX_TIMESTAMP
+
+SPS = bytes.fromhex('6742c01e')
+PPS = bytes.fromhex('68ce3c80')
+
+
+def h264_fragments(nal, size):
+    """按FU-A把一个NAL切成多个分片的负载"""
+    header, data = nal[0], nal[1:]
+    chunks = [data[i:i + size] for i in range(0, len(data), size)]
+    payloads = []
+    for i, chunk in enumerate(chunks):
+        fu_header = (header & 0x1F) | (0x80 if i == 0 else 0) | (0x40 if i == len(chunks) - 1 else 0)
+        payloads.append(bytes(((header & 0xE0) | 28, fu_header)) + chunk)
+    return payloads
+
+
+def test_h264_fu_a_reassembly_with_parameter_sets():
+    """FU-A分片重组为一个NAL, SDP中的SPS/PPS加在第一个访问单元之前"""
+    fmtp = {'sprop-parameter-sets': base64.b64encode(SPS).decode() + ',' + base64.b64encode(PPS).decode()}
+    depacketizer = H264Depacketizer(fmtp)
+    idr = bytes((0x65,)) + bytes(range(256)) * 4
+    payloads = h264_fragments(idr, 300)
+    frames = []
+    for i, payload in enumerate(payloads):
+        frames += depacketizer.push(memoryview(payload), 3000, i == len(payloads) - 1)
+    assert frames == [(3000, START_CODE + SPS + START_CODE + PPS + START_CODE + idr)]
+    assert depacketizer.is_keyframe(frames[0][1])
+
+    # 参数集只加一次, 非IDR帧不是关键帧
+    frames = depacketizer.push(memoryview(b'\x41\x9a\x00'), 6000, True)
+    assert frames == [(6000, START_CODE + b'\x41\x9a\x00')]
+    assert not depacketizer.is_keyframe(frames[0][1])
+
+
+def test_h264_fu_a_drops_fragments_after_lost_start():
+    """起始分片丢失时丢弃同一NAL的其余分片"""
+    depacketizer = H264Depacketizer({})
+    nal = bytes((0x41,)) + bytes(range(100))
+    payloads = h264_fragments(nal, 40)
+    frames = []
+    for payload in payloads[1:]:
+        frames += depacketizer.push(memoryview(payload), 3000, False)
+    frames += depacketizer.push(memoryview(b'\x41\x01'), 3000, True)
+    assert frames == [(3000, START_CODE + b'\x41\x01')]
+
+
+def test_h264_stap_a_and_timestamp_change():
+    """STAP-A中的每个NAL各加起始码; 没有标记位时按时间戳变化结束访问单元"""
+    depacketizer = H264Depacketizer({})
+    payload = bytes((24,)) + len(SPS).to_bytes(2, 'big') + SPS + len(PPS).to_bytes(2, 'big') + PPS
+    assert depacketizer.push(memoryview(payload), 100, False) == []
+    assert depacketizer.push(memoryview(b'\x65\x88'), 100, False) == []
+    frames = depacketizer.push(memoryview(b'\x41\x9a'), 200, True)
+    assert frames == [(100, START_CODE + SPS + START_CODE + PPS + START_CODE + b'\x65\x88'),
+                      (200, START_CODE + b'\x41\x9a')]
+
+
+def test_h265_fu_reassembly():
+    """H.265 FU: 由PayloadHdr和FU头中的类型重建2字节NAL头"""
+    vps, sps, pps = b'\x40\x01\x0c', b'\x42\x01\x01', b'\x44\x01\xc1'
+    fmtp = {'sprop-vps': base64.b64encode(vps).decode(), 'sprop-sps': base64.b64encode(sps).decode(),
+            'sprop-pps': base64.b64encode(pps).decode()}
+    depacketizer = H265Depacketizer(fmtp)
+    nal = bytes(((19 << 1), 0x01)) + bytes(range(200))  # IDR_W_RADL
+    data = nal[2:]
+    payloads = []
+    for start in range(0, len(data), 64):
+        fu_header = 19 | (0x80 if start == 0 else 0) | (0x40 if start + 64 >= len(data) else 0)
+        payloads.append(bytes((49 << 1, 0x01, fu_header)) + data[start:start + 64])
+    frames = []
+    for i, payload in enumerate(payloads):
+        frames += depacketizer.push(memoryview(payload), 9000, i == len(payloads) - 1)
+    assert frames == [(9000, START_CODE + vps + START_CODE + sps + START_CODE + pps + START_CODE + nal)]
+    assert depacketizer.is_keyframe(frames[0][1])
+
+
+def test_aac_au_headers():
+    """RFC 3640 AAC-hbr: 13位长度 + 3位索引, 第i个AU的时间戳为包时间戳 + i*1024"""
+    depacketizer = AACDepacketizer({'sizelength': '13', 'indexlength': '3', 'config': '1210'})
+    assert depacketizer.extradata == b'\x12\x10'
+    units = [b'a' * 5, b'b' * 300, b'c' * 17]
+    headers = b''.join(((len(unit) << 3) | 0).to_bytes(2, 'big') for unit in units)
+    payload = (len(units) * 16).to_bytes(2, 'big') + headers + b''.join(units)
+    timestamp = MAX_TIMESTAMP - 1024
+    assert depacketizer.push(memoryview(payload), timestamp, True) == [
+        (timestamp, units[0]), (0, units[1]), (1024, units[2])]
+
+    # AU超出负载时丢弃它及之后的AU
+    assert depacketizer.push(memoryview(payload[:-1]), 0, True) == [(0, units[0]), (1024, units[1])]
+
+
+def test_digest_authorization_rfc2617_example(monkeypatch):
+    """RFC 2617 3.5节的示例"""
+    monkeypatch.setattr(RTSPIngest.os, 'urandom', lambda size: bytes.fromhex('0a4f113b'))
+    auth = RTSPAuthenticator('Mufasa', 'Circle Of Life')
+    assert auth.authorization('GET', '/dir/index.html') is None
+    assert auth.set_challenge('Basic realm="testrealm@host.com"\n'
+                              'Digest realm="testrealm@host.com", qop="auth,auth-int", '
+                              'nonce="dcd98b7102dd2f0e8b11d0f600bfb0c093", opaque="5ccc069c403ebaf9f0171e9517f40e41"')
+    header = auth.authorization('GET', '/dir/index.html')
+    assert header.startswith('Digest ')
+    assert 'response="6629fae49393a05397450978507c4ef1"' in header
+    assert 'nc=00000001' in header and 'cnonce="0a4f113b"' in header
+    assert 'opaque="5ccc069c403ebaf9f0171e9517f40e41"' in header
+    assert 'nc=00000002' in auth.authorization('GET', '/dir/index.html')
+
+
+def test_basic_authorization_and_unsupported_challenge():
+    auth = RTSPAuthenticator('Aladdin', 'open sesame')
+    assert not auth.set_challenge('Bearer realm="camera"')
+    assert auth.set_challenge('Basic realm="camera"')
+    assert auth.authorization('DESCRIBE', 'rtsp://camera/stream') == 'Basic QWxhZGRpbjpvcGVuIHNlc2FtZQ=='
+
+
+def test_parse_sdp():
+    sdp = "\r\n".join([
+        "v=0",
+        "o=- 0 0 IN IP4 127.0.0.1",
+        "s=Stream",
+        "a=control:*",
+        "m=video 0 RTP/AVP 96",
+        "a=rtpmap:96 H264/90000",
+        "a=fmtp:96 packetization-mode=1; sprop-parameter-sets=Z0LAHg==,aM48gA==; profile-level-id=42C01E",
+        "a=framerate:25",
+        "a=control:trackID=1",
+        "m=audio 0 RTP/AVP 0",
+        "a=control:rtsp://camera/stream/trackID=2",
+        "m=audio 0 RTP/AVP 97",
+        "a=rtpmap:97 MPEG4-GENERIC/16000/2",
+        "a=fmtp:97 streamtype=5; mode=AAC-hbr; config=1410; SizeLength=13; IndexLength=3",
+        "a=control:audio",
+        ""])
+    session_control, tracks = parse_sdp(sdp, 'rtsp://camera/stream/')
+    assert session_control == 'rtsp://camera/stream/'
+    video, pcmu, aac = tracks
+    assert (video.type, video.encoding, video.clock_rate, video.track_id, video.framerate) == ('video', 'H264', 90000, 1, 25.0)
+    assert video.control == 'rtsp://camera/stream/trackID=1'
+    assert video.fmtp['sprop-parameter-sets'] == 'Z0LAHg==,aM48gA=='
+    assert video.fmtp['packetization-mode'] == '1'
+    # 静态负载类型没有rtpmap
+    assert (pcmu.encoding, pcmu.clock_rate, pcmu.track_id, pcmu.control) == ('PCMU', 8000, 2, 'rtsp://camera/stream/trackID=2')
+    assert (aac.encoding, aac.clock_rate, aac.channels, aac.codec_name) == ('MPEG4-GENERIC', 16000, 2, 'aac')
+    assert aac.fmtp['sizelength'] == '13' and aac.fmtp['config'] == '1410'
+    assert aac.control == 'rtsp://camera/stream/audio'
+
+
+def test_unwrap_handles_wrap_and_reordering():
+    """pts从0开始, 跨越32位回绕后继续递增, B帧的时间戳回退时pts也回退"""
+    track = IngestTrack('video', 96, 0)
+    assert track.unwrap(MAX_TIMESTAMP - 3000) == 0
+    assert track.unwrap(MAX_TIMESTAMP - 1) == 2999
+    assert track.unwrap(2999) == 5999
+    assert track.unwrap(0) == 3000
+    assert track.unwrap(9000) == 12000
+
+
+def make_client(data:bytes):
+    """不建立连接的RTSPClient, 只用于解析接收缓冲区"""
+    client = RTSPClient.__new__(RTSPClient)
+    client.buffer = bytearray(data)
+    client.offset = 0
+    return client
+
+
+def test_parse_response_joins_repeated_headers_and_waits_for_body():
+    response = (b"RTSP/1.0 401 Unauthorized\r\nCSeq: 2\r\n"
+                b"WWW-Authenticate: Digest realm=\"cam\", nonce=\"abc\"\r\n"
+                b"WWW-Authenticate: Basic realm=\"cam\"\r\n"
+                b"Content-Length: 5\r\n\r\nhello")
+    client = make_client(response[:-2])
+    assert client.parse_response() is None
+    client.buffer += response[-2:] + b"$\x00\x00\x02ab"
+    message = client.parse_response()
+    assert message.status == 401
+    assert message.headers['www-authenticate'] == 'Digest realm="cam", nonce="abc"\nBasic realm="cam"'
+    assert message.body == 'hello'
+    assert client.buffer[client.offset:] == b"$\x00\x00\x02ab"
+
+
+def test_read_message_interleaved_packets_and_resync():
+    """交织包和响应混在同一个缓冲区中, 失步的字节被跳过"""
+    client = make_client(b"$\x00\x00\x03abc" + b"junk" + b"$\x01\x00\x01z" + b"RTSP/1.0 200 OK\r\nCSeq: 5\r\n\r\n")
+    assert client.read_message() == (0, b"abc")
+    assert client.read_message() == (1, b"z")
+    message = client.read_message()
+    assert message.status == 200 and message.headers['cseq'] == '5'